@@ -0,0 +1,211 @@
+import base64
+import binascii
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# ----------------------------------------------------------------------
+# AEAD Envelopes
+# A lighter e2ee envelope for traffic between the user device and the VPN
+# service than one Fernet token per message. The device opens a session
+# by picking a random session id; both sides derive the session secret
+# from the shared QA key with HKDF-SHA256, salted with that id, so the
+# id can travel in the clear in the X-Cdnx-Session header. Messages are
+# sealed with AES-256-GCM (AES and GHASH instructions on x86 and on the
+# ARMv8 crypto extensions of the Graviton instances) under 96 bit nonces
+# made of a direction and a message counter, and travel as raw binary
+# request and response bodies instead of base64 in the URL.
+#
+# Sealed message layout:
+#   8 byte big-endian counter | ciphertext | 16 byte GCM tag
+# Requests are sealed with the session key and the device's counter. Each
+# response is sealed under its own key, derived from the session secret
+# and a random salt sent back in X-Cdnx-Response-Salt, so a replayed
+# request can never make the VPN reuse a nonce. The session id, the
+# counter and, for requests, the endpoint path are bound in as associated
+# data.
+# ----------------------------------------------------------------------
+
+SESSION_HEADER = "X-Cdnx-Session"
+RESPONSE_SALT_HEADER = "X-Cdnx-Response-Salt"
+ENVELOPE_MIMETYPE = "application/vnd.cdnx.envelope"
+
+SESSION_ID_SIZE = 16
+COUNTER = struct.Struct(">Q")
+DIRECTION = struct.Struct(">I")
+TAG_SIZE = 16
+OVERHEAD = COUNTER.size + TAG_SIZE
+
+REQUEST_DIRECTION = 0
+RESPONSE_DIRECTION = 1
+
+SESSION_INFO = b"cdnx-e2ee-session-v1"
+REQUEST_INFO = b"cdnx-e2ee-request-v1"
+RESPONSE_INFO = b"cdnx-e2ee-response-v1"
+
+# Devices start a new session after this many seconds or messages
+SESSION_LIFETIME = float(os.getenv("cdnx_session_lifetime", 3600))
+SESSION_MAX_MESSAGES = 2**32
+
+# Sessions the VPN keeps derived keys for
+SESSION_CACHE_SIZE = int(os.getenv("cdnx_session_cache_size", 10000))
+
+
+def _derive(secret, salt, info):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(
+        secret
+    )
+
+
+class EnvelopeCipher:
+    """AES-GCM under one key with counter nonces, with a Fernet-like encrypt/decrypt."""
+
+    def __init__(self, key, direction, associated_data=b""):
+        self._aead = AESGCM(key)
+        self._nonce_prefix = DIRECTION.pack(direction)
+        self._associated_data = associated_data
+        self._lock = threading.Lock()
+        self.messages = 0
+
+    # context (the endpoint path) is authenticated along with the message
+    def encrypt(self, data, context=b""):
+        with self._lock:
+            counter = COUNTER.pack(self.messages)
+            self.messages += 1
+        return counter + self._aead.encrypt(
+            self._nonce_prefix + counter,
+            data,
+            self._associated_data + counter + context,
+        )
+
+    # Raises InvalidToken on failure, like Fernet, so callers handle both alike
+    def decrypt(self, token, context=b""):
+        if len(token) < OVERHEAD:
+            raise InvalidToken
+        counter = bytes(token[: COUNTER.size])
+        try:
+            return self._aead.decrypt(
+                self._nonce_prefix + counter,
+                bytes(token[COUNTER.size :]),
+                self._associated_data + counter + context,
+            )
+        except InvalidTag:
+            raise InvalidToken
+
+
+class EnvelopeSession:
+    """Keys shared by the device and the VPN for one session id."""
+
+    def __init__(self, shared_key, session_id=None):
+        self.session_id = session_id or os.urandom(SESSION_ID_SIZE)
+        self.created = time.monotonic()
+        # Fernet keys are urlsafe base64 of 32 bytes, reuse the raw bytes as key material
+        self._secret = _derive(
+            base64.urlsafe_b64decode(shared_key), self.session_id, SESSION_INFO
+        )
+        # One counter for every request of the session, whatever the endpoint
+        self.requests = EnvelopeCipher(
+            _derive(self._secret, b"", REQUEST_INFO),
+            REQUEST_DIRECTION,
+            associated_data=self.session_id,
+        )
+
+    @property
+    def expired(self):
+        return (
+            time.monotonic() - self.created > SESSION_LIFETIME
+            or self.requests.messages >= SESSION_MAX_MESSAGES
+        )
+
+    # Headers that tell the VPN which session a request belongs to
+    def headers(self):
+        return {SESSION_HEADER: self.session_id.hex()}
+
+    def seal_request(self, path, data):
+        return self.requests.encrypt(data, path.encode("utf-8"))
+
+    def open_request(self, path, token):
+        return self.requests.decrypt(token, path.encode("utf-8"))
+
+    # A cipher under a fresh key for one response. Returns the salt to send back
+    # along with the cipher; pass the received salt to open a response.
+    def response_cipher(self, salt=None):
+        if salt is None:
+            salt = os.urandom(SESSION_ID_SIZE)
+        cipher = EnvelopeCipher(
+            _derive(self._secret, salt, RESPONSE_INFO),
+            RESPONSE_DIRECTION,
+            associated_data=self.session_id,
+        )
+        return salt, cipher
+
+    # Opens a single-message response given its headers and body
+    def open_response(self, headers, token):
+        return self.response_cipher(response_salt(headers))[1].decrypt(token)
+
+
+# Salt of a response from its headers, raising InvalidToken if it is missing
+def response_salt(headers):
+    try:
+        return binascii.unhexlify(headers[RESPONSE_SALT_HEADER])
+    except (KeyError, binascii.Error):
+        raise InvalidToken
+
+
+class DeviceSessions:
+    """The device's current session, replaced when it expires."""
+
+    def __init__(self, shared_key):
+        self._shared_key = shared_key
+        self._session = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if self._session is None or self._session.expired:
+                self._session = EnvelopeSession(self._shared_key)
+            return self._session
+
+
+class SessionCache:
+    """The VPN's sessions by id, so keys are derived once per session."""
+
+    def __init__(self, shared_key, max_entries=SESSION_CACHE_SIZE):
+        self._shared_key = shared_key
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the session for a X-Cdnx-Session header value, or None if the request
+    # did not use an envelope. Raises InvalidToken for a malformed session id.
+    def for_headers(self, headers):
+        session_id = headers.get(SESSION_HEADER)
+        if session_id is None:
+            return None
+        try:
+            session_id = binascii.unhexlify(session_id)
+        except binascii.Error:
+            raise InvalidToken
+        if len(session_id) != SESSION_ID_SIZE:
+            raise InvalidToken
+
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                return session
+
+        session = EnvelopeSession(self._shared_key, session_id)
+        with self._lock:
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+        return session
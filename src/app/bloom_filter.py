@@ -0,0 +1,295 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# ----------------------------------------------------------------------
+# Content Key Bloom Filters
+# Lets the VPN service answer definite CDNx misses without a round trip to
+# the content key cache. The cache keeps a counting Bloom filter of its
+# key set and publishes the plain bit array; the VPN holds a replica of it
+# in memory and only asks the cache about keys the filter says might be
+# there. A Bloom filter has no false negatives, so a key it rejects is
+# certainly not in the VPN-managed CDN, while a false positive only costs
+# the lookup that would have happened anyway.
+#
+# Positions are derived from the same 16 byte BLAKE2b digests the content
+# key index stores (content_key_index.digest) by double hashing, so the
+# cache can rebuild its filter from the index without the content keys.
+#
+# Replicas stay current with deltas: every bit that turns on or off bumps
+# the filter's sequence number and is logged, and a replica asks for the
+# positions changed since the sequence it holds. The counters make removals
+# possible; keys the index drops on its own (eviction, expiry) keep their
+# bits until the next rebuild, which starts a new generation that replicas
+# reload in full.
+# ----------------------------------------------------------------------
+
+# False positive rate the filter is sized for at its capacity
+FALSE_POSITIVE_RATE = float(os.getenv("cdnx_filter_false_positive_rate", 0.01))
+
+# Bit changes kept for deltas; older replicas reload the whole filter
+DELTA_LOG_SIZE = int(os.getenv("cdnx_filter_delta_log", 100000))
+
+FILTER_MIMETYPE = "application/vnd.cdnx.bloom"
+GENERATION_HEADER = "X-Cdnx-Filter-Generation"
+SEQUENCE_HEADER = "X-Cdnx-Filter-Sequence"
+HASHES_HEADER = "X-Cdnx-Filter-Hashes"
+
+
+# Bits and hash count of a filter holding capacity keys at false_positive_rate
+def filter_shape(capacity, false_positive_rate):
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+    bits = max(64, -(-bits // 8) * 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def positions(key_digest, bit_count, hashes):
+    first = int.from_bytes(key_digest[:8], "little")
+    second = int.from_bytes(key_digest[8:16], "little") | 1
+    return [(first + i * second) % bit_count for i in range(hashes)]
+
+
+class BloomFilter:
+    """A Bloom filter bit array over content key digests."""
+
+    def __init__(self, bit_count, hashes, bits=None):
+        self.bit_count = bit_count
+        self.hashes = hashes
+        self.bits = bytearray(bit_count // 8) if bits is None else bytearray(bits)
+
+    def might_contain(self, key_digest):
+        bits = self.bits
+        for position in positions(key_digest, self.bit_count, self.hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key_digest):
+        for position in positions(key_digest, self.bit_count, self.hashes):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def set_bit(self, position, value):
+        if value:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        else:
+            self.bits[position >> 3] &= ~(1 << (position & 7)) & 0xFF
+
+    # Share of bits set, and the false positive rate that fill gives
+    def fill_ratio(self):
+        return bin(int.from_bytes(self.bits, "little")).count("1") / self.bit_count
+
+    def estimated_false_positive_rate(self):
+        return self.fill_ratio() ** self.hashes
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+class CountingBloomFilter:
+    """The content key cache's filter: saturating counters plus a log of bit changes."""
+
+    def __init__(self, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.bit_count, self.hashes = filter_shape(capacity, false_positive_rate)
+        self._lock = threading.Lock()
+        self.rebuild(())
+
+    # Replaces the contents with the given digests and starts a new generation. Callers
+    # must hold off adds and removes until it returns, or a removal of a key missing
+    # from the digests could clear the bits of another key.
+    def rebuild(self, key_digests):
+        counters = bytearray(self.bit_count)
+        bloom = BloomFilter(self.bit_count, self.hashes)
+        for key_digest in key_digests:
+            for position in positions(key_digest, self.bit_count, self.hashes):
+                if counters[position] < 255:
+                    counters[position] += 1
+            bloom.add(key_digest)
+
+        with self._lock:
+            self._counters = counters
+            self._bloom = bloom
+            self.generation = os.urandom(4).hex()
+            self.sequence = 0
+            self._changes = deque(maxlen=DELTA_LOG_SIZE)
+
+    def add(self, key_digest):
+        with self._lock:
+            for position in positions(key_digest, self.bit_count, self.hashes):
+                count = self._counters[position]
+                if count == 0:
+                    self._changed(position, True)
+                if count < 255:
+                    self._counters[position] = count + 1
+
+    # Only digests that were added may be removed. Saturated counters never go down
+    # since their true count is unknown.
+    def remove(self, key_digest):
+        with self._lock:
+            for position in positions(key_digest, self.bit_count, self.hashes):
+                count = self._counters[position]
+                if 0 < count < 255:
+                    self._counters[position] = count - 1
+                    if count == 1:
+                        self._changed(position, False)
+
+    def _changed(self, position, value):
+        self._bloom.set_bit(position, value)
+        self.sequence += 1
+        self._changes.append((self.sequence, position))
+
+    def might_contain(self, key_digest):
+        return self._bloom.might_contain(key_digest)
+
+    # The whole bit array with the generation and sequence it reflects
+    def snapshot(self):
+        with self._lock:
+            return self.generation, self.sequence, bytes(self._bloom.bits)
+
+    # The positions set and cleared since a sequence of this generation, or None if
+    # the log no longer covers it and the replica has to reload the whole filter
+    def delta(self, generation, since):
+        with self._lock:
+            if generation != self.generation or since > self.sequence:
+                return None
+            if since < self.sequence and (
+                not self._changes or self._changes[0][0] > since + 1
+            ):
+                return None
+
+            changed = {
+                position for sequence, position in self._changes if sequence > since
+            }
+            bits = self._bloom
+            return {
+                "generation": self.generation,
+                "sequence": self.sequence,
+                "set": sorted(
+                    position
+                    for position in changed
+                    if bits.bits[position >> 3] & (1 << (position & 7))
+                ),
+                "cleared": sorted(
+                    position
+                    for position in changed
+                    if not bits.bits[position >> 3] & (1 << (position & 7))
+                ),
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "generation": self.generation,
+                "sequence": self.sequence,
+                "bits": self.bit_count,
+                "hashes": self.hashes,
+                "capacity": self.capacity,
+                "memory_bytes": len(self._counters) + self._bloom.memory_bytes,
+                "target_false_positive_rate": self.false_positive_rate,
+                "estimated_false_positive_rate": (
+                    self._bloom.estimated_false_positive_rate()
+                ),
+            }
+
+
+class FilterReplica:
+    """The VPN's copy of one content key cache shard's filter."""
+
+    def __init__(self, max_age=None):
+        # A replica not refreshed for max_age seconds stops rejecting keys, so a cache
+        # shard that cannot be reached never leaves newly published keys unservable
+        self.max_age = max_age
+        self._bloom = None
+        self.generation = None
+        self.sequence = 0
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+        self.rejected = 0
+        self.passed = 0
+        self.full_loads = 0
+        self.delta_loads = 0
+        self.refresh_errors = 0
+
+    @property
+    def current(self):
+        return self._bloom is not None and (
+            self.max_age is None or time.monotonic() - self.refreshed_at <= self.max_age
+        )
+
+    # False only for keys that are certainly not in the shard. Until the filter has
+    # been loaded, or once it is stale, every key might be.
+    def might_contain(self, key_digest):
+        bloom = self._bloom
+        if not self.current or bloom.might_contain(key_digest):
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    # Sets the bits of a key that was just published, ahead of the next refresh
+    def add(self, key_digest):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(key_digest)
+
+    # Query string asking the cache for what changed since this replica's version
+    def query(self):
+        if self.generation is None:
+            return ""
+        return "?generation=%s&since=%d" % (self.generation, self.sequence)
+
+    # Applies a /filter response: the whole bit array or a JSON delta
+    def apply(self, mimetype, headers, body):
+        with self._lock:
+            if mimetype == FILTER_MIMETYPE:
+                self._bloom = BloomFilter(
+                    len(body) * 8, int(headers[HASHES_HEADER]), body
+                )
+                self.generation = headers[GENERATION_HEADER]
+                self.sequence = int(headers[SEQUENCE_HEADER])
+                self.refreshed_at = time.monotonic()
+                self.full_loads += 1
+                return
+
+            for position in body["set"]:
+                self._bloom.set_bit(position, True)
+            for position in body["cleared"]:
+                self._bloom.set_bit(position, False)
+            self.sequence = body["sequence"]
+            self.refreshed_at = time.monotonic()
+            self.delta_loads += 1
+
+    def stats(self):
+        bloom = self._bloom
+        checked = self.rejected + self.passed
+        stats = {
+            "loaded": bloom is not None,
+            "current": self.current,
+            "generation": self.generation,
+            "sequence": self.sequence,
+            "rejected": self.rejected,
+            "passed": self.passed,
+            "rejected_ratio": self.rejected / checked if checked else 0.0,
+            "full_loads": self.full_loads,
+            "delta_loads": self.delta_loads,
+            "refresh_errors": self.refresh_errors,
+        }
+        if bloom is not None:
+            stats.update(
+                {
+                    "bits": bloom.bit_count,
+                    "hashes": bloom.hashes,
+                    "memory_bytes": bloom.memory_bytes,
+                    "estimated_false_positive_rate": (
+                        bloom.estimated_false_positive_rate()
+                    ),
+                }
+            )
+        return stats
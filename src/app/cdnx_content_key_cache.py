@@ -1,6 +1,19 @@
 import os
+import threading
+import time
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+
+import metrics
+import timing
+from bloom_filter import (
+    FILTER_MIMETYPE,
+    GENERATION_HEADER,
+    HASHES_HEADER,
+    SEQUENCE_HEADER,
+    CountingBloomFilter,
+)
+from content_key_index import ContentKeyIndex, digest
 
 # ----------------------------------------------------------------------
 # CDNx Content Key Cache Service Code
@@ -10,33 +23,246 @@ from flask import Flask, jsonify, request
 # ----------------------------------------------------------------------
 
 app = Flask(__name__)
+timing.init_app(app)
+metrics.init_app(app)
 
 # This constant corresponds to the VPN-managed cache entry for the asset requested in the simulation. It is
 # passed to the server during deployment in cdk.py
-ENCRYPTED_CONTENT_KEY = os.getenv("cdnx_encrypted_content_key").encode("utf-8")
+ENCRYPTED_CONTENT_KEY = os.getenv("cdnx_encrypted_content_key", "").encode("utf-8")
+
+# Sizing of the content key index and the snapshot it is bulk loaded from at startup
+INDEX_MAX_ENTRIES = int(os.getenv("cdnx_index_max_entries", 1000000))
+INDEX_MAX_VALUE_BYTES = int(os.getenv("cdnx_index_max_value_bytes", 256 * 1024 * 1024))
+INDEX_TTL = int(os.getenv("cdnx_index_ttl", 0))
+INDEX_SNAPSHOT = os.getenv("cdnx_index_snapshot")
+
+# Keys the Bloom filter published to VPN services is sized for, and how often it is
+# rebuilt from the index to drop the bits of evicted and expired keys
+FILTER_CAPACITY = int(os.getenv("cdnx_filter_capacity", INDEX_MAX_ENTRIES))
+FILTER_REBUILD_INTERVAL = float(os.getenv("cdnx_filter_rebuild_interval", 600))
+
+# Comma separated base URLs of VPN services to push invalidations to when entries change
+INVALIDATION_SUBSCRIBERS = [
+    url for url in os.getenv("cdnx_invalidation_subscribers", "").split(",") if url
+]
+
+content_key_index = ContentKeyIndex(
+    INDEX_MAX_ENTRIES, max_value_bytes=INDEX_MAX_VALUE_BYTES, default_ttl=INDEX_TTL
+)
+if INDEX_SNAPSHOT and os.path.exists(INDEX_SNAPSHOT):
+    content_key_index.load(INDEX_SNAPSHOT)
+
+# The single asset used by the original experiment stays available without a snapshot
+if ENCRYPTED_CONTENT_KEY:
+    content_key_index.put("10mb.bin", ENCRYPTED_CONTENT_KEY, ttl=0)
+
+# Membership filter of the key set that VPN services fetch from /filter. Inserts,
+# removals and rebuilds hold key_set_lock so the filter never misses a key in the index.
+content_key_filter = CountingBloomFilter(FILTER_CAPACITY)
+key_set_lock = threading.Lock()
+filter_rebuilds_started = threading.Event()
+content_key_filter.rebuild(content_key_index.digests())
+
+
+# Clears the bits of keys the index evicted or expired on its own
+def rebuild_filter_periodically():
+    while True:
+        time.sleep(FILTER_REBUILD_INTERVAL)
+        with key_set_lock:
+            content_key_filter.rebuild(content_key_index.digests())
 
-# Heartbeat endpoint included on all services for testing deployment status
 
+# The rebuild thread starts with the first request rather than on import, so it runs
+# in the worker process when the app is preloaded before forking (see serve.py)
+@app.before_request
+def start_filter_rebuilds():
+    if FILTER_REBUILD_INTERVAL > 0 and not filter_rebuilds_started.is_set():
+        filter_rebuilds_started.set()
+        threading.Thread(target=rebuild_filter_periodically, daemon=True).start()
 
+
+# Heartbeat endpoint included on all services for testing deployment status
 @app.route("/heartbeat")
 def heartbeat():
     """Return a simple OK message for health checks."""
     return jsonify({"status": "ok", "message": "Flask heartbeat OK"}), 200
 
 
-# The main endpoint of this service simulates a cache hit/miss encounter to check whether
-# a given content key is available in the cache. Since the experiment is run with a single
-# asset the conditional is hardcoded to return a valid token for the encrypted asset.
+# The main endpoint of this service checks whether a given content key is available in
+# the VPN-managed CDN and, on a hit, returns the encrypted content key it is stored under.
 @app.route("/content_key")
 def check_content_key():
     content_key = request.args.get("content_key")
+    if not content_key:
+        return jsonify("content_key is required"), 400
+
+    with timing.current_trace().span("index_lookup"):
+        encrypted_content_key = content_key_index.get(content_key)
+    if encrypted_content_key is not None:
+        metrics.LOOKUPS.labels("hit").inc()
+        return encrypted_content_key
+
+    metrics.LOOKUPS.labels("miss").inc()
+    return jsonify("Key not found"), 404
+
+
+# Bulk variant of /content_key for pages and segmented media that need many objects.
+# Expects a JSON body with a content_keys list and returns the encrypted content keys
+# of the hits along with the explicit list of misses.
+@app.route("/content_keys", methods=["POST"])
+def check_content_keys():
+    body = request.get_json(silent=True) or {}
+    content_keys = body.get("content_keys")
+    if not isinstance(content_keys, list):
+        return jsonify("content_keys list is required"), 400
+
+    hits = {}
+    misses = []
+    with timing.current_trace().span("index_lookup"):
+        for content_key in content_keys:
+            encrypted_content_key = content_key_index.get(content_key)
+            if encrypted_content_key is None:
+                misses.append(content_key)
+            else:
+                hits[content_key] = encrypted_content_key.decode("utf-8")
+    metrics.LOOKUPS.labels("hit").inc(len(hits))
+    metrics.LOOKUPS.labels("miss").inc(len(misses))
+
+    return jsonify({"hits": hits, "misses": misses}), 200
+
+
+# Inserts or replaces an entry when an asset is published to the VPN-managed CDN.
+# Expects a JSON body with content_key, encrypted_content_key and an optional ttl.
+@app.route("/content_key", methods=["PUT"])
+def insert_content_key():
+    body = request.get_json(silent=True) or {}
+    content_key = body.get("content_key")
+    encrypted_content_key = body.get("encrypted_content_key")
+    if not content_key or not encrypted_content_key:
+        return jsonify("content_key and encrypted_content_key are required"), 400
+    # A ttl of 0 keeps the entry until it is removed
+    ttl = body.get("ttl")
+    if ttl is not None and (
+        isinstance(ttl, bool)
+        or not isinstance(ttl, (int, float))
+        or not 0 <= ttl < float("inf")
+    ):
+        return jsonify("ttl must be a non-negative number of seconds"), 400
+
+    with key_set_lock:
+        if content_key_index.put(content_key, encrypted_content_key, ttl=ttl):
+            content_key_filter.add(digest(content_key))
+    push_invalidation([content_key])
+    return jsonify({"status": "ok"}), 200
+
+
+# Removes an entry when an asset is taken off the VPN-managed CDN
+@app.route("/content_key", methods=["DELETE"])
+def invalidate_content_key():
+    content_key = request.args.get("content_key")
+    if not content_key:
+        return jsonify("content_key is required"), 400
+
+    with key_set_lock:
+        removed = content_key_index.invalidate(content_key)
+        if removed:
+            content_key_filter.remove(digest(content_key))
+    push_invalidation([content_key])
+    return jsonify({"status": "ok", "removed": removed}), 200
+
+
+# Serves the membership filter of the key set to VPN services. A request carrying the
+# generation and sequence of the copy it holds gets a JSON delta of the bits changed
+# since, when the change log still covers it; otherwise the whole bit array is sent.
+@app.route("/filter")
+def key_set_filter():
+    generation = request.args.get("generation")
+    since = request.args.get("since", type=int)
+    if generation and since is not None:
+        delta = content_key_filter.delta(generation, since)
+        if delta is not None:
+            return jsonify(delta)
+
+    generation, sequence, bits = content_key_filter.snapshot()
+    return Response(
+        bits,
+        mimetype=FILTER_MIMETYPE,
+        headers={
+            GENERATION_HEADER: generation,
+            SEQUENCE_HEADER: str(sequence),
+            HASHES_HEADER: str(content_key_filter.hashes),
+        },
+    )
+
+
+# Tells subscribed VPN services to drop their cached lookups for changed keys. This
+# runs in the background so inserts and invalidations are not held up by the VPNs.
+def push_invalidation(content_keys):
+    if not INVALIDATION_SUBSCRIBERS:
+        return
+
+    # Imported here so a cache without subscribers never loads requests
+    import http_client
+
+    def notify():
+        for subscriber in INVALIDATION_SUBSCRIBERS:
+            try:
+                http_client.post(
+                    f"{subscriber}/cdnx_invalidate",
+                    json={"content_keys": content_keys},
+                )
+            except Exception as e:
+                print(e)
+
+    threading.Thread(target=notify, daemon=True).start()
+
+
+# Reports the size and eviction counters of the content key index
+@app.route("/index_stats")
+def index_stats():
+    return jsonify(
+        {
+            "entries": len(content_key_index),
+            "max_entries": content_key_index.max_entries,
+            "memory_bytes": content_key_index.memory_bytes,
+            "evictions": content_key_index.evictions,
+            "expirations": content_key_index.expirations,
+            "filter": content_key_filter.stats(),
+        }
+    )
+
+
+# Metric families of the content key index, read on each scrape
+def index_metrics():
+    return [
+        metrics.family(
+            "cdnx_index_entries",
+            "gauge",
+            "Entries in the content key index.",
+            len(content_key_index),
+        ),
+        metrics.family(
+            "cdnx_index_memory_bytes",
+            "gauge",
+            "Memory held by the content key index.",
+            content_key_index.memory_bytes,
+        ),
+        metrics.family(
+            "cdnx_index_removals_total",
+            "counter",
+            "Entries the content key index dropped on its own, by reason.",
+            {
+                "eviction": content_key_index.evictions,
+                "expiration": content_key_index.expirations,
+            },
+            "reason",
+        ),
+    ]
 
-    if content_key == "10mb.bin":
-        return ENCRYPTED_CONTENT_KEY
 
-    return jsonify("Key not found", 500)
+metrics.register_collector("index", index_metrics)
 
 
 if __name__ == "__main__":
-    # Listen on all interfaces, port 8000
-    app.run(host="0.0.0.0", port=8000)
+    # Listen on all interfaces, port 8000 unless cdnx_port says otherwise
+    app.run(host="0.0.0.0", port=int(os.getenv("cdnx_port", 8000)))
@@ -0,0 +1,140 @@
+import bisect
+import hashlib
+import os
+import threading
+
+# ----------------------------------------------------------------------
+# Consistent Hashing
+# Routes content keys to the shards of the content key cache. Every shard
+# is placed on a 64 bit hash ring at VIRTUAL_NODES pseudo-random points,
+# and a key belongs to the shard owning the first point at or after the
+# key's own hash. Adding or removing a shard only moves the keys of the
+# arcs next to its points (about 1/N of the keys) instead of reshuffling
+# everything the way hash(key) % N would, and the many virtual nodes keep
+# the share of keys each shard owns close to even.
+#
+# Shards are named separately from their addresses so that the routing,
+# and any per-shard index snapshot built from it, survive a shard moving
+# to a new host. Shard lists are written as comma separated entries of
+# name=host[:port], or just host[:port] to use the address as the name.
+# ----------------------------------------------------------------------
+
+# Points each shard gets on the ring
+VIRTUAL_NODES = int(os.getenv("cdnx_cache_virtual_nodes", 160))
+
+
+def ring_hash(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+
+
+# Parses a shard list into a list of (name, address) pairs, in order
+def parse_shards(shard_list, default_port=8000):
+    shards = []
+    for entry in shard_list.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, address = entry.rpartition("=")
+        address = address if ":" in address else "%s:%d" % (address, default_port)
+        shards.append((name or address, address))
+    return shards
+
+
+class HashRing:
+    """Consistent hash ring of named shards with virtual nodes."""
+
+    def __init__(self, shards=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        # (sorted points, owner of each point, shards), replaced as a whole so readers
+        # never see the points of one ring with the owners of another
+        self._ring = ([], [], [])
+        self._lock = threading.Lock()
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self):
+        return len(self._ring[2])
+
+    def __contains__(self, shard):
+        return shard in self._ring[2]
+
+    @property
+    def shards(self):
+        return list(self._ring[2])
+
+    def add(self, shard):
+        with self._lock:
+            points, owners, shards = self._ring
+            if shard in shards:
+                return
+            points = list(zip(points, owners))
+            for replica in range(self.virtual_nodes):
+                points.append((ring_hash("%s#%d" % (shard, replica)), shard))
+            self._rebuild(points, shards + [shard])
+
+    def remove(self, shard):
+        with self._lock:
+            points, owners, shards = self._ring
+            if shard not in shards:
+                return
+            self._rebuild(
+                [
+                    (point, owner)
+                    for point, owner in zip(points, owners)
+                    if owner != shard
+                ],
+                [other for other in shards if other != shard],
+            )
+
+    def _rebuild(self, points, shards):
+        points.sort()
+        self._ring = (
+            [point for point, _ in points],
+            [owner for _, owner in points],
+            shards,
+        )
+
+    # The shard that owns a key
+    def shard_for(self, key):
+        points, owners, _ = self._ring
+        if not points:
+            raise LookupError("the hash ring has no shards")
+        position = bisect.bisect_left(points, ring_hash(key))
+        return owners[position % len(points)]
+
+    # The first count distinct shards clockwise from the key: the owner first, then
+    # the shards holding its replicas
+    def shards_for(self, key, count):
+        points, owners, ring_shards = self._ring
+        if not points:
+            raise LookupError("the hash ring has no shards")
+        count = min(count, len(ring_shards))
+        position = bisect.bisect_left(points, ring_hash(key))
+
+        shards = []
+        for offset in range(len(points)):
+            owner = owners[(position + offset) % len(points)]
+            if owner not in shards:
+                shards.append(owner)
+                if len(shards) == count:
+                    break
+        return shards
+
+    # Groups keys by the shard to ask for them: their owner or, once shards are
+    # excluded after failing, the next of their replicas that is not excluded. Keys
+    # with no replica left are grouped under None.
+    def partition(self, keys, replicas=1, exclude=()):
+        groups = {}
+        for key in keys:
+            shard = next(
+                (
+                    shard
+                    for shard in self.shards_for(key, replicas)
+                    if shard not in exclude
+                ),
+                None,
+            )
+            groups.setdefault(shard, []).append(key)
+        return groups
@@ -0,0 +1,425 @@
+import hashlib
+import mmap
+import random
+import struct
+import threading
+import time
+from array import array
+
+# ----------------------------------------------------------------------
+# Content Key Index
+# The in-memory index behind the CDNx content key cache. It maps content
+# keys to the encrypted content keys the VPN-managed CDN stores assets
+# under, sized for millions of objects on a small instance:
+#   - content keys are never stored, only 16 byte BLAKE2b digests packed
+#     side by side in one bytearray
+#   - encrypted content keys live back to back in a single byte arena
+#   - an open-addressing table of entry numbers gives O(1) lookups
+#   - per-entry expiry and last-access times are fixed-width arrays
+# Eviction is TTL plus approximated LRU: when the index is full a handful
+# of random entries are sampled and the least recently used one is evicted,
+# the same tradeoff Redis makes to avoid a linked list per entry.
+#
+# Snapshots are written in the same layout the index uses in memory (native
+# byte order, which is little-endian on both the x86 build hosts and the
+# Graviton instances), so a restart maps the file and copies each section
+# in bulk instead of re-inserting every entry.
+# ----------------------------------------------------------------------
+
+DIGEST_SIZE = 16
+
+EMPTY = -1
+TOMBSTONE = -2
+
+# Entries sampled per eviction when approximating LRU
+EVICTION_SAMPLES = 8
+
+SNAPSHOT_MAGIC = b"CDNXIDX1"
+# magic, version, entry count, table size, arena length
+SNAPSHOT_HEADER = struct.Struct("<8sIIIQ")
+SNAPSHOT_VERSION = 1
+
+
+def digest(content_key):
+    if isinstance(content_key, str):
+        content_key = content_key.encode("utf-8")
+    return hashlib.blake2b(content_key, digest_size=DIGEST_SIZE).digest()
+
+
+def _table_size_for(max_entries):
+    # Keep the load factor at or below one half so probe sequences stay short
+    size = 8
+    while size < max_entries * 2:
+        size <<= 1
+    return size
+
+
+class ContentKeyIndex:
+    """Bounded content key -> encrypted content key index with TTL and LRU eviction."""
+
+    def __init__(self, max_entries, max_value_bytes=256 * 1024 * 1024, default_ttl=0):
+        self.max_entries = max_entries
+        self.max_value_bytes = max_value_bytes
+        self.default_ttl = default_ttl
+
+        self._lock = threading.Lock()
+        self._reset(_table_size_for(max_entries))
+
+    def _reset(self, table_size):
+        self._slots = array("i", [EMPTY]) * table_size
+        self._mask = table_size - 1
+        self._tombstones = 0
+
+        self._digests = bytearray(self.max_entries * DIGEST_SIZE)
+        self._offsets = array("I", [0]) * self.max_entries
+        self._lengths = array("I", [0]) * self.max_entries
+        self._expiry = array("I", [0]) * self.max_entries
+        self._access = array("I", [0]) * self.max_entries
+        self._live = bytearray(self.max_entries)
+
+        # Entry numbers are handed out in order, freed ones are reused first
+        self._allocated = 0
+        self._free = array("i")
+        self._count = 0
+
+        self._arena = bytearray()
+        self._dead_bytes = 0
+        self._clock = 0
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return self._count
+
+    # Bytes held by the index structures and value arena
+    @property
+    def memory_bytes(self):
+        return (
+            self._slots.itemsize * len(self._slots)
+            + len(self._digests)
+            + self._offsets.itemsize * len(self._offsets)
+            + self._lengths.itemsize * len(self._lengths)
+            + self._expiry.itemsize * len(self._expiry)
+            + self._access.itemsize * len(self._access)
+            + len(self._live)
+            + len(self._arena)
+        )
+
+    # ------------------------------------------------------------------
+    # Public operations
+    # ------------------------------------------------------------------
+
+    # Returns the encrypted content key for a content key, or None on a miss
+    def get(self, content_key):
+        key_digest = digest(content_key)
+
+        with self._lock:
+            position, entry = self._find(key_digest)
+            if entry < 0:
+                return None
+
+            expiry = self._expiry[entry]
+            if expiry and expiry <= time.time():
+                self._remove(position, entry)
+                self.expirations += 1
+                return None
+
+            self._clock += 1
+            self._access[entry] = self._clock & 0xFFFFFFFF
+
+            offset = self._offsets[entry]
+            return bytes(self._arena[offset : offset + self._lengths[entry]])
+
+    # Inserts or replaces an entry, evicting others if the index is full. Returns True
+    # if the content key was not in the index before.
+    def put(self, content_key, encrypted_content_key, ttl=None):
+        if isinstance(encrypted_content_key, str):
+            encrypted_content_key = encrypted_content_key.encode("utf-8")
+        ttl = self.default_ttl if ttl is None else ttl
+        expiry = int(time.time() + ttl) if ttl else 0
+        key_digest = digest(content_key)
+
+        with self._lock:
+            return self._put(key_digest, encrypted_content_key, expiry)
+
+    # Removes an entry, returning True if it was present
+    def invalidate(self, content_key):
+        key_digest = digest(content_key)
+
+        with self._lock:
+            position, entry = self._find(key_digest)
+            if entry < 0:
+                return False
+            self._remove(position, entry)
+            return True
+
+    # Digests of all live entries, for rebuilding a filter of the key set
+    def digests(self):
+        with self._lock:
+            digests = self._digests
+            return [
+                bytes(digests[entry * DIGEST_SIZE : (entry + 1) * DIGEST_SIZE])
+                for entry in range(self._allocated)
+                if self._live[entry]
+            ]
+
+    # ------------------------------------------------------------------
+    # Snapshots
+    # ------------------------------------------------------------------
+
+    # Writes the live entries to disk in the in-memory layout
+    def save(self, path):
+        with self._lock:
+            self._compact()
+
+            count = self._allocated
+            header = SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                count,
+                len(self._slots),
+                len(self._arena),
+            )
+            with open(path, "wb") as out:
+                out.write(header)
+                out.write(memoryview(self._slots).cast("B"))
+                out.write(memoryview(self._digests)[: count * DIGEST_SIZE])
+                out.write(memoryview(self._offsets)[:count].cast("B"))
+                out.write(memoryview(self._lengths)[:count].cast("B"))
+                out.write(memoryview(self._expiry)[:count].cast("B"))
+                out.write(self._arena)
+
+    # Replaces the contents of the index with a snapshot file. The file is memory
+    # mapped and each section copied in bulk; the hash table is only rebuilt when
+    # the snapshot was written with a different capacity.
+    def load(self, path):
+        with open(path, "rb") as source, self._lock:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                self._load(view)
+            finally:
+                view.release()
+                mapped.close()
+
+    def _load(self, view):
+        magic, version, count, table_size, arena_length = SNAPSHOT_HEADER.unpack_from(
+            view
+        )
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("not a content key index snapshot")
+        if count > self.max_entries:
+            raise ValueError(
+                "snapshot holds %d entries but the index is capped at %d"
+                % (count, self.max_entries)
+            )
+
+        own_table_size = _table_size_for(self.max_entries)
+        self._reset(own_table_size)
+
+        position = SNAPSHOT_HEADER.size
+
+        def section(length):
+            nonlocal position
+            start = position
+            position += length
+            return view[start:position]
+
+        slots = section(table_size * 4)
+        self._digests[: count * DIGEST_SIZE] = section(count * DIGEST_SIZE)
+        self._offsets[:count] = _array_from("I", section(count * 4))
+        self._lengths[:count] = _array_from("I", section(count * 4))
+        self._expiry[:count] = _array_from("I", section(count * 4))
+        self._arena = bytearray(section(arena_length))
+        self._live[:count] = b"\x01" * count
+        self._allocated = count
+        self._count = count
+
+        if table_size == own_table_size:
+            self._slots = _array_from("i", slots)
+        else:
+            self._rehash()
+
+    # ------------------------------------------------------------------
+    # Internals, all called with the lock held
+    # ------------------------------------------------------------------
+
+    # Probes for a digest. Returns (slot position, entry) on a hit, or the slot
+    # position an insert should use and -1 on a miss.
+    def _find(self, key_digest):
+        slots = self._slots
+        digests = self._digests
+        mask = self._mask
+        position = int.from_bytes(key_digest[:8], "little") & mask
+        first_tombstone = -1
+
+        while True:
+            entry = slots[position]
+            if entry == EMPTY:
+                if first_tombstone >= 0:
+                    return first_tombstone, -1
+                return position, -1
+            if entry == TOMBSTONE:
+                if first_tombstone < 0:
+                    first_tombstone = position
+            else:
+                start = entry * DIGEST_SIZE
+                if digests[start : start + DIGEST_SIZE] == key_digest:
+                    return position, entry
+            position = (position + 1) & mask
+
+    def _put(self, key_digest, value, expiry):
+        position, entry = self._find(key_digest)
+        inserted = entry < 0
+        if entry >= 0:
+            self._dead_bytes += self._lengths[entry]
+        else:
+            while self._count >= self.max_entries:
+                self._evict_one()
+            # Evictions may have moved tombstones around, probe again for the slot
+            position, _ = self._find(key_digest)
+            entry = self._allocate()
+            if self._slots[position] == TOMBSTONE:
+                self._tombstones -= 1
+            self._slots[position] = entry
+            start = entry * DIGEST_SIZE
+            self._digests[start : start + DIGEST_SIZE] = key_digest
+            self._live[entry] = 1
+            self._count += 1
+
+        self._offsets[entry] = len(self._arena)
+        self._lengths[entry] = len(value)
+        self._arena += value
+        self._expiry[entry] = expiry
+        self._clock += 1
+        self._access[entry] = self._clock & 0xFFFFFFFF
+
+        while (
+            len(self._arena) - self._dead_bytes > self.max_value_bytes
+            and self._count > 1
+        ):
+            self._evict_one()
+        if self._dead_bytes > len(self._arena) // 2:
+            self._compact_arena()
+        return inserted
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        entry = self._allocated
+        self._allocated += 1
+        return entry
+
+    def _remove(self, position, entry):
+        self._slots[position] = TOMBSTONE
+        self._tombstones += 1
+        self._live[entry] = 0
+        self._dead_bytes += self._lengths[entry]
+        self._lengths[entry] = 0
+        self._free.append(entry)
+        self._count -= 1
+
+        if self._tombstones > len(self._slots) // 4:
+            self._rehash()
+
+    # Evicts an expired entry if the sample finds one, otherwise the least
+    # recently used entry of the sample
+    def _evict_one(self):
+        now = time.time()
+        victim = -1
+        oldest = -1
+        expired = False
+
+        for _ in range(EVICTION_SAMPLES):
+            entry = random.randrange(self._allocated)
+            if not self._live[entry]:
+                continue
+            expiry = self._expiry[entry]
+            if expiry and expiry <= now:
+                victim, expired = entry, True
+                break
+            age = (self._clock - self._access[entry]) & 0xFFFFFFFF
+            if age > oldest:
+                victim, oldest = entry, age
+
+        if victim < 0:
+            # Unlucky sample of free entries, fall back to the first live one
+            victim = self._live.index(1)
+
+        if expired:
+            self.expirations += 1
+        else:
+            self.evictions += 1
+
+        start = victim * DIGEST_SIZE
+        position, _ = self._find(bytes(self._digests[start : start + DIGEST_SIZE]))
+        self._remove(position, victim)
+
+    # Rebuilds the hash table from the live entries, dropping tombstones
+    def _rehash(self):
+        table_size = len(self._slots)
+        self._slots = array("i", [EMPTY]) * table_size
+        self._tombstones = 0
+        digests = self._digests
+
+        for entry in range(self._allocated):
+            if not self._live[entry]:
+                continue
+            start = entry * DIGEST_SIZE
+            position, _ = self._find(bytes(digests[start : start + DIGEST_SIZE]))
+            self._slots[position] = entry
+
+    # Rewrites the arena without the bytes of replaced or removed values
+    def _compact_arena(self):
+        arena = bytearray()
+        for entry in range(self._allocated):
+            if not self._live[entry]:
+                continue
+            offset = self._offsets[entry]
+            self._offsets[entry] = len(arena)
+            arena += self._arena[offset : offset + self._lengths[entry]]
+        self._arena = arena
+        self._dead_bytes = 0
+
+    # Packs live entries into the lowest entry numbers so a snapshot has no holes
+    def _compact(self):
+        if self._count != self._allocated:
+            target = 0
+            for entry in range(self._allocated):
+                if not self._live[entry]:
+                    continue
+                if entry != target:
+                    self._move_entry(entry, target)
+                target += 1
+            self._allocated = target
+            self._free = array("i")
+            self._rehash()
+        self._compact_arena()
+
+    def _move_entry(self, source, target):
+        source_start = source * DIGEST_SIZE
+        target_start = target * DIGEST_SIZE
+        self._digests[target_start : target_start + DIGEST_SIZE] = self._digests[
+            source_start : source_start + DIGEST_SIZE
+        ]
+        for column in (self._offsets, self._lengths, self._expiry, self._access):
+            column[target] = column[source]
+        self._live[target] = 1
+        self._live[source] = 0
+
+
+def _array_from(typecode, buffer):
+    column = array(typecode)
+    column.frombytes(buffer)
+    return column
+
+
+# Builds a snapshot file from (content key, encrypted content key) pairs
+def write_snapshot(path, entries, max_entries=None):
+    entries = list(entries)
+    index = ContentKeyIndex(max_entries or max(len(entries), 1))
+    for content_key, encrypted_content_key in entries:
+        index.put(content_key, encrypted_content_key)
+    index.save(path)
+    return index
@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------
+# Device Asset Cache
+# Keeps the CDNx objects a user device downloaded on its disk so repeat
+# views do not cost the full transfer again. Objects are stored exactly as
+# the CDN serves them, still encrypted under the asset key, and are keyed
+# by their encrypted content key, so the cache reveals no more at rest than
+# the CDN does. They are only ever decrypted into memory, as a download is.
+#
+# Each object is kept with the validators and freshness the CDN sent with
+# it. A fresh object is used without any request; a stale one is
+# revalidated with If-None-Match (or If-Modified-Since), so an unchanged
+# object costs one small round trip and a 304. Freshness comes from the
+# response's Cache-Control max-age (immutable objects never go stale) or,
+# without one, cdnx_device_cache_ttl seconds.
+#
+# The cache holds at most cdnx_device_cache_bytes and evicts the least
+# recently used objects beyond that. Recency is kept in the objects' mtimes,
+# so the order survives a restart. Each process keeps its own index of the
+# directory; with several device worker processes sharing one directory the
+# budget applies per process.
+#
+# Layout: <directory>/<sha256 of name>.obj and a .json file of its metadata.
+# ----------------------------------------------------------------------
+
+MAX_BYTES = int(os.getenv("cdnx_device_cache_bytes", 1024 * 1024 * 1024))
+
+# Seconds an object is used without revalidation when the CDN gives no max-age
+DEFAULT_TTL = float(os.getenv("cdnx_device_cache_ttl", 0))
+
+OBJECT_SUFFIX = ".obj"
+META_SUFFIX = ".json"
+PARTIAL_SUFFIX = ".partial"
+
+# Seconds after which unfinished or inconsistent files found at startup are deleted
+ABANDONED_AGE = 3600
+
+MAX_AGE = re.compile(r"(?:^|,)\s*(?:s-)?max-age\s*=\s*\"?(\d+)")
+
+
+# Time until which a response may be used without revalidation
+def fresh_until(headers, now, default_ttl):
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "immutable" in cache_control:
+        return float("inf")
+    if "no-cache" in cache_control:
+        return now
+    match = MAX_AGE.search(cache_control)
+    if match:
+        return now + int(match.group(1))
+    return now + default_ttl
+
+
+class CacheEntry:
+    """A cached object's size, validators and freshness."""
+
+    def __init__(self, name, size, etag, last_modified, fresh_until):
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+
+    # Conditional request headers revalidating this object
+    def validators(self):
+        if self.etag:
+            return {"If-None-Match": self.etag}
+        if self.last_modified:
+            return {"If-Modified-Since": self.last_modified}
+        return {}
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "size": self.size,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            # JSON has no infinity
+            "fresh_until": (
+                self.fresh_until if self.fresh_until != float("inf") else None
+            ),
+        }
+
+
+class CacheWriter:
+    """An object being downloaded into the cache, committed once complete."""
+
+    def __init__(self, cache, name, path):
+        self.cache = cache
+        self.name = name
+        self.path = path
+        self.written = 0
+        self._file = open(path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+        self.written += len(data)
+
+    # Throws away what was written, for a download that has to start over
+    def restart(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self.written = 0
+
+    # Stores the object under the validators of the response it came with, and returns
+    # it opened for reading. The handle stays valid if the object is evicted meanwhile.
+    def commit(self, headers):
+        self._file.close()
+        stored = open(self.path, "rb")
+        self.cache._commit(self.name, self.path, self.written, headers)
+        return stored
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DeviceCache:
+    """Byte-budgeted LRU of encrypted CDN objects on disk, revalidated with ETags."""
+
+    def __init__(
+        self, directory, max_bytes=MAX_BYTES, default_ttl=DEFAULT_TTL, clock=time.time
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # name -> CacheEntry, least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        self.fresh_hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.updated = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name, suffix):
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    # Rebuilds the index from the directory, most recently used last, dropping
+    # abandoned downloads and objects whose metadata does not match
+    def _load(self):
+        found = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if file_name.endswith(PARTIAL_SUFFIX):
+                if self._abandoned(path):
+                    self._delete(path)
+                continue
+            if not file_name.endswith(META_SUFFIX):
+                continue
+            object_path = path[: -len(META_SUFFIX)] + OBJECT_SUFFIX
+            try:
+                with open(path) as meta_file:
+                    meta = json.load(meta_file)
+                stat = os.stat(object_path)
+            except (OSError, ValueError):
+                if self._abandoned(path):
+                    self._delete(path, object_path)
+                continue
+            if stat.st_size != meta["size"]:
+                if self._abandoned(path):
+                    self._delete(path, object_path)
+                continue
+            if meta["fresh_until"] is None:
+                meta["fresh_until"] = float("inf")
+            found.append((stat.st_mtime, CacheEntry(**meta)))
+
+        for _, entry in sorted(found, key=lambda item: item[0]):
+            self._entries[entry.name] = entry
+            self.bytes += entry.size
+        with self._lock:
+            self._evict()
+
+    # Whether a file left inconsistent is old enough that no other process sharing the
+    # directory can still be writing it
+    def _abandoned(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) > ABANDONED_AGE
+        except FileNotFoundError:
+            return False
+
+    def _delete(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def is_fresh(self, entry):
+        return self._clock() < entry.fresh_until
+
+    # The entry of a cached object and the object opened for reading, or (None, None)
+    def open(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            path = self._path(name, OBJECT_SUFFIX)
+            try:
+                stored = open(path, "rb")
+                os.utime(path)
+            except FileNotFoundError:
+                # Removed by another process sharing the directory
+                self._forget(name)
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(name)
+            return entry, stored
+
+    def writer(self, name):
+        return CacheWriter(self, name, self._partial_path(name, OBJECT_SUFFIX))
+
+    # Concurrent writers of the same file, in this process or another, each get their own
+    def _partial_path(self, name, suffix):
+        return "%s-%d-%d%s" % (
+            self._path(name, suffix),
+            os.getpid(),
+            threading.get_ident(),
+            PARTIAL_SUFFIX,
+        )
+
+    def _commit(self, name, partial_path, size, headers):
+        now = self._clock()
+        entry = CacheEntry(
+            name,
+            size,
+            headers.get("ETag"),
+            headers.get("Last-Modified"),
+            fresh_until(headers, now, self.default_ttl),
+        )
+        if size > self.max_bytes:
+            self._delete(partial_path)
+            return
+
+        # The object goes in first: a crash before its metadata is written leaves the
+        # new bytes with the old validators, which the CDN answers with the object
+        # again rather than confirming bytes it never sent
+        os.replace(partial_path, self._path(name, OBJECT_SUFFIX))
+        self._write_meta(entry)
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.bytes -= previous.size
+                self.updated += 1
+            self._entries[name] = entry
+            self.bytes += size
+            self._evict()
+
+    # Marks a cached object fresh again after the CDN answered 304 Not Modified
+    def revalidate(self, name, headers):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            entry.fresh_until = fresh_until(headers, self._clock(), self.default_ttl)
+            entry.etag = headers.get("ETag") or entry.etag
+            entry.last_modified = headers.get("Last-Modified") or entry.last_modified
+            self.revalidated += 1
+        self._write_meta(entry)
+
+    def count_fresh_hit(self):
+        with self._lock:
+            self.fresh_hits += 1
+
+    def remove(self, name):
+        with self._lock:
+            self._forget(name)
+
+    def _forget(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.bytes -= entry.size
+            self._delete(self._path(name, META_SUFFIX), self._path(name, OBJECT_SUFFIX))
+
+    def _write_meta(self, entry):
+        partial = self._partial_path(entry.name, META_SUFFIX)
+        with open(partial, "w") as meta_file:
+            json.dump(entry.as_dict(), meta_file)
+        os.replace(partial, self._path(entry.name, META_SUFFIX))
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            name = next(iter(self._entries))
+            self._forget(name)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            requests = self.fresh_hits + self.revalidated + self.misses + self.updated
+            return {
+                "objects": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "fresh_hits": self.fresh_hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "updated": self.updated,
+                "evictions": self.evictions,
+                "hit_ratio": (
+                    (self.fresh_hits + self.revalidated) / requests if requests else 0.0
+                ),
+            }
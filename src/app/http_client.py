@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.util.retry import Retry
+
+import metrics
+
+# ----------------------------------------------------------------------
+# Shared HTTP Client
+# Every outbound request made by the services goes through a shared pooled
+# session so connections to each host are kept alive and reused across
+# requests instead of paying a fresh TCP+TLS handshake on every call. On
+# the cross-region hops that handshake is a large share of the measured
+# time. The client also counts how many connections each request had to
+# open so benchmark results can be split into cold and warm numbers, and
+# records every request's latency and outcome in the service's metrics.
+# ----------------------------------------------------------------------
+
+# Pool sizing, timeouts and retry policy, overridable per deployment
+POOL_HOSTS = int(os.getenv("cdnx_http_pool_hosts", 10))
+POOL_SIZE = int(os.getenv("cdnx_http_pool_size", 32))
+CONNECT_TIMEOUT = float(os.getenv("cdnx_http_connect_timeout", 5))
+READ_TIMEOUT = float(os.getenv("cdnx_http_read_timeout", 60))
+RETRIES = int(os.getenv("cdnx_http_retries", 2))
+BACKOFF_FACTOR = float(os.getenv("cdnx_http_backoff", 0.1))
+
+CONNECTIONS_OPENED_HEADER = "X-Cdnx-Connections-Opened"
+CONNECTIONS_REUSED_HEADER = "X-Cdnx-Connections-Reused"
+
+_request_stats = threading.local()
+_host_stats = {}
+_host_stats_lock = threading.Lock()
+
+
+def _record(host, opened):
+    with _host_stats_lock:
+        stats = _host_stats.setdefault(host, {"requests": 0, "connections_opened": 0})
+        if opened:
+            stats["connections_opened"] += 1
+        else:
+            stats["requests"] += 1
+
+    if opened:
+        _request_stats.opened = getattr(_request_stats, "opened", 0) + 1
+    else:
+        _request_stats.requests = getattr(_request_stats, "requests", 0) + 1
+
+
+# Connections that count every socket they open, including reconnects of pooled
+# connections the server closed while idle
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _record(self.host, True)
+        return super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _record(self.host, True)
+        return super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def _build_session(status_forcelist):
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=status_forcelist,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = _PooledAdapter(
+        pool_connections=POOL_HOSTS,
+        pool_maxsize=POOL_SIZE,
+        max_retries=retry,
+        pool_block=False,
+    )
+
+    new_session = requests.Session()
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+    return new_session
+
+
+# Both sessions retry GETs whose connection failed. Only requests sent with
+# retry_unavailable=True, for hops that are cheap to repeat such as content key
+# lookups, are also retried on a 502, 503 or 504: repeating a relay or a CDNx key
+# resolution would replay a whole cross-region fetch and hide it from the timings.
+session = _build_session(())
+unavailable_retry_session = _build_session((502, 503, 504))
+
+
+# Sends a request through a shared pooled session with the default timeouts
+def request(method, url, retry_unavailable=False, **kwargs):
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    parts = requests.utils.urlparse(url)
+    _record(parts.hostname, False)
+    started = time.perf_counter_ns()
+    try:
+        pooled = unavailable_retry_session if retry_unavailable else session
+        response = pooled.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        metrics.observe_upstream(parts.netloc, type(e).__name__, started)
+        raise
+    metrics.observe_upstream(parts.netloc, response.status_code, started)
+    return response
+
+
+# Counts a request sent over another transport to host, such as the VPN tunnel, and
+# the connection it opened if it had to
+def record_request(host, opened=False):
+    _record(host, False)
+    if opened:
+        _record(host, True)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+# Clears the per-request counters, called at the start of each inbound request
+def reset_request_stats():
+    _request_stats.requests = 0
+    _request_stats.opened = 0
+
+
+# Outbound requests made and connections opened while handling the current request
+def request_stats():
+    made = getattr(_request_stats, "requests", 0)
+    opened = getattr(_request_stats, "opened", 0)
+    return {
+        "requests": made,
+        "connections_opened": opened,
+        "connections_reused": max(made - opened, 0),
+    }
+
+
+# Adds connection stats gathered on a worker thread to the current request's stats
+def merge_request_stats(stats):
+    _request_stats.requests = getattr(_request_stats, "requests", 0) + stats["requests"]
+    _request_stats.opened = (
+        getattr(_request_stats, "opened", 0) + stats["connections_opened"]
+    )
+
+
+# Per-host totals since the process started
+def host_stats():
+    with _host_stats_lock:
+        return {host: dict(stats) for host, stats in _host_stats.items()}
+
+
+def collect_metrics():
+    return [
+        metrics.family(
+            "cdnx_upstream_connections_opened_total",
+            "counter",
+            "Connections opened to each upstream host, reconnects included.",
+            {host: stats["connections_opened"] for host, stats in host_stats().items()},
+            "host",
+        )
+    ]
+
+
+metrics.register_collector("http_client", collect_metrics)
+
+
+# Registers hooks on a Flask app that report each request's connection reuse
+# in response headers, so benchmarks can tell cold requests from warm ones
+def init_app(app):
+    @app.before_request
+    def _reset_connection_stats():
+        reset_request_stats()
+
+    @app.after_request
+    def _add_connection_stats(response):
+        stats = request_stats()
+        response.headers[CONNECTIONS_OPENED_HEADER] = str(stats["connections_opened"])
+        response.headers[CONNECTIONS_REUSED_HEADER] = str(stats["connections_reused"])
+        return response
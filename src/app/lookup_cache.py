@@ -0,0 +1,306 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------
+# Lookup Cache
+# An in-process cache the VPN service keeps in front of the content key
+# cache so popular content keys do not cost a round trip on every CDNx
+# request. Hits and misses are both cached, each with its own TTL, and
+# concurrent lookups of the same uncached key are coalesced so only one of
+# them goes upstream while the rest wait for its answer. AsyncLookupCache is
+# the same cache for the asyncio serving mode, where loaders are coroutines.
+# ----------------------------------------------------------------------
+
+
+class _Flight:
+    """An upstream lookup in progress that other callers can wait on."""
+
+    def __init__(self, done=None):
+        self.done = done or threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+        # Set when the loading caller was cancelled before the load completed
+        self.abandoned = False
+
+
+class LookupCache:
+    """Bounded LRU cache of positive and negative lookups with single-flight loads."""
+
+    def __init__(
+        self, loader, positive_ttl, negative_ttl, max_entries, bulk_loader=None
+    ):
+        # loader(key) returns the value for a key, or None if the key does not exist.
+        # bulk_loader(keys), if given, returns a dict of key -> value (or None) in one call
+        self._loader = loader
+        self._bulk_loader = bulk_loader
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.loads = 0
+        self.bulk_loads = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns the cached or freshly loaded value for a key, None if it does not exist
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    if value is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return value
+                del self._entries[key]
+
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self._inflight[key] = _Flight()
+                self.loads += 1
+                leader = True
+
+        if leader:
+            self._load(key, flight)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, flight):
+        try:
+            flight.value = self._loader(key)
+        except Exception as e:
+            flight.error = e
+
+        self._finish(key, flight)
+
+    # Returns a dict of key -> value (None for keys that do not exist). Cached keys are
+    # answered locally, keys already being loaded are waited on, and all remaining keys
+    # are resolved together in a single bulk_loader call.
+    def get_many(self, keys):
+        results = {}
+        loading = []
+        waiting = []
+        now = time.monotonic()
+
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    if entry[0] is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    results[key] = entry[0]
+                    continue
+
+                flight = self._inflight.get(key)
+                if flight is not None:
+                    self.coalesced += 1
+                    waiting.append((key, flight))
+                else:
+                    flight = self._inflight[key] = _Flight()
+                    self.loads += 1
+                    loading.append((key, flight))
+
+            if loading:
+                self.bulk_loads += 1
+
+        if loading:
+            try:
+                values = self._bulk_loader([key for key, _ in loading])
+            except Exception as e:
+                values = {}
+                for _, flight in loading:
+                    flight.error = e
+
+            for key, flight in loading:
+                flight.value = values.get(key)
+                self._finish(key, flight)
+
+        for key, flight in loading + waiting:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            results[key] = flight.value
+
+        return results
+
+    def _finish(self, key, flight):
+        with self._lock:
+            del self._inflight[key]
+            # Errors are never cached, and neither is an answer invalidated mid-flight
+            # or one that never arrived
+            if flight.error is None and not flight.stale and not flight.abandoned:
+                ttl = self.negative_ttl if flight.value is None else self.positive_ttl
+                if ttl > 0:
+                    self._entries[key] = (flight.value, time.monotonic() + ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+
+        flight.done.set()
+
+    # True when a key would be answered from the cache without a load
+    def cached(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    # Drops the given keys, or everything when no keys are given
+    def invalidate(self, keys=None):
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                for flight in self._inflight.values():
+                    flight.stale = True
+                return
+
+            for key in keys:
+                self._entries.pop(key, None)
+                flight = self._inflight.get(key)
+                if flight is not None:
+                    flight.stale = True
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.negative_hits + self.loads + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "upstream_loads": self.loads,
+                "bulk_loads": self.bulk_loads,
+                "coalesced": self.coalesced,
+                "hit_ratio": (
+                    (self.hits + self.negative_hits + self.coalesced) / requests
+                    if requests
+                    else 0.0
+                ),
+            }
+
+
+class AsyncLookupCache(LookupCache):
+    """LookupCache for asyncio, with coroutine loaders and non-blocking waits."""
+
+    # Returns the cached or freshly loaded value for a key, None if it does not exist
+    async def get(self, key):
+        cached, flight, leader = self._claim(key)
+        if flight is None:
+            return cached
+
+        if leader:
+            try:
+                flight.value = await self._loader(key)
+            except Exception as e:
+                flight.error = e
+            except BaseException:
+                # Cancelled mid-load: the waiters load the key again themselves rather
+                # than inherit a cancellation that is not theirs
+                flight.abandoned = True
+                raise
+            finally:
+                self._finish(key, flight)
+        else:
+            await flight.done.wait()
+            if flight.abandoned:
+                return await self.get(key)
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    # Same contract as LookupCache.get_many, with all misses resolved in one
+    # awaited bulk_loader call
+    async def get_many(self, keys):
+        results = {}
+        loading = []
+        waiting = []
+
+        for key in dict.fromkeys(keys):
+            cached, flight, leader = self._claim(key)
+            if flight is None:
+                results[key] = cached
+            elif leader:
+                loading.append((key, flight))
+            else:
+                waiting.append((key, flight))
+
+        if loading:
+            self.bulk_loads += 1
+            try:
+                values = await self._bulk_loader([key for key, _ in loading])
+            except Exception as e:
+                values = {}
+                for _, flight in loading:
+                    flight.error = e
+            except BaseException:
+                # Cancelled mid-load, see get
+                values = {}
+                for _, flight in loading:
+                    flight.abandoned = True
+                raise
+            finally:
+                for key, flight in loading:
+                    flight.value = values.get(key)
+                    self._finish(key, flight)
+
+        for key, flight in loading + waiting:
+            await flight.done.wait()
+            if flight.abandoned:
+                results[key] = await self.get(key)
+                continue
+            if flight.error is not None:
+                raise flight.error
+            results[key] = flight.value
+
+        return results
+
+    # Returns (cached value, None, False) on a hit, otherwise (None, flight, leader)
+    # where leader says whether the caller has to load the key itself. Everything
+    # runs on the event loop thread, so no lock is needed.
+    def _claim(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if value is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return value, None, False
+            del self._entries[key]
+
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return None, flight, False
+
+        # Imported here so the threaded services, which never build this cache, do not
+        # pay for loading asyncio at start-up
+        import asyncio
+
+        flight = self._inflight[key] = _Flight(asyncio.Event())
+        self.loads += 1
+        return None, flight, True
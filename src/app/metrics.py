@@ -0,0 +1,621 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+# ----------------------------------------------------------------------
+# Service Metrics
+# Counters, gauges and fixed-bucket histograms every service exposes on
+# /metrics in the Prometheus text format: request latency per endpoint,
+# the timing phases of each request (encryption, decryption, lookups,
+# fetches, see timing.py), upstream request latency and outcomes, relayed
+# bytes and CDNx hits and misses. Recording takes no lock: each thread
+# adds into its own shard of plain dicts that only it writes, and a
+# scrape sums the shards, so requests never wait on each other and
+# recording stays in the low microseconds per request.
+# Stats the services already keep (lookup cache, filters, device cache,
+# content key index) are read by collectors when /metrics is scraped and
+# cost nothing per request.
+#
+# Under serve.py with several worker processes each worker keeps its own
+# series and writes a snapshot of them to cdnx_metrics_directory every
+# cdnx_metrics_flush_interval seconds and when it exits. /metrics sums
+# the snapshots of all workers, past ones included so counters never go
+# backwards when a worker is recycled, and gauges of live workers only,
+# so whichever worker answers the scrape reports the whole service. The
+# snapshots of exited workers are folded into one retired snapshot as the
+# scrape reads them, so recycling does not grow the directory.
+# ----------------------------------------------------------------------
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Shared by the worker processes of one service, see serve.py. Unset, /metrics
+# reports the process that answers it.
+METRICS_DIRECTORY = os.getenv("cdnx_metrics_directory")
+FLUSH_INTERVAL = float(os.getenv("cdnx_metrics_flush_interval", 1))
+
+# Histogram bucket upper bounds in seconds, for requests and upstream fetches and for
+# the much shorter timing phases
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+PHASE_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    10.0,
+)
+
+# Endpoint label of requests that matched no route, so stray paths cannot add series
+UNMATCHED_ENDPOINT = "unmatched"
+
+
+class _Shard:
+    """The values recorded by one thread, which alone writes to it."""
+
+    __slots__ = ("values", "histograms")
+
+    def __init__(self):
+        # Series key -> counter or gauge value
+        self.values = {}
+        # Series key -> bucket counts, the last of observations above every bound,
+        # followed by the sum of the observations
+        self.histograms = {}
+
+    def add(self, other):
+        for key, value in dict(other.values).items():
+            self.values[key] = self.values.get(key, 0) + value
+        for key, counts in list(other.histograms.items()):
+            counts = list(counts)
+            totals = self.histograms.get(key)
+            if totals is None:
+                self.histograms[key] = counts
+            else:
+                self.histograms[key] = [a + b for a, b in zip(totals, counts)]
+
+
+_local = threading.local()
+# (thread, shard) of every thread that recorded a value, and the values of finished
+# threads once they have been folded together
+_shards = []
+_retired = _Shard()
+_shards_lock = threading.Lock()
+
+# Once this many threads have recorded, finished ones are folded into _retired, as
+# the Flask development server runs every request on a new thread
+RETIRE_AFTER_THREADS = 64
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        pass
+    shard = _local.shard = _Shard()
+    with _shards_lock:
+        if len(_shards) >= RETIRE_AFTER_THREADS:
+            _retire_finished()
+        _shards.append((threading.current_thread(), shard))
+    return shard
+
+
+def _retire_finished():
+    for thread, shard in list(_shards):
+        if not thread.is_alive():
+            _retired.add(shard)
+            _shards.remove((thread, shard))
+
+
+# The values of every thread added up into one shard
+def _totals():
+    totals = _Shard()
+    with _shards_lock:
+        totals.add(_retired)
+        for _, shard in _shards:
+            totals.add(shard)
+    return totals
+
+
+# A forked worker process starts with none of the values recorded before the fork
+def _reset_after_fork():
+    global _local, _shards, _retired, _shards_lock
+    _local = threading.local()
+    _shards = []
+    _retired = _Shard()
+    _shards_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _add(values, key, amount):
+    values[key] = values.get(key, 0) + amount
+
+
+def _observe(histograms, key, bounds, value):
+    counts = histograms.get(key)
+    if counts is None:
+        counts = histograms[key] = [0] * (len(bounds) + 2)
+    counts[bisect.bisect_left(bounds, value)] += 1
+    counts[-1] += value
+
+
+class CounterSeries:
+    """One labelled series of a counter."""
+
+    __slots__ = ("_key",)
+
+    def __init__(self, metric, label_values):
+        self._key = (metric, label_values)
+
+    def inc(self, amount=1):
+        _add(_shard().values, self._key, amount)
+
+
+class GaugeSeries(CounterSeries):
+    """One labelled series of a gauge."""
+
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        _add(_shard().values, self._key, -amount)
+
+
+class HistogramSeries:
+    """One labelled series of a histogram, counting observations per bucket."""
+
+    __slots__ = ("_key", "_bounds")
+
+    def __init__(self, metric, label_values):
+        self._key = (metric, label_values)
+        self._bounds = metric.bounds
+
+    def observe(self, value):
+        _observe(_shard().histograms, self._key, self._bounds, value)
+
+
+class Metric:
+    """A named metric and its series, one per combination of label values."""
+
+    def __init__(self, name, kind, documentation, label_names, new_series, bounds=()):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.bounds = bounds
+        self._new_series = new_series
+        self._series = {}
+
+    # The series of the given label values, in the order of label_names. Series only
+    # name where values go, so two threads creating the same one at once is harmless.
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = self._new_series(self, values)
+        return series
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    # The family of this metric, from series_values of label values -> the totals
+    # recorded for them
+    def collect(self, series_values):
+        samples = []
+        for values, value in series_values.items():
+            labels = tuple(zip(self.label_names, values))
+            if self.kind != "histogram":
+                samples.append((self.name, labels, value))
+                continue
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), value):
+                cumulative += count
+                samples.append(
+                    (
+                        self.name + "_bucket",
+                        labels + (("le", format_value(bound)),),
+                        cumulative,
+                    )
+                )
+            samples.append((self.name + "_sum", labels, value[-1]))
+            samples.append((self.name + "_count", labels, cumulative))
+        return (self.name, self.kind, self.documentation, samples)
+
+
+_metrics = []
+# Collector name -> function returning metric families, see family
+_collectors = {}
+
+
+def counter(name, documentation, label_names=()):
+    return _register(Metric(name, "counter", documentation, label_names, CounterSeries))
+
+
+def gauge(name, documentation, label_names=()):
+    return _register(Metric(name, "gauge", documentation, label_names, GaugeSeries))
+
+
+def histogram(name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+    return _register(
+        Metric(
+            name,
+            "histogram",
+            documentation,
+            label_names,
+            HistogramSeries,
+            tuple(sorted(buckets)),
+        )
+    )
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+# Registers a function called on every scrape for metric families built with family.
+# Registering another function under the same name replaces the first.
+def register_collector(name, function):
+    _collectors[name] = function
+
+
+# A collected metric family. values is a number, or a dict of label value -> number
+# for a family with the single label label_name.
+def family(name, kind, documentation, values, label_name=None):
+    if label_name is None:
+        samples = [(name, (), values)]
+    else:
+        samples = [
+            (name, ((label_name, str(label)),), value)
+            for label, value in values.items()
+        ]
+    return (name, kind, documentation, samples)
+
+
+REQUESTS = counter(
+    "cdnx_requests_total",
+    "Requests handled, by endpoint, method and status code.",
+    ("endpoint", "method", "status"),
+)
+REQUEST_DURATION = histogram(
+    "cdnx_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response.",
+    ("endpoint",),
+)
+REQUESTS_IN_FLIGHT = gauge(
+    "cdnx_requests_in_flight", "Requests being handled.", ("endpoint",)
+)
+PHASE_DURATION = histogram(
+    "cdnx_phase_duration_seconds",
+    "Time requests spent in each timing phase, such as encryption or lookups.",
+    ("endpoint", "phase"),
+    PHASE_BUCKETS,
+)
+UPSTREAM_REQUESTS = counter(
+    "cdnx_upstream_requests_total",
+    "Outbound requests, by host and status code or the error that failed them.",
+    ("host", "outcome"),
+)
+UPSTREAM_DURATION = histogram(
+    "cdnx_upstream_duration_seconds",
+    "Time outbound requests took to receive their response headers.",
+    ("host",),
+)
+RELAY_BYTES = counter(
+    "cdnx_relay_bytes_total",
+    "Bytes of relayed assets, as plaintext and as sealed frames on the wire.",
+    ("kind",),
+)
+LOOKUPS = counter(
+    "cdnx_lookups_total", "CDNx content key lookups, by result.", ("result",)
+)
+
+
+# Starts measuring a request, returning the value to pass to finish_request
+def start_request(endpoint):
+    start_flushing()
+    _add(_shard().values, (REQUESTS_IN_FLIGHT, (endpoint,)), 1)
+    return time.perf_counter_ns()
+
+
+# Records a finished request and, with its trace, the phases it went through. Runs on
+# every request, so it adds into the thread's shard directly.
+def finish_request(endpoint, method, status, started, trace=None):
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+    shard = _shard()
+    histograms = shard.histograms
+    _observe(histograms, (REQUEST_DURATION, (endpoint,)), LATENCY_BUCKETS, elapsed)
+    _add(shard.values, (REQUESTS, (endpoint, method, str(status))), 1)
+    _add(shard.values, (REQUESTS_IN_FLIGHT, (endpoint,)), -1)
+    if trace is not None:
+        for phase, duration_ns in list(trace.phases.items()):
+            _observe(
+                histograms,
+                (PHASE_DURATION, (endpoint, phase)),
+                PHASE_BUCKETS,
+                duration_ns / 1e9,
+            )
+
+
+# Records an outbound request to host, with its port unless it is the scheme's default,
+# that got a response with status code outcome or failed with the error named by
+# outcome, started at perf_counter_ns started
+def observe_upstream(host, outcome, started):
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+    shard = _shard()
+    _observe(shard.histograms, (UPSTREAM_DURATION, (host,)), LATENCY_BUCKETS, elapsed)
+    _add(shard.values, (UPSTREAM_REQUESTS, (host, str(outcome))), 1)
+
+
+# Every metric family of this process, as (name, kind, documentation, samples) with
+# samples of (sample name, label pairs, value)
+def collect():
+    totals = _totals()
+    series_values = {metric: {} for metric in _metrics}
+    for recorded in (totals.values, totals.histograms):
+        for (metric, values), value in recorded.items():
+            series_values[metric][values] = value
+    families = [metric.collect(series_values[metric]) for metric in _metrics]
+    for function in list(_collectors.values()):
+        try:
+            families.extend(function())
+        except Exception as e:
+            print(e)
+    return families
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# The metric families in the Prometheus text exposition format
+def render(families):
+    lines = []
+    for name, kind, documentation, samples in families:
+        lines.append("# HELP %s %s" % (name, documentation))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for sample_name, labels, value in samples:
+            if labels:
+                sample_name += "{%s}" % ",".join(
+                    '%s="%s"' % (label, _escape(label_value))
+                    for label, label_value in labels
+                )
+            lines.append("%s %s" % (sample_name, format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+# Snapshot file of this worker process. Named by start time as well as pid, so a
+# recycled worker's pid reused later never overwrites its counts.
+_snapshot_name = None
+_flushing_started = threading.Event()
+
+
+def write_snapshot():
+    global _snapshot_name
+    if not METRICS_DIRECTORY:
+        return
+    if _snapshot_name is None:
+        _snapshot_name = "%d-%d.json" % (os.getpid(), time.time_ns())
+    path = os.path.join(METRICS_DIRECTORY, _snapshot_name)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as out:
+        json.dump(collect(), out, separators=(",", ":"))
+    os.replace(temporary_path, path)
+
+
+def flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(e)
+
+
+# The flush thread starts with the first request, in the worker process rather than
+# in the serve.py master the app is loaded in before forking
+def start_flushing():
+    if METRICS_DIRECTORY and not _flushing_started.is_set():
+        _flushing_started.set()
+        threading.Thread(target=flush_periodically, daemon=True).start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Counts of the workers that have exited, folded together so the directory does not
+# keep a snapshot for every worker ever recycled
+RETIRED_SNAPSHOT = "retired.json"
+
+
+# Sums the snapshots of every worker, current and past, into one set of families.
+# Gauges describe the present, so only live workers' gauges are added up. Runs under
+# a lock on the directory, as it moves exited workers' snapshots into the retired one.
+def merge_snapshots(directory):
+    # Imported here, metrics directories are only used under serve.py on POSIX
+    import fcntl
+
+    with open(os.path.join(directory, "retired.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _retire_snapshots(directory)
+
+        families = {}
+        for snapshot_name in sorted(os.listdir(directory)):
+            if not snapshot_name.endswith(".json"):
+                continue
+            snapshot_families = _read_snapshot(os.path.join(directory, snapshot_name))
+            if snapshot_name == RETIRED_SNAPSHOT:
+                _add_families(families, snapshot_families["families"], False)
+            elif snapshot_families is not None:
+                alive = _alive(int(snapshot_name.split("-")[0]))
+                _add_families(families, snapshot_families, alive)
+
+    return _family_list(families)
+
+
+# Adds the snapshots of exited workers to the retired snapshot and removes them. The
+# retired snapshot names the ones it took in last, so one left behind by a crash
+# before its removal is removed the next time instead of being counted again.
+def _retire_snapshots(directory):
+    retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+    retired = _read_snapshot(retired_path) or {"families": [], "folded": []}
+    for snapshot_name in retired["folded"]:
+        if os.path.exists(os.path.join(directory, snapshot_name)):
+            os.remove(os.path.join(directory, snapshot_name))
+
+    families = {}
+    _add_families(families, retired["families"], False)
+    folded = []
+    for snapshot_name in sorted(os.listdir(directory)):
+        if not snapshot_name.endswith(".json") or snapshot_name == RETIRED_SNAPSHOT:
+            continue
+        if _alive(int(snapshot_name.split("-")[0])):
+            continue
+        snapshot_families = _read_snapshot(os.path.join(directory, snapshot_name))
+        if snapshot_families is not None:
+            _add_families(families, snapshot_families, False)
+            folded.append(snapshot_name)
+    if not folded:
+        return
+
+    temporary_path = retired_path + ".tmp"
+    with open(temporary_path, "w") as out:
+        json.dump(
+            {"families": _family_list(families), "folded": folded},
+            out,
+            separators=(",", ":"),
+        )
+    os.replace(temporary_path, retired_path)
+    for snapshot_name in folded:
+        os.remove(os.path.join(directory, snapshot_name))
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as snapshot:
+            return json.load(snapshot)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(e)
+        return None
+
+
+# Adds snapshot families to name -> (kind, documentation, totals), gauges only if the
+# worker they came from is alive
+def _add_families(families, snapshot_families, alive):
+    for name, kind, documentation, samples in snapshot_families:
+        totals = families.setdefault(name, (kind, documentation, {}))[2]
+        if kind == "gauge" and not alive:
+            continue
+        for sample_name, labels, value in samples:
+            key = (sample_name, tuple(tuple(label) for label in labels))
+            totals[key] = totals.get(key, 0) + value
+
+
+def _family_list(families):
+    return [
+        (
+            name,
+            kind,
+            documentation,
+            [
+                (sample_name, labels, value)
+                for (sample_name, labels), value in totals.items()
+            ],
+        )
+        for name, (kind, documentation, totals) in families.items()
+    ]
+
+
+# The body of /metrics: this process's metrics, or all workers' under serve.py
+def exposition():
+    if not METRICS_DIRECTORY:
+        return render(collect())
+    write_snapshot()
+    return render(merge_snapshots(METRICS_DIRECTORY))
+
+
+def endpoint_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else UNMATCHED_ENDPOINT
+
+
+# Registers hooks on a Flask app that measure every request, until the last byte of
+# streamed responses, and the /metrics endpoint. Phases are read from the request's
+# trace, so timing.init_app should be called first.
+def init_app(app):
+    @app.before_request
+    def _start_request_metrics():
+        endpoint = endpoint_label()
+        g.cdnx_metrics = (endpoint, start_request(endpoint))
+
+    @app.after_request
+    def _observe_request(response):
+        measured = g.pop("cdnx_metrics", None)
+        if measured is None:
+            return response
+        endpoint, started = measured
+        method = request.method
+        trace = g.get("cdnx_trace")
+        response.call_on_close(
+            lambda: finish_request(
+                endpoint, method, response.status_code, started, trace
+            )
+        )
+        return response
+
+    @app.route("/metrics")
+    def metrics_exposition():
+        return Response(exposition(), content_type=METRICS_MIMETYPE)
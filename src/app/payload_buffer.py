@@ -0,0 +1,148 @@
+import os
+import tempfile
+
+from flask import Response, send_file
+
+# ----------------------------------------------------------------------
+# Spooled Payloads
+# Holds an asset (or its sealed relay frames) on its way through a service
+# without keeping several full copies of it in memory. A payload lives in a
+# bytearray until it grows past SPOOL_MAX_MEMORY and is then moved to an
+# unlinked temporary file, so a multi-gigabyte asset costs disk space and
+# page cache instead of resident memory. Writers fill it either in order or
+# at explicit offsets (for parallel ranged downloads), readers take it back
+# in bounded chunks, and a Flask response serves it straight from the file
+# (sendfile where the server supports it) or in chunks from memory.
+# ----------------------------------------------------------------------
+
+# Payloads larger than this are spooled to a temporary file
+SPOOL_MAX_MEMORY = int(os.getenv("cdnx_spool_max_memory", 32 * 1024 * 1024))
+
+# Directory for spooled payloads, the system temp directory by default
+SPOOL_DIRECTORY = os.getenv("cdnx_spool_directory") or None
+
+# Largest buffer used to copy between a socket and a spooled file
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledPayload:
+    """A payload kept in memory while small and in a temporary file past max_memory."""
+
+    def __init__(self, size=None, max_memory=None):
+        self.max_memory = SPOOL_MAX_MEMORY if max_memory is None else max_memory
+        self.size = 0
+        self._memory = bytearray()
+        self._file = None
+
+        # Payloads of a known size are preallocated so they can be filled at offsets
+        if size is not None:
+            if size > self.max_memory:
+                self._spill()
+                self._file.truncate(size)
+            else:
+                self._memory = bytearray(size)
+            self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    # Bytes of the payload held in memory, none once it is spooled to its file
+    @property
+    def resident_bytes(self):
+        return 0 if self._file is not None else self.size
+
+    def _spill(self):
+        self._file = tempfile.TemporaryFile(dir=SPOOL_DIRECTORY)
+        if self._memory:
+            self._file.write(self._memory)
+        self._memory = bytearray()
+
+    # Appends data, moving the payload to disk once it outgrows max_memory
+    def write(self, data):
+        if self._file is None and self.size + len(data) > self.max_memory:
+            self._spill()
+
+        if self._file is None:
+            self._memory += data
+        else:
+            os.pwrite(self._file.fileno(), data, self.size)
+        self.size += len(data)
+
+    # Fills length bytes at offset from readinto (a file-like readinto method) and
+    # returns the number of bytes filled. In memory the reads land directly in the
+    # payload; on disk they pass through one bounded buffer.
+    def fill(self, offset, length, readinto):
+        if self._file is None:
+            with memoryview(self._memory) as view:
+                return _fill_view(view[offset : offset + length], readinto)
+
+        buffer = memoryview(bytearray(min(length, COPY_CHUNK_SIZE)))
+        filled = 0
+        while filled < length:
+            read = readinto(buffer[: min(len(buffer), length - filled)])
+            if not read:
+                break
+            os.pwrite(self._file.fileno(), buffer[:read], offset + filled)
+            filled += read
+        return filled
+
+    # Returns length bytes starting at offset
+    def read_at(self, offset, length):
+        if self._file is None:
+            return bytes(self._memory[offset : offset + length])
+        return os.pread(self._file.fileno(), length, offset)
+
+    # Yields the payload in chunks of at most chunk_size bytes
+    def chunks(self, chunk_size):
+        for offset in range(0, self.size, chunk_size):
+            yield self.read_at(offset, min(chunk_size, self.size - offset))
+
+    # A Flask response that sends the payload and releases it once sent
+    def response(self, mimetype):
+        if self._file is not None:
+            self._file.seek(0)
+            spooled_file, self._file = self._file, None
+            response = send_file(
+                spooled_file, mimetype=mimetype, conditional=False, etag=False
+            )
+            response.content_length = self.size
+            return response
+
+        payload = self._memory
+        self._memory = bytearray()
+        response = Response(_memory_chunks(payload), mimetype=mimetype)
+        response.content_length = len(payload)
+        return response
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = bytearray()
+
+
+def _fill_view(view, readinto):
+    filled = 0
+    while filled < len(view):
+        read = readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+# WSGI servers only accept bytes, so the payload is copied out one bounded chunk at a time
+def _memory_chunks(payload):
+    with memoryview(payload) as view:
+        for offset in range(0, len(view), COPY_CHUNK_SIZE):
+            yield bytes(view[offset : offset + COPY_CHUNK_SIZE])
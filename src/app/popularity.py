@@ -0,0 +1,210 @@
+import heapq
+import math
+import os
+import threading
+import time
+from array import array
+
+from bloom_filter import positions
+from content_key_index import digest
+
+# ----------------------------------------------------------------------
+# Content Popularity Tracking
+# Tells the publishing side which objects users want. The VPN service sees
+# every CDNx request, hit or miss, and feeds the content key into a
+# count-min sketch: a fixed grid of depth rows by width counters, where a
+# key adds to one counter per row and its count is estimated by the
+# smallest of them. Memory never grows with the number of distinct keys,
+# and counts can only be overestimated, by collisions with other keys.
+# Updates are conservative (only the counters at the current minimum are
+# raised), which keeps that error small for the heavy hitters.
+#
+# Counts decay with a half-life so the tracker follows what is popular now.
+# Rather than aging every counter, each request adds a weight that grows
+# by 2x per half-life (forward decay), which keeps updates constant time;
+# dividing by the current weight turns a counter back into a decayed count.
+# Once the weights get large everything is rescaled, a rare full pass.
+#
+# The top-K keys by estimated count are kept alongside, with whether their
+# latest request hit, and the popular keys that missed form the admission
+# list the publishing side reads to encrypt and insert hot objects.
+# ----------------------------------------------------------------------
+
+SKETCH_WIDTH = int(os.getenv("cdnx_popularity_width", 4096))
+SKETCH_DEPTH = int(os.getenv("cdnx_popularity_depth", 4))
+
+# Heavy hitters kept, and the seconds after which a request counts half
+TOP_K = int(os.getenv("cdnx_popularity_top_k", 100))
+HALF_LIFE = float(os.getenv("cdnx_popularity_half_life", 600))
+
+# Forward decay weights are rescaled once they reach 2**RESCALE_HALF_LIVES
+RESCALE_HALF_LIVES = 32
+
+
+class CountMinSketch:
+    """Fixed size count-min sketch over content key digests."""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self._counts = array("d", bytes(8 * width * depth))
+
+    def _cells(self, key_digest):
+        width = self.width
+        return [
+            row * width + column
+            for row, column in enumerate(positions(key_digest, width, self.depth))
+        ]
+
+    # Adds weight to a key with a conservative update and returns its new estimate
+    def add(self, key_digest, weight=1.0):
+        counts = self._counts
+        cells = self._cells(key_digest)
+        estimate = min(counts[cell] for cell in cells) + weight
+        for cell in cells:
+            if counts[cell] < estimate:
+                counts[cell] = estimate
+        return estimate
+
+    def estimate(self, key_digest):
+        counts = self._counts
+        return min(counts[cell] for cell in self._cells(key_digest))
+
+    def scale(self, factor):
+        counts = self._counts
+        for cell in range(len(counts)):
+            counts[cell] *= factor
+
+    @property
+    def memory_bytes(self):
+        return self._counts.itemsize * len(self._counts)
+
+
+class PopularityTracker:
+    """Time-decayed request counts, heavy hitters and hit ratio of CDNx requests."""
+
+    def __init__(
+        self,
+        top_k=TOP_K,
+        half_life=HALF_LIFE,
+        width=SKETCH_WIDTH,
+        depth=SKETCH_DEPTH,
+        clock=time.monotonic,
+    ):
+        self.top_k = top_k
+        self.half_life = half_life
+        self._clock = clock
+        self._sketch = CountMinSketch(width, depth)
+        self._landmark = clock()
+        self._lock = threading.Lock()
+
+        # content key -> [weighted estimate, whether its latest request hit]
+        self._top = {}
+        # Min-heap of (weighted estimate, content key), with stale entries skipped
+        self._heap = []
+
+        self.requests = 0
+        self.hits = 0
+        self._weighted_requests = 0.0
+        self._weighted_hits = 0.0
+
+    # Weight of a request made now, rescaling everything when it gets too large
+    def _weight(self):
+        exponent = (self._clock() - self._landmark) / self.half_life
+        if exponent >= RESCALE_HALF_LIVES:
+            factor = 2.0**-exponent
+            self._sketch.scale(factor)
+            for entry in self._top.values():
+                entry[0] *= factor
+            self._heap = [(entry[0], key) for key, entry in self._top.items()]
+            heapq.heapify(self._heap)
+            self._weighted_requests *= factor
+            self._weighted_hits *= factor
+            self._landmark = self._clock()
+            exponent = 0.0
+        return 2.0**exponent
+
+    # Records one CDNx request for a content key and whether it hit
+    def record(self, content_key, hit):
+        key_digest = digest(content_key)
+        with self._lock:
+            weight = self._weight()
+            estimate = self._sketch.add(key_digest, weight)
+
+            self.requests += 1
+            self._weighted_requests += weight
+            if hit:
+                self.hits += 1
+                self._weighted_hits += weight
+
+            entry = self._top.get(content_key)
+            if entry is None:
+                if len(self._top) >= self.top_k:
+                    floor, floor_key = self._floor()
+                    if floor_key is None or estimate <= floor:
+                        return
+                    del self._top[floor_key]
+                entry = self._top[content_key] = [estimate, hit]
+            entry[0] = estimate
+            entry[1] = hit
+            heapq.heappush(self._heap, (estimate, content_key))
+            if len(self._heap) > 8 * max(self.top_k, 1):
+                self._heap = [(entry[0], key) for key, entry in self._top.items()]
+                heapq.heapify(self._heap)
+
+    # The smallest live heap entry, dropping entries that were superseded or evicted
+    def _floor(self):
+        heap = self._heap
+        while heap:
+            estimate, content_key = heap[0]
+            entry = self._top.get(content_key)
+            if entry is not None and entry[0] == estimate:
+                return estimate, content_key
+            heapq.heappop(heap)
+        return 0.0, None
+
+    # The decayed request count of a key, including keys outside the top-K
+    def estimate(self, content_key):
+        with self._lock:
+            return self._sketch.estimate(digest(content_key)) / self._weight()
+
+    # The heavy hitters, most requested first, with their decayed request counts
+    def top(self, count=None):
+        with self._lock:
+            weight = self._weight()
+            ranked = sorted(
+                self._top.items(), key=lambda item: item[1][0], reverse=True
+            )
+            return [
+                {"content_key": content_key, "score": estimate / weight, "hit": hit}
+                for content_key, (estimate, hit) in ranked[:count]
+            ]
+
+    # Heavy hitters whose latest request missed: objects worth publishing to the CDN
+    def admission_list(self, count=None):
+        return [entry for entry in self.top() if not entry["hit"]][:count]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hits": self.hits,
+                "hit_ratio": self.hits / self.requests if self.requests else 0.0,
+                "recent_hit_ratio": (
+                    self._weighted_hits / self._weighted_requests
+                    if self._weighted_requests
+                    else 0.0
+                ),
+                "half_life": self.half_life,
+                "top_k": self.top_k,
+                "tracked": len(self._top),
+                "sketch_width": self._sketch.width,
+                "sketch_depth": self._sketch.depth,
+                "memory_bytes": self._sketch.memory_bytes,
+                "overestimate_bound": (
+                    math.e
+                    / self._sketch.width
+                    * self._weighted_requests
+                    / self._weight()
+                ),
+            }
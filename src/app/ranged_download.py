@@ -0,0 +1,249 @@
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+import http_client
+from payload_buffer import COPY_CHUNK_SIZE, SpooledPayload
+
+# ----------------------------------------------------------------------
+# Ranged Downloads
+# Fetches one large object over several pooled connections at once with
+# HTTP Range requests. A single connection on a long, fast path spends much
+# of the transfer growing its TCP window; splitting the object into ranges
+# fetched in parallel keeps more data in flight. Every range is read
+# straight into its place in one preallocated SpooledPayload (a bytearray,
+# or a temporary file for large objects), so the body is never reassembled
+# from pieces.
+#
+# The first range doubles as the probe: its Content-Range reveals the
+# object size, and an origin that ignores Range answers it with the whole
+# body, which is then read as a single stream. Segment sizes follow the
+# throughput each connection observes, aiming at SEGMENT_SECONDS per range,
+# and connections are added while the combined throughput keeps improving.
+# ----------------------------------------------------------------------
+
+# Callers fetch over a single connection unless cdnx_ranged_downloads=1, so the
+# download strategies the benchmarks compare keep their single-connection meaning
+ENABLED = os.getenv("cdnx_ranged_downloads", "0") == "1"
+
+# Size of the probe range and of the first ranges after it
+INITIAL_SEGMENT_SIZE = int(os.getenv("cdnx_ranged_segment_size", 1024 * 1024))
+MIN_SEGMENT_SIZE = 256 * 1024
+MAX_SEGMENT_SIZE = int(os.getenv("cdnx_ranged_max_segment_size", 16 * 1024 * 1024))
+
+# Connections a download starts with and may grow to
+INITIAL_CONCURRENCY = int(os.getenv("cdnx_ranged_concurrency", 4))
+MAX_CONCURRENCY = int(os.getenv("cdnx_ranged_max_concurrency", 16))
+
+# Time a range should take on one connection, and the throughput gain needed to
+# keep adding connections
+SEGMENT_SECONDS = float(os.getenv("cdnx_ranged_segment_seconds", 0.25))
+RAMP_UP_GAIN = 1.1
+
+# Attempts per range, each resuming from the last byte received
+RANGE_ATTEMPTS = 3
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangedDownloadError(Exception):
+    """Raised when the origin answers a range request inconsistently."""
+
+
+# Downloads a whole object into a SpooledPayload, which moves to a temporary file when
+# the object is larger than max_memory (SPOOL_MAX_MEMORY by default)
+def download(url, headers=None, max_memory=None):
+    # Ranges are byte offsets into the stored representation, so it must not be
+    # transparently compressed
+    headers = dict(headers or {}, **{"Accept-Encoding": "identity"})
+
+    probe_headers = dict(headers, Range="bytes=0-%d" % (INITIAL_SEGMENT_SIZE - 1))
+    with http_client.get(url, headers=probe_headers, stream=True) as response:
+        response.raise_for_status()
+
+        total = _content_range(response, 0)
+        if response.status_code != 206 or total is None:
+            return _read_whole(response, max_memory)
+
+        payload = SpooledPayload(total, max_memory=max_memory)
+        received = payload.fill(
+            0, min(total, INITIAL_SEGMENT_SIZE), response.raw.readinto
+        )
+        validator = response.headers.get("ETag") or response.headers.get(
+            "Last-Modified"
+        )
+
+    try:
+        if received < total:
+            _RangedFetch(url, headers, validator, payload, received).run()
+    except BaseException:
+        payload.close()
+        raise
+    return payload
+
+
+# Fallback for origins without range support: the response already holds the whole
+# body, read it into a payload of the advertised length when there is one
+def _read_whole(response, max_memory):
+    length = response.headers.get("Content-Length")
+    if length is None:
+        payload = SpooledPayload(max_memory=max_memory)
+        for chunk in response.iter_content(chunk_size=COPY_CHUNK_SIZE):
+            payload.write(chunk)
+        return payload
+
+    payload = SpooledPayload(int(length), max_memory=max_memory)
+    if payload.fill(0, len(payload), response.raw.readinto) != len(payload):
+        payload.close()
+        raise RangedDownloadError("body is shorter than its Content-Length")
+    return payload
+
+
+# Returns the total size from a 206 response's Content-Range, checking the range
+# starts where it was asked to
+def _content_range(response, start):
+    match = CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+    if match is None:
+        return None
+    if int(match.group(1)) != start:
+        raise RangedDownloadError("origin returned a different range than requested")
+    return int(match.group(3))
+
+
+class _RangedFetch:
+    """The remaining ranges of one object, fetched by a growing set of workers."""
+
+    def __init__(self, url, headers, validator, payload, offset):
+        self.url = url
+        self.headers = dict(headers)
+        # If the object changes mid-download the origin answers 200 instead of 206
+        if validator:
+            self.headers["If-Range"] = validator
+        self.payload = payload
+        self.total = len(payload)
+        self.next_offset = offset
+        self.segment_size = INITIAL_SEGMENT_SIZE
+
+        self._lock = threading.Lock()
+        self._progress = queue.Queue()
+        self._failed = False
+
+    def run(self):
+        pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        workers = []
+        try:
+            for _ in range(min(INITIAL_CONCURRENCY, self.ranges_left())):
+                workers.append(pool.submit(self.worker))
+
+            window_started = time.perf_counter()
+            window_bytes = 0
+            best_rate = 0.0
+            while not all(worker.done() for worker in workers):
+                try:
+                    window_bytes += self._progress.get(timeout=SEGMENT_SECONDS / 4)
+                except queue.Empty:
+                    continue
+
+                elapsed = time.perf_counter() - window_started
+                if elapsed < SEGMENT_SECONDS:
+                    continue
+                rate = window_bytes / elapsed
+                if (
+                    rate >= best_rate * RAMP_UP_GAIN
+                    and len(workers) < MAX_CONCURRENCY
+                    and self.ranges_left() > len(workers)
+                ):
+                    workers.append(pool.submit(self.worker))
+                best_rate = max(best_rate, rate)
+                window_started = time.perf_counter()
+                window_bytes = 0
+
+            # Raises the first worker error, and counts the connections the workers used
+            for worker in workers:
+                http_client.merge_request_stats(worker.result())
+        finally:
+            with self._lock:
+                self._failed = True
+            pool.shutdown(wait=True)
+
+    def ranges_left(self):
+        with self._lock:
+            return -(-(self.total - self.next_offset) // self.segment_size)
+
+    # Claims the next range to fetch, or None when everything is claimed
+    def next_range(self):
+        with self._lock:
+            if self._failed or self.next_offset >= self.total:
+                return None
+            start = self.next_offset
+            self.next_offset = min(start + self.segment_size, self.total)
+            return start, self.next_offset
+
+    # Moves the segment size towards what one connection moves in SEGMENT_SECONDS
+    def observe(self, size, seconds):
+        target = size / max(seconds, 1e-6) * SEGMENT_SECONDS
+        with self._lock:
+            self.segment_size = int(
+                max(
+                    MIN_SEGMENT_SIZE,
+                    min(MAX_SEGMENT_SIZE, (self.segment_size + target) / 2),
+                )
+            )
+
+    def worker(self):
+        http_client.reset_request_stats()
+        try:
+            while True:
+                claimed = self.next_range()
+                if claimed is None:
+                    break
+
+                start, end = claimed
+                started = time.perf_counter()
+                self.fetch_range(start, end)
+                self.observe(end - start, time.perf_counter() - started)
+                self._progress.put(end - start)
+        except Exception:
+            with self._lock:
+                self._failed = True
+            raise
+
+        return http_client.request_stats()
+
+    def fetch_range(self, start, end):
+        offset = start
+        for attempt in range(RANGE_ATTEMPTS):
+            headers = dict(self.headers, Range="bytes=%d-%d" % (offset, end - 1))
+            try:
+                with http_client.get(
+                    self.url, headers=headers, stream=True
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise RangedDownloadError("object changed during the download")
+                    if _content_range(response, offset) != self.total:
+                        raise RangedDownloadError(
+                            "object size changed during the download"
+                        )
+
+                    offset += self.payload.fill(
+                        offset, end - offset, response.raw.readinto
+                    )
+                    if offset == end:
+                        return
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                ProtocolError,
+                ReadTimeoutError,
+            ):
+                if attempt == RANGE_ATTEMPTS - 1:
+                    raise
+
+        raise RangedDownloadError("range %d-%d ended early" % (start, end - 1))
@@ -0,0 +1,82 @@
+import argparse
+import json
+import sys
+import time
+import urllib.request
+
+# ----------------------------------------------------------------------
+# Readiness Probe
+# Run on an instance right after its service is started. It polls the
+# service's /heartbeat until it answers and prints how long bring-up took
+# as one JSON line:
+#   boot_to_heartbeat_s  kernel boot to the first heartbeat
+#   boot_to_setup_s      kernel boot to the user data script starting
+#   setup_s              user data start to the service being started
+#                        (unpacking the code and its dependencies)
+#   service_start_s      service started to its first heartbeat
+# Only the standard library is used so the probe works whatever the state of
+# the service's dependencies.
+#
+# Usage: python3 readiness.py --service vpn_service \
+#            --setup-started <epoch s> --service-started <epoch s>
+# Exits 1 if the service is not up within --timeout seconds.
+# ----------------------------------------------------------------------
+
+
+# Wall clock time the kernel booted, from the seconds it has been up
+def boot_time():
+    with open("/proc/uptime") as uptime:
+        return time.time() - float(uptime.read().split()[0])
+
+
+def wait_for_heartbeat(url, timeout, interval):
+    deadline = time.monotonic() + timeout
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            with urllib.request.urlopen(url, timeout=interval) as response:
+                if response.status == 200:
+                    return attempts
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Service readiness probe")
+    parser.add_argument("--service", required=True)
+    parser.add_argument("--url", default="http://127.0.0.1:8000/heartbeat")
+    parser.add_argument("--setup-started", type=float, help="epoch seconds")
+    parser.add_argument("--service-started", type=float, help="epoch seconds")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--interval", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    attempts = wait_for_heartbeat(args.url, args.timeout, args.interval)
+    if attempts is None:
+        print(json.dumps({"service": args.service, "ready": False}), flush=True)
+        return 1
+    ready = time.time()
+    booted = boot_time()
+
+    report = {
+        "service": args.service,
+        "ready": True,
+        "attempts": attempts,
+        "boot_to_heartbeat_s": ready - booted,
+    }
+    if args.setup_started:
+        report["boot_to_setup_s"] = args.setup_started - booted
+        if args.service_started:
+            report["setup_s"] = args.service_started - args.setup_started
+    if args.service_started:
+        report["service_start_s"] = ready - args.service_started
+    print(json.dumps(report), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
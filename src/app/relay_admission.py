@@ -0,0 +1,239 @@
+import threading
+from collections import deque
+
+# ----------------------------------------------------------------------
+# Relay Admission Control
+# Bounds the relays a VPN service runs at once so a burst of large
+# downloads cannot exhaust its memory or its request threads and take the
+# CDNx lookups served by the same process down with it. Every relay
+# reserves a share of a byte budget up front (what it may hold in memory
+# before its response is sent) and one of a fixed number of upstream
+# fetch slots. A relay that does not fit waits in a bounded queue for up
+# to max_wait seconds; once the queue is full, or the wait runs out, it is
+# turned away with AdmissionRejected, which the service answers with a 429
+# and a Retry-After. Relays that answer /use_cdnx misses wait in their own
+# queue that is served first and may displace queued bulk relays, so the
+# small objects of the CDNx path stay ahead of bulk /use_vpn downloads.
+# AsyncRelayAdmission is the same controller for the asyncio serving mode.
+# ----------------------------------------------------------------------
+
+# Relay priorities, most urgent first
+CONTROL = 0
+BULK = 1
+
+
+class AdmissionRejected(Exception):
+    """A relay turned away because the relay budget stayed exhausted."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__("relay budget exhausted (%s)" % reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A relay's admission, holding its share of the budget until released."""
+
+    def __init__(self, admission, cost, priority, done):
+        self._admission = admission
+        self.cost = cost
+        self.priority = priority
+        # Set once the relay is admitted, or rejected while it waited
+        self.done = done
+        self.admitted = False
+        self.rejected = None
+        self.released = False
+
+    # Gives back what the relay no longer needs, once its size is known
+    def shrink(self, cost):
+        self._admission._shrink(self, cost)
+
+    def release(self):
+        self._admission._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class RelayAdmission:
+    """Byte budget and fetch slots for relays, with a bounded priority wait queue."""
+
+    def __init__(self, max_bytes, max_relays, max_waiting, max_wait, retry_after):
+        self.max_bytes = max_bytes
+        self.max_relays = max_relays
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        # Waiting tickets by priority, each queue in arrival order
+        self._waiting = (deque(), deque())
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.peak_in_flight = 0
+        self.peak_in_flight_bytes = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.displaced = 0
+
+    # Admits a relay reserving cost bytes, waiting up to max_wait behind the relays
+    # already queued. Raises AdmissionRejected when it cannot be admitted in time.
+    def acquire(self, cost, priority=BULK):
+        ticket = self._enter(cost, priority, threading.Event())
+        if not ticket.admitted:
+            ticket.done.wait(self.max_wait)
+            self._settle(ticket)
+        return ticket
+
+    # Admits or queues a new ticket, or raises AdmissionRejected when the queue is full
+    def _enter(self, cost, priority, done):
+        ticket = Ticket(self, cost, priority, done)
+        with self._lock:
+            ahead = sum(len(queue) for queue in self._waiting[: priority + 1])
+            if not ahead and self._fits(cost):
+                self._admit(ticket)
+                return ticket
+
+            if self._waiting_count() >= self.max_waiting:
+                displaced = self._displace(priority)
+                if displaced is None:
+                    self.rejected += 1
+                    raise AdmissionRejected("queue full", self.retry_after)
+                displaced.done.set()
+
+            self._waiting[priority].append(ticket)
+            self.queued += 1
+        return ticket
+
+    # Resolves a ticket whose wait ended, rejecting it if it was not admitted in time
+    def _settle(self, ticket):
+        with self._lock:
+            if ticket.admitted:
+                return
+            if ticket.rejected is None:
+                self._waiting[ticket.priority].remove(ticket)
+                self.timed_out += 1
+                ticket.rejected = "timed out"
+        raise AdmissionRejected(ticket.rejected, self.retry_after)
+
+    # Drops a ticket whose caller stopped waiting, giving its share of the budget back
+    # if it was admitted in the meantime
+    def _abandon(self, ticket):
+        with self._lock:
+            if not ticket.admitted:
+                if ticket.rejected is None:
+                    self._waiting[ticket.priority].remove(ticket)
+                    ticket.rejected = "abandoned"
+                return
+        self._release(ticket)
+
+    # Makes room in a full queue for a more urgent relay by turning away the bulk
+    # relay that arrived last, returning it or None if there is none to displace
+    def _displace(self, priority):
+        for lower in range(len(self._waiting) - 1, priority, -1):
+            if self._waiting[lower]:
+                ticket = self._waiting[lower].pop()
+                ticket.rejected = "displaced"
+                self.displaced += 1
+                return ticket
+        return None
+
+    def _fits(self, cost):
+        if self.in_flight >= self.max_relays:
+            return False
+        # A relay larger than the whole budget still runs, on its own
+        return self.in_flight_bytes + cost <= self.max_bytes or not self.in_flight
+
+    def _admit(self, ticket):
+        ticket.admitted = True
+        self.in_flight += 1
+        self.in_flight_bytes += ticket.cost
+        self.admitted += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+
+    def _waiting_count(self):
+        return sum(len(queue) for queue in self._waiting)
+
+    def _shrink(self, ticket, cost):
+        with self._lock:
+            if ticket.released or cost >= ticket.cost:
+                return
+            self.in_flight_bytes -= ticket.cost - cost
+            ticket.cost = cost
+            admitted = self._admit_waiting()
+        for waiting in admitted:
+            waiting.done.set()
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+            self.in_flight_bytes -= ticket.cost
+            admitted = self._admit_waiting()
+        for waiting in admitted:
+            waiting.done.set()
+
+    # Admits queued tickets in priority order for as long as they fit. Bulk relays
+    # keep waiting while a more urgent relay is still queued.
+    def _admit_waiting(self):
+        admitted = []
+        for queue in self._waiting:
+            while queue and self._fits(queue[0].cost):
+                ticket = queue.popleft()
+                self._admit(ticket)
+                admitted.append(ticket)
+            if queue:
+                break
+        return admitted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "max_relays": self.max_relays,
+                "in_flight": self.in_flight,
+                "in_flight_bytes": self.in_flight_bytes,
+                "peak_in_flight": self.peak_in_flight,
+                "peak_in_flight_bytes": self.peak_in_flight_bytes,
+                "waiting": {
+                    "control": len(self._waiting[CONTROL]),
+                    "bulk": len(self._waiting[BULK]),
+                },
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "displaced": self.displaced,
+            }
+
+
+class AsyncRelayAdmission(RelayAdmission):
+    """RelayAdmission for asyncio, waiting in the queue without blocking the loop."""
+
+    # Same contract as RelayAdmission.acquire, for a caller on the event loop thread
+    async def acquire(self, cost, priority=BULK):
+        # Imported here so the threaded services, which never build this controller,
+        # do not pay for loading asyncio at start-up
+        import asyncio
+
+        ticket = self._enter(cost, priority, asyncio.Event())
+        if not ticket.admitted:
+            try:
+                await asyncio.wait_for(ticket.done.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # A handler cancelled while queued, as when its client disconnects
+                self._abandon(ticket)
+                raise
+            self._settle(ticket)
+        return ticket
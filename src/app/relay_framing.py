@@ -0,0 +1,145 @@
+import os
+import struct
+
+from cryptography.fernet import InvalidToken
+
+from relay_compression import DecompressionError, decode_chunk, encode_chunk
+
+# ----------------------------------------------------------------------
+# Relay Framing
+# Shared by the VPN service and the user device for the streaming relay
+# mode. Instead of sealing a whole asset into one token, the VPN reads the
+# origin response in chunks and seals each chunk into its own independently
+# authenticated frame, so the first bytes can leave the VPN before the
+# download finishes and neither side ever holds more than a frame in memory.
+#
+# Wire format, repeated until the final frame:
+#   4 byte big-endian token length | sealed token
+# Each sealed token authenticates an 8 byte sequence number and a 1 byte
+# final-frame flag ahead of the chunk, so frames cannot be reordered,
+# replayed within the stream, or silently truncated.
+#
+# Compressed relays (RELAY_COMPRESSED_MIMETYPE, for requests that opted in
+# with compress=1) put a codec byte between that header and the chunk and
+# compress the chunk before it is sealed, see relay_compression.py.
+# ----------------------------------------------------------------------
+
+# Size of each origin read that is sealed into its own frame
+CHUNK_SIZE = int(os.getenv("cdnx_relay_chunk_size", 64 * 1024))
+
+# Upper bound on a single sealed token, guards the reader against bogus lengths
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+FRAME_LENGTH = struct.Struct(">I")
+FRAME_HEADER = struct.Struct(">QB")
+
+RELAY_MIMETYPE = "application/vnd.cdnx.frames"
+RELAY_COMPRESSED_MIMETYPE = "application/vnd.cdnx.compressed-frames"
+
+
+class FramingError(Exception):
+    """Raised when a framed relay stream is malformed, tampered with or truncated."""
+
+
+def relay_mimetype(compress):
+    return RELAY_COMPRESSED_MIMETYPE if compress else RELAY_MIMETYPE
+
+
+# Seals a single chunk into a length-prefixed frame, compressing it first for
+# compressed relays
+def seal_frame(crypto_util, sequence, final, chunk, compress=False):
+    if compress:
+        chunk = encode_chunk(chunk)
+    token = crypto_util.encrypt(FRAME_HEADER.pack(sequence, int(final)) + chunk)
+    return FRAME_LENGTH.pack(len(token)) + token
+
+
+# Seals an iterable of plaintext chunks into frames. One chunk is held back so
+# the last frame can be flagged as final; an empty body still yields a final frame.
+def seal_frames(crypto_util, chunks, compress=False):
+    sequence = 0
+    pending = None
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if pending is not None:
+            yield seal_frame(crypto_util, sequence, False, pending, compress)
+            sequence += 1
+        pending = chunk
+
+    yield seal_frame(crypto_util, sequence, True, pending or b"", compress)
+
+
+class FrameReader:
+    """Incrementally reassembles and verifies frames from arbitrary network reads."""
+
+    def __init__(self, crypto_util, compressed=False):
+        self._crypto_util = crypto_util
+        self._compressed = compressed
+        self._buffer = bytearray()
+        self._next_sequence = 0
+        self.finished = False
+
+    # Accepts the next network read and yields every plaintext chunk it completes
+    def feed(self, data):
+        self._buffer += data
+
+        while len(self._buffer) >= FRAME_LENGTH.size:
+            (token_length,) = FRAME_LENGTH.unpack_from(self._buffer)
+            if token_length > MAX_FRAME_SIZE:
+                raise FramingError("frame length %d exceeds limit" % token_length)
+
+            frame_end = FRAME_LENGTH.size + token_length
+            if len(self._buffer) < frame_end:
+                return
+
+            token = bytes(self._buffer[FRAME_LENGTH.size : frame_end])
+            del self._buffer[:frame_end]
+
+            yield self._open(token)
+
+    # Verifies the stream ended on its final frame with nothing trailing it
+    def close(self):
+        if not self.finished:
+            raise FramingError("relay stream truncated before final frame")
+        if self._buffer:
+            raise FramingError("unexpected data after final frame")
+
+    def _open(self, token):
+        if self.finished:
+            raise FramingError("unexpected frame after final frame")
+
+        try:
+            plaintext = self._crypto_util.decrypt(token)
+        except InvalidToken:
+            raise FramingError("frame failed authentication")
+
+        sequence, final = FRAME_HEADER.unpack_from(plaintext)
+        if sequence != self._next_sequence:
+            raise FramingError(
+                "expected frame %d but received %d" % (self._next_sequence, sequence)
+            )
+
+        self._next_sequence += 1
+        self.finished = bool(final)
+
+        if self._compressed:
+            try:
+                return decode_chunk(
+                    memoryview(plaintext)[FRAME_HEADER.size :], MAX_FRAME_SIZE
+                )
+            except DecompressionError as e:
+                raise FramingError("frame %d: %s" % (sequence, e))
+        return plaintext[FRAME_HEADER.size :]
+
+
+# Verifies and decrypts a framed relay stream, yielding plaintext chunks as they complete
+def open_frames(crypto_util, byte_chunks, compressed=False):
+    reader = FrameReader(crypto_util, compressed)
+
+    for data in byte_chunks:
+        for chunk in reader.feed(data):
+            yield chunk
+
+    reader.close()
@@ -0,0 +1,271 @@
+import base64
+import io
+import os
+import struct
+import sys
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# ----------------------------------------------------------------------
+# Segmented Encrypted Asset Container
+# The format CDNx assets are stored in on the VPN-managed CDN. Instead of a
+# single base64 Fernet token that must be fully downloaded before it can be
+# decrypted, the asset is a fixed-size binary header followed by fixed-size
+# AES-GCM sealed segments. The user device decrypts each segment as soon as
+# it arrives, and because every segment sits at a known offset it can also be
+# fetched out of order with HTTP Range requests or resumed after a failure.
+#
+# Layout:
+#   header | segment 0 | segment 1 | ... | segment n-1
+# Each segment is segment_size bytes of ciphertext plus a 16 byte tag (the
+# last segment may be shorter). Every file gets a random id from which its
+# AES key is derived, each segment's nonce is its index, and the header plus
+# the segment index are bound in as associated data so segments cannot be
+# swapped, reordered, dropped or moved between files.
+# ----------------------------------------------------------------------
+
+MAGIC = b"CDNXSEG1"
+VERSION = 1
+
+# magic, version, segment size, segment count, plaintext length, file id
+HEADER = struct.Struct(">8sB3xIIQ16s")
+HEADER_SIZE = HEADER.size
+
+SEGMENT_INDEX = struct.Struct(">I")
+NONCE_PREFIX = bytes(8)
+TAG_SIZE = 16
+
+DEFAULT_SEGMENT_SIZE = int(os.getenv("cdnx_asset_segment_size", 64 * 1024))
+
+SEGMENTED_MIMETYPE = "application/vnd.cdnx.segmented"
+
+
+class SegmentedAssetError(Exception):
+    """Raised when a segmented asset is malformed or fails authentication."""
+
+
+# Returns True if the leading bytes of an asset are a segmented container header
+def is_segmented(data):
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+class AssetHeader:
+    """Parsed container header along with the helpers for locating segments."""
+
+    def __init__(self, segment_size, segment_count, plaintext_length, file_id):
+        self.segment_size = segment_size
+        self.segment_count = segment_count
+        self.plaintext_length = plaintext_length
+        self.file_id = file_id
+        self.raw = HEADER.pack(
+            MAGIC, VERSION, segment_size, segment_count, plaintext_length, file_id
+        )
+
+    @classmethod
+    def parse(cls, data):
+        if len(data) < HEADER_SIZE:
+            raise SegmentedAssetError("asset is shorter than its header")
+
+        magic, version, segment_size, segment_count, plaintext_length, file_id = (
+            HEADER.unpack_from(data)
+        )
+        if magic != MAGIC:
+            raise SegmentedAssetError("not a segmented asset")
+        if version != VERSION:
+            raise SegmentedAssetError("unsupported asset version %d" % version)
+        if segment_size == 0 or segment_count != segment_count_for(
+            plaintext_length, segment_size
+        ):
+            raise SegmentedAssetError("inconsistent segment layout in header")
+
+        return cls(segment_size, segment_count, plaintext_length, file_id)
+
+    # Plaintext length of the segment at the given index
+    def plaintext_size(self, index):
+        if index == self.segment_count - 1:
+            return self.plaintext_length - index * self.segment_size
+        return self.segment_size
+
+    # Byte offset of a segment within the container
+    def segment_offset(self, index):
+        return HEADER_SIZE + index * (self.segment_size + TAG_SIZE)
+
+    # Inclusive byte range of a segment, ready for an HTTP Range header
+    def segment_range(self, index):
+        start = self.segment_offset(index)
+        return start, start + self.plaintext_size(index) + TAG_SIZE - 1
+
+    # Index of the segment holding the given container offset
+    def segment_at_offset(self, container_offset):
+        return (container_offset - HEADER_SIZE) // (self.segment_size + TAG_SIZE)
+
+    @property
+    def container_length(self):
+        return HEADER_SIZE + self.plaintext_length + self.segment_count * TAG_SIZE
+
+
+def segment_count_for(plaintext_length, segment_size):
+    # An empty asset is still stored as one empty authenticated segment
+    return max(1, -(-plaintext_length // segment_size))
+
+
+class SegmentedAssetCipher:
+    """Seals and opens segmented assets with keys derived from a Fernet asset key."""
+
+    def __init__(self, asset_key):
+        # Fernet keys are urlsafe base64 of 32 bytes, reuse the raw bytes as key material
+        self._key_material = base64.urlsafe_b64decode(asset_key)
+
+    def _aead(self, file_id):
+        key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=file_id,
+            info=b"cdnx-segmented-asset-v1",
+        ).derive(self._key_material)
+        return AESGCM(key)
+
+    # Yields the container for a readable binary stream of known length, one
+    # segment at a time so memory stays bounded by the segment size
+    def encrypt_stream(
+        self, stream, plaintext_length, segment_size=DEFAULT_SEGMENT_SIZE
+    ):
+        header = AssetHeader(
+            segment_size,
+            segment_count_for(plaintext_length, segment_size),
+            plaintext_length,
+            os.urandom(16),
+        )
+        aead = self._aead(header.file_id)
+
+        yield header.raw
+        for index in range(header.segment_count):
+            segment = stream.read(header.plaintext_size(index))
+            if len(segment) != header.plaintext_size(index):
+                raise SegmentedAssetError("source ended before its declared length")
+            yield _seal_segment(aead, header, index, segment)
+
+    def encrypt_bytes(self, data, segment_size=DEFAULT_SEGMENT_SIZE):
+        return b"".join(self.encrypt_stream(io.BytesIO(data), len(data), segment_size))
+
+    # Returns a decryptor that opens individual segments in any order
+    def segment_decryptor(self, header):
+        return SegmentDecryptor(header, self._aead(header.file_id))
+
+    # Returns an incremental decryptor for a container arriving in order
+    def stream_decryptor(self):
+        return StreamDecryptor(self)
+
+
+def _seal_segment(aead, header, index, segment):
+    index_bytes = SEGMENT_INDEX.pack(index)
+    return aead.encrypt(NONCE_PREFIX + index_bytes, segment, header.raw + index_bytes)
+
+
+class SegmentDecryptor:
+    """Opens segments of one asset independently, for ranged or resumed fetches."""
+
+    def __init__(self, header, aead):
+        self.header = header
+        self._aead = aead
+
+    def decrypt_segment(self, index, sealed_segment):
+        if not 0 <= index < self.header.segment_count:
+            raise SegmentedAssetError("segment %d out of range" % index)
+
+        index_bytes = SEGMENT_INDEX.pack(index)
+        try:
+            segment = self._aead.decrypt(
+                NONCE_PREFIX + index_bytes,
+                bytes(sealed_segment),
+                self.header.raw + index_bytes,
+            )
+        except InvalidTag:
+            raise SegmentedAssetError("segment %d failed authentication" % index)
+
+        if len(segment) != self.header.plaintext_size(index):
+            raise SegmentedAssetError("segment %d has the wrong length" % index)
+        return segment
+
+
+class StreamDecryptor:
+    """Decrypts a container segment by segment as network reads arrive."""
+
+    def __init__(self, cipher):
+        self._cipher = cipher
+        self._buffer = bytearray()
+        self._segments = None
+        self.next_index = 0
+
+    @property
+    def header(self):
+        return self._segments.header if self._segments else None
+
+    @property
+    def finished(self):
+        return self._segments is not None and (
+            self.next_index == self._segments.header.segment_count
+        )
+
+    # Container offset of the first byte not yet consumed into a segment, used to resume
+    @property
+    def resume_offset(self):
+        if self._segments is None:
+            return 0
+        return self._segments.header.segment_offset(self.next_index)
+
+    # Accepts the next network read and yields every plaintext segment it completes
+    def feed(self, data):
+        self._buffer += data
+
+        if self._segments is None:
+            if len(self._buffer) < HEADER_SIZE:
+                return
+            header = AssetHeader.parse(self._buffer)
+            self._segments = self._cipher.segment_decryptor(header)
+            del self._buffer[:HEADER_SIZE]
+
+        header = self._segments.header
+        while self.next_index < header.segment_count:
+            sealed_size = header.plaintext_size(self.next_index) + TAG_SIZE
+            if len(self._buffer) < sealed_size:
+                return
+
+            segment = self._segments.decrypt_segment(
+                self.next_index, self._buffer[:sealed_size]
+            )
+            del self._buffer[:sealed_size]
+            self.next_index += 1
+            yield segment
+
+    # Drops any partial segment so the stream can be resumed from resume_offset
+    def discard_partial(self):
+        self._buffer = bytearray()
+
+    def close(self):
+        if not self.finished:
+            raise SegmentedAssetError("asset truncated before its final segment")
+        if self._buffer:
+            raise SegmentedAssetError("unexpected data after final segment")
+
+
+# Encrypts a plaintext file into a segmented container on disk
+def encrypt_file(asset_key, source_path, destination_path, segment_size=None):
+    cipher = SegmentedAssetCipher(asset_key)
+    with open(source_path, "rb") as source, open(destination_path, "wb") as out:
+        length = os.fstat(source.fileno()).st_size
+        for block in cipher.encrypt_stream(
+            source, length, segment_size or DEFAULT_SEGMENT_SIZE
+        ):
+            out.write(block)
+
+
+if __name__ == "__main__":
+    # Usage: python3 segmented_asset.py <plaintext file> <encrypted output file>
+    # The asset key is read from the same cdnx_asset_key env var the services use.
+    if len(sys.argv) != 3:
+        sys.exit("usage: segmented_asset.py <source> <destination>")
+    encrypt_file(os.getenv("cdnx_asset_key").encode("utf-8"), sys.argv[1], sys.argv[2])
@@ -0,0 +1,137 @@
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+# ----------------------------------------------------------------------
+# Production Serving Mode
+# Runs a service under gunicorn instead of Flask's development server: a
+# prefork server with one worker process per core, each serving requests
+# on a pool of threads (or, for vpn_service_async, on its own asyncio event
+# loop). The app is imported once in the master before the workers fork,
+# so keys, Fernet and AEAD contexts and loaded index snapshots are built
+# once and shared copy-on-write; background threads start in each worker
+# with its first request.
+#
+# Workers are recycled after cdnx_max_requests requests, with jitter so
+# they do not all restart at once, and get cdnx_graceful_timeout seconds
+# to finish in-flight requests on SIGTERM or when recycled. Idle client
+# connections are kept open for cdnx_keepalive seconds, past the usual
+# client pool idle time, and up to cdnx_backlog connections may wait to be
+# accepted.
+#
+# The content key cache always runs a single worker: inserts and removals
+# change its index and membership filter, which must stay in one process.
+# So do the VPN services, whose lookup cache (invalidated by pushes that
+# reach one process), filter replicas, popularity counts, admission list
+# file and relay budget all describe the whole service; they serve their
+# requests on the worker's threads or event loop. Services with several
+# workers get a temporary directory for their metrics snapshots
+# (cdnx_metrics_directory, see metrics.py), so /metrics adds up every
+# worker, and each worker writes its final snapshot as it exits.
+#
+# Usage: python3 serve.py vpn_service [--bind 0.0.0.0:8000]
+# ----------------------------------------------------------------------
+
+# Worker processes, and request threads in each
+WORKERS = int(os.getenv("cdnx_workers", os.cpu_count() or 1))
+WORKER_THREADS = int(os.getenv("cdnx_worker_threads", 32))
+
+# Requests a worker serves before it is replaced, 0 to keep workers for good
+MAX_REQUESTS = int(os.getenv("cdnx_max_requests", 10000))
+
+GRACEFUL_TIMEOUT = int(os.getenv("cdnx_graceful_timeout", 30))
+KEEPALIVE = int(os.getenv("cdnx_keepalive", 75))
+BACKLOG = int(os.getenv("cdnx_backlog", 2048))
+
+# Seconds a worker may go without checking in before it is restarted. Threaded and
+# asyncio workers check in while requests run, so long relays do not count.
+WORKER_TIMEOUT = 60
+
+# Service module -> (worker class, fixed worker count or None for WORKERS)
+SERVICES = {
+    "cdnx_content_key_cache": ("gthread", 1),
+    "user_device": ("gthread", None),
+    "vpn_service": ("gthread", 1),
+    "vpn_service_async": ("aiohttp.GunicornWebWorker", 1),
+}
+
+
+class ServiceApplication(BaseApplication):
+    """A gunicorn application serving one of the CDNx services."""
+
+    def __init__(self, service, options):
+        self.service = service
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        module = importlib.import_module(self.service)
+        if hasattr(module, "create_app"):
+            return module.create_app()
+        return module.app
+
+
+def options_for(service, bind, workers=None):
+    worker_class, fixed_workers = SERVICES[service]
+    return {
+        "bind": bind,
+        "worker_class": worker_class,
+        "workers": fixed_workers or workers or WORKERS,
+        "threads": WORKER_THREADS,
+        "preload_app": True,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS // 10,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": WORKER_TIMEOUT,
+        "keepalive": KEEPALIVE,
+        "backlog": BACKLOG,
+        # Heartbeat files on tmpfs, so a slow disk cannot get workers killed
+        "worker_tmp_dir": "/dev/shm" if os.path.isdir("/dev/shm") else None,
+    }
+
+
+# Runs in a worker process as it exits, so its last counts are not lost
+def write_metrics_snapshot(server, worker):
+    import metrics
+
+    metrics.write_snapshot()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a CDNx service with gunicorn")
+    parser.add_argument(
+        "service", help="service module, e.g. vpn_service or vpn_service.py"
+    )
+    parser.add_argument("--bind", default="0.0.0.0:8000")
+    parser.add_argument("--workers", type=int, help="worker processes")
+    args = parser.parse_args(argv)
+
+    service = args.service[:-3] if args.service.endswith(".py") else args.service
+    if service not in SERVICES:
+        parser.error("unknown service: %s" % args.service)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    options = options_for(service, args.bind, args.workers)
+    # Set before the app is loaded, which reads it on import
+    if options["workers"] > 1 and not os.getenv("cdnx_metrics_directory"):
+        metrics_directory = tempfile.mkdtemp(prefix="cdnx-metrics-")
+        os.environ["cdnx_metrics_directory"] = metrics_directory
+        options["on_exit"] = lambda server: shutil.rmtree(
+            metrics_directory, ignore_errors=True
+        )
+    options["worker_exit"] = write_metrics_snapshot
+    ServiceApplication(service, options).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+# ----------------------------------------------------------------------
+# Phase Timing
+# Breaks the time a request spends in each service down into named phases
+# (encryption, round trips, lookups, fetches, decryption) using the
+# monotonic nanosecond clock. A trace id travels with the request across
+# hops in the X-Cdnx-Trace-Id header, and each service reports its own
+# phases back in the X-Cdnx-Timing header (JSON) and the standard
+# Server-Timing header, so the user device can return one breakdown of the
+# whole CDNx handshake. Recording a phase is a clock read and a dict
+# update, cheap enough to leave on during benchmark runs.
+# ----------------------------------------------------------------------
+
+TRACE_HEADER = "X-Cdnx-Trace-Id"
+TIMING_HEADER = "X-Cdnx-Timing"
+
+# Set cdnx_timing=0 to stop reporting phases in response headers
+TIMING_ENABLED = os.getenv("cdnx_timing", "1") != "0"
+
+
+class Trace:
+    """Phase durations recorded while handling one request."""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter_ns()
+        self.phases = {}
+        self.upstream = {}
+        self._lock = threading.Lock()
+
+    # Adds a duration to a phase, repeated phases (per-segment decryption) accumulate
+    def record(self, name, duration_ns):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + duration_ns
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter_ns() - started)
+
+    # Headers to send on an outbound request so the next hop joins this trace
+    def headers(self):
+        return {TRACE_HEADER: self.trace_id}
+
+    # Keeps the phase breakdown a downstream service reported on its response
+    def add_upstream(self, name, response):
+        reported = response.headers.get(TIMING_HEADER)
+        if reported:
+            try:
+                self.upstream[name] = json.loads(reported)
+            except ValueError:
+                pass
+
+    @property
+    def elapsed_ms(self):
+        return (time.perf_counter_ns() - self.started) / 1e6
+
+    def as_dict(self):
+        with self._lock:
+            breakdown = {
+                "trace_id": self.trace_id,
+                "elapsed_ms": self.elapsed_ms,
+                "phases": {name: ns / 1e6 for name, ns in self.phases.items()},
+            }
+        if self.upstream:
+            breakdown["upstream"] = self.upstream
+        return breakdown
+
+    def server_timing(self):
+        with self._lock:
+            return ", ".join(
+                "%s;dur=%.3f" % (name, ns / 1e6) for name, ns in self.phases.items()
+            )
+
+
+# The trace of the request being handled, or a throwaway one outside a request
+# (for example on worker threads) so callers never need to check
+def current_trace():
+    if has_request_context() and "cdnx_trace" in g:
+        return g.cdnx_trace
+    return Trace()
+
+
+# Registers hooks on a Flask app that start a trace for every request, joining
+# the caller's trace id if one was sent, and report the phases in response headers
+def init_app(app):
+    @app.before_request
+    def _start_trace():
+        g.cdnx_trace = Trace(request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def _report_trace(response):
+        trace = g.get("cdnx_trace")
+        if trace is not None:
+            response.headers.update(response_headers(trace))
+        return response
+
+
+# Headers reporting a trace on a response, shared by the Flask hooks and the asyncio
+# serving mode
+def response_headers(trace):
+    headers = {TRACE_HEADER: trace.trace_id}
+    if TIMING_ENABLED:
+        headers[TIMING_HEADER] = json.dumps(trace.as_dict(), separators=(",", ":"))
+        headers["Server-Timing"] = trace.server_timing()
+    return headers
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import os
+import struct
+from collections import deque
+
+import aiohttp
+
+# ----------------------------------------------------------------------
+# Multiplexed VPN Tunnel
+# A long-lived WebSocket between a user device and the VPN service that
+# carries many request/response exchanges at once, so concurrent requests
+# from one device share one connection instead of each paying for its own
+# request on the cross-region link (or a new connection once the pool is
+# exhausted). Every exchange is a stream of binary frames:
+#
+#   stream id (4 bytes) | frame type (1 byte) | payload
+#
+#   OPEN     device -> VPN  JSON {"method", "path", "headers"} of a request
+#   HEADERS  VPN -> device  JSON {"status", "headers"} of its response
+#   DATA     either way     a piece of the request or response body
+#   END      either way     no more body in that direction
+#   WINDOW   either way     4 byte count of body bytes the sender may add
+#   RESET    either way     UTF-8 reason the stream was abandoned
+#
+# Bodies are the same sealed e2ee messages the services exchange over
+# plain HTTP, so the tunnel sees no more than an HTTP hop does.
+#
+# Flow control is per stream: a sender may have at most the receiver's
+# window of body bytes unread, and the receiver grants more as it consumes
+# them. A slow reader of a large relay only stalls its own stream, and
+# bodies are cut into frames of at most FRAME_DATA_SIZE so a large relay
+# cannot hold back the small key-resolution exchanges interleaved with it.
+# ----------------------------------------------------------------------
+
+TUNNEL_PATH = "/tunnel"
+
+FRAME_HEADER = struct.Struct(">IB")
+WINDOW_INCREMENT = struct.Struct(">I")
+
+OPEN = 1
+HEADERS = 2
+DATA = 3
+END = 4
+WINDOW = 5
+RESET = 6
+
+# Body bytes each side of a stream may have in flight. A stream gets at most one window
+# per round trip, so this has to cover the device link's bandwidth-delay product
+# (100 Mbit/s over a 124 ms round trip is about 1.5 MB) for relays to keep up with HTTP.
+INITIAL_WINDOW = int(os.getenv("cdnx_tunnel_window", 4 * 1024 * 1024))
+
+# Largest body piece sent in one frame
+FRAME_DATA_SIZE = 16 * 1024
+
+# Seconds between pings on an idle tunnel, so a dead peer is noticed and NATs keep it
+HEARTBEAT = float(os.getenv("cdnx_tunnel_heartbeat", 30))
+
+# Streams open at once on one tunnel
+MAX_STREAMS = int(os.getenv("cdnx_tunnel_max_streams", 256))
+
+# Headers that describe one HTTP hop rather than the exchange, not carried over
+HOP_BY_HOP_HEADERS = frozenset(
+    [
+        "connection",
+        "content-length",
+        "host",
+        "keep-alive",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    ]
+)
+
+
+class TunnelError(Exception):
+    """A tunnel stream was reset, or the tunnel closed under it."""
+
+
+# The headers of a request or response worth carrying through the tunnel
+def end_to_end(headers):
+    return {
+        name: value
+        for name, value in headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    }
+
+
+class TunnelStream:
+    """One request/response exchange on a tunnel, flow controlled both ways."""
+
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.id = stream_id
+        self.head = asyncio.get_running_loop().create_future()
+
+        self._send_window = INITIAL_WINDOW
+        self._credit = asyncio.Event()
+        self._received = deque()
+        self._buffered = 0
+        self._readable = asyncio.Event()
+        self._unacknowledged = 0
+        self._local_ended = False
+        self._remote_ended = False
+        self._error = None
+
+    @property
+    def finished(self):
+        return self._error is not None or (self._local_ended and self._remote_ended)
+
+    async def send_head(self, frame_type, head):
+        await self.connection.send(
+            self.id, frame_type, json.dumps(head).encode("utf-8")
+        )
+
+    # Sends body bytes, waiting for window whenever the receiver has too much unread
+    async def send_data(self, data):
+        view = memoryview(data)
+        while view:
+            while self._send_window <= 0 and self._error is None:
+                self._credit.clear()
+                await self._credit.wait()
+            if self._error is not None:
+                raise self._error
+            size = min(len(view), self._send_window, FRAME_DATA_SIZE)
+            self._send_window -= size
+            await self.connection.send(self.id, DATA, view[:size])
+            view = view[size:]
+
+    async def end(self):
+        if self._error is not None:
+            raise self._error
+        self._local_ended = True
+        await self.connection.send(self.id, END)
+        self._forget_if_finished()
+
+    # All the body received so far, waiting for some if there is none, or b"" once the
+    # other side has ended it
+    async def read(self):
+        while not self._received:
+            if self._error is not None:
+                raise self._error
+            if self._remote_ended:
+                return b""
+            self._readable.clear()
+            await self._readable.wait()
+
+        data = b"".join(self._received)
+        self._received.clear()
+        self._buffered = 0
+        self._unacknowledged += len(data)
+        if self._unacknowledged >= INITIAL_WINDOW // 2 and not self._remote_ended:
+            increment = self._unacknowledged
+            self._unacknowledged = 0
+            await self.connection.send(
+                self.id, WINDOW, WINDOW_INCREMENT.pack(increment)
+            )
+        return data
+
+    # The whole body, or a TunnelError if it is longer than limit
+    async def read_all(self, limit):
+        body = bytearray()
+        while True:
+            data = await self.read()
+            if not data:
+                return bytes(body)
+            body += data
+            if len(body) > limit:
+                raise TunnelError("body over %d bytes" % limit)
+
+    # Abandons the stream, telling the other side unless it already finished
+    async def reset(self, reason=""):
+        if self.finished:
+            return
+        self.fail(TunnelError(reason or "stream reset"))
+        await self.connection.send(self.id, RESET, reason.encode("utf-8"))
+
+    def fail(self, error):
+        if self._error is not None:
+            return
+        self._error = error
+        if not self.head.done():
+            self.head.set_exception(error)
+            # Retrieved here so an unawaited head does not log a warning
+            self.head.exception()
+        self._credit.set()
+        self._readable.set()
+        self.connection.forget(self)
+
+    def receive(self, frame_type, payload):
+        if frame_type == DATA:
+            self._buffered += len(payload)
+            if self._buffered > INITIAL_WINDOW:
+                self.connection.start_task(self.reset("flow control window exceeded"))
+                return
+            self._received.append(payload)
+            self._readable.set()
+        elif frame_type == END:
+            self._remote_ended = True
+            self._readable.set()
+            self._forget_if_finished()
+        elif frame_type == WINDOW:
+            self._send_window += WINDOW_INCREMENT.unpack(payload)[0]
+            self._credit.set()
+        elif frame_type == RESET:
+            self.fail(TunnelError(payload.decode("utf-8") or "stream reset by peer"))
+        elif frame_type in (OPEN, HEADERS) and not self.head.done():
+            self.head.set_result(json.loads(payload))
+
+    def _forget_if_finished(self):
+        if self.finished:
+            self.connection.forget(self)
+
+
+class TunnelConnection:
+    """The streams multiplexed on one tunnel WebSocket, on either end of it."""
+
+    def __init__(self, websocket, on_open=None):
+        self.websocket = websocket
+        # Called with each stream the other side opens, for the VPN end of a tunnel
+        self._on_open = on_open
+        self._streams = {}
+        self._next_id = 1
+        self._send_lock = asyncio.Lock()
+        self._stream_finished = asyncio.Event()
+        self._tasks = set()
+        self.closed = False
+
+        self.streams_opened = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    @property
+    def active_streams(self):
+        return len(self._streams)
+
+    async def send(self, stream_id, frame_type, payload=b""):
+        if self.closed:
+            raise TunnelError("tunnel closed")
+        frame = FRAME_HEADER.pack(stream_id, frame_type) + payload
+        # One frame at a time, so concurrent streams never interleave within a frame
+        async with self._send_lock:
+            try:
+                await self.websocket.send_bytes(frame)
+            except (ConnectionError, RuntimeError) as e:
+                raise TunnelError("tunnel closed: %s" % e)
+
+    # Opens a stream for a request, for the device end of a tunnel, waiting while the
+    # tunnel already has MAX_STREAMS open
+    async def open_stream(self, method, path, headers):
+        while len(self._streams) >= MAX_STREAMS and not self.closed:
+            self._stream_finished.clear()
+            await self._stream_finished.wait()
+
+        stream = TunnelStream(self, self._next_id)
+        self._next_id += 1
+        self._streams[stream.id] = stream
+        self.streams_opened += 1
+        try:
+            await stream.send_head(
+                OPEN, {"method": method, "path": path, "headers": end_to_end(headers)}
+            )
+        except TunnelError as e:
+            stream.fail(e)
+            raise
+        return stream
+
+    def forget(self, stream):
+        if self._streams.pop(stream.id, None) is not None:
+            self._stream_finished.set()
+
+    # Reads frames until the WebSocket closes, then fails the streams still open
+    async def run(self):
+        try:
+            async for message in self.websocket:
+                if message.type != aiohttp.WSMsgType.BINARY:
+                    if message.type == aiohttp.WSMsgType.ERROR:
+                        break
+                    continue
+                self.frames_received += 1
+                self.bytes_received += len(message.data)
+                self._dispatch(message.data)
+        finally:
+            self.closed = True
+            self._stream_finished.set()
+            for stream in list(self._streams.values()):
+                stream.fail(TunnelError("tunnel closed"))
+            for task in list(self._tasks):
+                task.cancel()
+
+    def _dispatch(self, frame):
+        if len(frame) < FRAME_HEADER.size:
+            return
+        stream_id, frame_type = FRAME_HEADER.unpack_from(frame)
+        payload = frame[FRAME_HEADER.size :]
+
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            if frame_type == OPEN and self._on_open is not None:
+                self._accept(stream_id, payload)
+            # Anything else is for a stream already finished or reset, and is dropped
+            return
+        try:
+            stream.receive(frame_type, payload)
+        except (ValueError, struct.error):
+            self.start_task(stream.reset("malformed frame"))
+
+    def _accept(self, stream_id, payload):
+        if stream_id < self._next_id or len(self._streams) >= MAX_STREAMS:
+            self.start_task(self.send(stream_id, RESET, b"stream refused"))
+            return
+        self._next_id = stream_id + 1
+        stream = TunnelStream(self, stream_id)
+        self._streams[stream_id] = stream
+        self.streams_opened += 1
+        try:
+            stream.receive(OPEN, payload)
+        except ValueError:
+            self.start_task(stream.reset("malformed request"))
+            return
+        self.start_task(self._on_open(stream, stream.head.result()))
+
+    # Runs a coroutine for the tunnel, cancelled if the tunnel closes first
+    def start_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            if not isinstance(task.exception(), TunnelError):
+                print(task.exception())
+
+    def stats(self):
+        return {
+            "active_streams": self.active_streams,
+            "streams_opened": self.streams_opened,
+            "frames_received": self.frames_received,
+            "bytes_received": self.bytes_received,
+        }
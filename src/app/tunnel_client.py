@@ -0,0 +1,197 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import http_client
+import metrics
+from tunnel import HEARTBEAT, TUNNEL_PATH, TunnelConnection, TunnelError
+
+# ----------------------------------------------------------------------
+# Device Tunnel Client
+# The user device's end of the multiplexed VPN tunnels (see tunnel.py).
+# Flask request threads send their VPN requests through it with the same
+# get/post calls as http_client, and get back responses read the same way
+# as streamed requests responses, so the e2ee handling does not change
+# with the transport. One tunnel is kept open per VPN service and shared
+# by every request thread; the tunnels run on an asyncio event loop in a
+# background thread, started with the first tunnelled request so each
+# serving worker process gets its own.
+#
+# Failures surface as the requests exceptions the same failure would raise
+# over plain HTTP, and a tunnel that closed is reopened by the next request.
+# ----------------------------------------------------------------------
+
+
+class TunnelResponse:
+    """A response received over a tunnel, read like a streamed requests response."""
+
+    def __init__(self, client, stream, url, head):
+        self._client = client
+        self._stream = stream
+        self.url = url
+        self.status_code = head["status"]
+        self.headers = CaseInsensitiveDict(head["headers"])
+        self._content = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The body as it arrives, whatever chunk_size asks for
+    def iter_content(self, chunk_size=None):
+        while True:
+            data = self._client.call(self._client.read(self._stream))
+            if not data:
+                return
+            yield data
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                "%d Error for url: %s" % (self.status_code, self.url), response=self
+            )
+
+    # Resets the stream if the body was not read to the end
+    def close(self):
+        if not self._stream.finished:
+            self._client.call(self._stream.reset("closed by device"))
+
+
+class TunnelClient:
+    """Blocking requests over one multiplexed tunnel per VPN service."""
+
+    def __init__(
+        self,
+        connect_timeout=http_client.CONNECT_TIMEOUT,
+        read_timeout=http_client.READ_TIMEOUT,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        # Created on the tunnel thread
+        self._session = None
+        # VPN base URL -> future of its TunnelConnection
+        self._tunnels = {}
+        self._readers = set()
+
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="vpn-tunnel", daemon=True
+                ).start()
+                self._loop = loop
+            return self._loop
+
+    # Runs a coroutine on the tunnel thread and waits for it, raising the requests
+    # exception the same failure would raise over plain HTTP
+    def call(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._event_loop())
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ReadTimeout("VPN tunnel timed out")
+        except (TunnelError, aiohttp.ClientError) as e:
+            raise requests.exceptions.ConnectionError("VPN tunnel: %s" % e)
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        parts = urlsplit(url)
+        base_url = "%s://%s" % (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+
+        started = time.perf_counter_ns()
+        try:
+            stream, head, opened = self.call(
+                self._exchange(base_url, method, path, headers or {}, data)
+            )
+        except requests.exceptions.RequestException as e:
+            metrics.observe_upstream(parts.netloc, type(e).__name__, started)
+            raise
+        http_client.record_request(parts.hostname, opened)
+        metrics.observe_upstream(parts.netloc, head["status"], started)
+        return TunnelResponse(self, stream, url, head)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    # Sends a request on a new stream and waits for the response headers
+    async def _exchange(self, base_url, method, path, headers, data):
+        tunnel, opened = await self._tunnel(base_url)
+        stream = await tunnel.open_stream(method, path, headers)
+        try:
+            if data:
+                await stream.send_data(data)
+            await stream.end()
+            head = await asyncio.wait_for(
+                asyncio.shield(stream.head), self.read_timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            await stream.reset("timed out")
+            raise
+        return stream, head, opened
+
+    async def read(self, stream):
+        try:
+            return await asyncio.wait_for(stream.read(), self.read_timeout)
+        except asyncio.TimeoutError:
+            await stream.reset("timed out")
+            raise
+
+    # The open tunnel to a VPN service, and whether this call had to open it
+    async def _tunnel(self, base_url):
+        connecting = self._tunnels.get(base_url)
+        opened = (
+            connecting is None
+            or connecting.cancelled()
+            or (connecting.done() and connecting.exception() is not None)
+            or (connecting.done() and connecting.result().closed)
+        )
+        if opened:
+            connecting = asyncio.ensure_future(self._connect(base_url))
+            self._tunnels[base_url] = connecting
+        return await asyncio.shield(connecting), opened
+
+    async def _connect(self, base_url):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            websocket = await asyncio.wait_for(
+                self._session.ws_connect(
+                    "ws" + base_url[len("http") :] + TUNNEL_PATH, heartbeat=HEARTBEAT
+                ),
+                self.connect_timeout,
+            )
+        except asyncio.TimeoutError:
+            raise TunnelError("timed out opening the tunnel to %s" % base_url)
+        tunnel = TunnelConnection(websocket)
+        reader = asyncio.ensure_future(tunnel.run())
+        self._readers.add(reader)
+        reader.add_done_callback(self._readers.discard)
+        return tunnel
+
+    def stats(self):
+        return {
+            base_url: connecting.result().stats()
+            for base_url, connecting in list(self._tunnels.items())
+            if connecting.done()
+            and not connecting.cancelled()
+            and connecting.exception() is None
+        }
@@ -1,11 +1,38 @@
+import itertools
+import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus
 
 import requests
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from flask import Flask, jsonify, request
 
+import http_client
+import metrics
+import ranged_download
+import timing
+from aead_envelope import DeviceSessions, response_salt
+from device_cache import DeviceCache
+from payload_buffer import COPY_CHUNK_SIZE
+from ranged_download import RangedDownloadError
+from relay_framing import (
+    RELAY_COMPRESSED_MIMETYPE,
+    RELAY_MIMETYPE,
+    FrameReader,
+    FramingError,
+)
+from segmented_asset import (
+    HEADER_SIZE,
+    MAGIC,
+    AssetHeader,
+    SegmentedAssetCipher,
+    SegmentedAssetError,
+    is_segmented,
+)
+from tunnel_client import TunnelClient
+
 # ----------------------------------------------------------------------
 # User Device Service Code
 # This service simulates a user device that can run VPN client software
@@ -17,6 +44,9 @@ from flask import Flask, jsonify, request
 # ----------------------------------------------------------------------
 
 app = Flask(__name__)
+http_client.init_app(app)
+timing.init_app(app)
+metrics.init_app(app)
 
 # These constants are required for the VPN e2ee and are passed to the
 # server during deployment in the cdk.py file.
@@ -26,10 +56,49 @@ CONTENT_KEY = os.getenv("cdnx_content_key").encode("utf-8")
 CDNX_CONTENT_CACHE = os.getenv("cdnx_qa_content_cache")
 QA_KEY = os.getenv("cdnx_qa_key").encode("utf-8")
 
+# Origin server the direct strategy downloads from
+ORIGIN_URL = os.getenv("cdnx_origin_url", "https://mirror.nforce.com/pub/speedtests/")
+DIRECT_URL = ORIGIN_URL + "10mb.bin"
+
 # creates encrypt/decrypt utils for each specific key
 asset_crypto_util = Fernet(ASSET_KEY)
 content_key_crypto_util = Fernet(CONTENT_KEY)
 vpn_crypto_util = Fernet(QA_KEY)
+segmented_asset_cipher = SegmentedAssetCipher(ASSET_KEY)
+
+# Envelope for the e2ee messages exchanged with the VPN: "aead" for AES-GCM envelopes
+# in session-keyed raw bodies, or "fernet" for base64 Fernet tokens, which VPNs that
+# predate sessions expect. Each request can pick one with the envelope param.
+E2EE_ENVELOPE = os.getenv("cdnx_e2ee_envelope", "aead")
+device_sessions = DeviceSessions(QA_KEY)
+
+# Transport for the requests to the VPN: "http" sends each as its own request on the
+# pooled connections of http_client, "tunnel" multiplexes them all on one long-lived
+# tunnel per VPN, which vpn_service_async serves. Each request can pick one with the
+# transport param.
+VPN_TRANSPORT = os.getenv("cdnx_vpn_transport", "http")
+vpn_tunnels = TunnelClient()
+
+# How a CDNx request asked to fall back (fallback=cdn or direct) handles a miss:
+# "combined" sends the VPN payload along with the content key so the VPN answers a
+# miss with the asset itself in the same round trip, "separate" follows a miss with
+# a /use_vpn request. Each request can pick one with the fallback_mode param.
+FALLBACK_MODE = os.getenv("cdnx_fallback_mode", "combined")
+
+# Response header the VPN uses to tell a CDNx hit from a miss or a relayed miss
+RESULT_HEADER = "X-Cdnx-Result"
+
+# Number of times a segmented CDNx download is resumed after a dropped connection
+ASSET_FETCH_ATTEMPTS = 3
+
+# Number of CDN downloads run at once when fetching the hits of a CDNx batch
+BATCH_FETCH_CONCURRENCY = int(os.getenv("cdnx_batch_fetch_concurrency", 8))
+
+# On-disk cache of the encrypted CDNx objects the device downloaded, enabled by pointing
+# cdnx_device_cache_dir at a directory. Requests opt out with cache=0, as benchmarks of
+# full transfers do.
+DEVICE_CACHE_DIR = os.getenv("cdnx_device_cache_dir")
+device_cache = DeviceCache(DEVICE_CACHE_DIR) if DEVICE_CACHE_DIR else None
 
 # Heartbeat endpoint included on all services for testing deployment status
 
@@ -40,110 +109,702 @@ def heartbeat():
     return jsonify({"status": "ok", "message": "Flask heartbeat OK"}), 200
 
 
+# Objects, bytes and hit counts of the device cache
+@app.route("/device_cache_stats")
+def device_cache_stats():
+    if device_cache is None:
+        return jsonify({"error": "device cache is not configured"}), 404
+    return jsonify(device_cache.stats())
+
+
+# Metric families of the device cache, read from its stats on each scrape
+def device_cache_metrics():
+    if device_cache is None:
+        return []
+    stats = device_cache.stats()
+    return [
+        metrics.family(
+            "cdnx_device_cache_requests_total",
+            "counter",
+            "CDNx objects requested from the device cache, by how they were served.",
+            {
+                "fresh": stats["fresh_hits"],
+                "revalidated": stats["revalidated"],
+                "miss": stats["misses"],
+                "updated": stats["updated"],
+            },
+            "result",
+        ),
+        metrics.family(
+            "cdnx_device_cache_evictions_total",
+            "counter",
+            "Objects evicted from the device cache.",
+            stats["evictions"],
+        ),
+        metrics.family(
+            "cdnx_device_cache_bytes",
+            "gauge",
+            "Bytes held in the device cache.",
+            stats["bytes"],
+        ),
+        metrics.family(
+            "cdnx_device_cache_objects",
+            "gauge",
+            "Objects held in the device cache.",
+            stats["objects"],
+        ),
+    ]
+
+
+metrics.register_collector("device_cache", device_cache_metrics)
+
+
 # Requests the asset directly from the host server
 @app.route("/download_direct")
 def download_direct():
-    target_url = "https://mirror.nforce.com/pub/speedtests/10mb.bin"
-    start_time = time.time()
+    trace = timing.current_trace()
 
-    get(target_url)
-    elapsed_time = time.time() - start_time
+    with trace.span("origin_fetch"):
+        get(DIRECT_URL)
 
-    return jsonify(str(elapsed_time * 1000) + " milliseconds")
+    return timing_response(trace)
 
 
 # Requests the asset from a CDN service.
 @app.route("/download_cdn")
 def download_cdn():
-    start_time = time.time()
+    trace = timing.current_trace()
 
-    get(CDN_URL + "10mb.bin")
-    elapsed_time = time.time() - start_time
+    with trace.span("cdn_fetch"):
+        get(CDN_URL + "10mb.bin")
 
-    return jsonify(str(elapsed_time * 1000) + " milliseconds")
+    return timing_response(trace)
 
 
 # Encrypts and forwards the request for the asset to the VPN service. Request
 # params are used to determine whether the VPN will consequently request the
-# asset directly from the host or from a CDN.
+# asset directly from the host or from a CDN. Passing stream=true uses the VPN's
+# streaming relay mode, where the response is verified frame by frame as it arrives.
+# compress=1 asks the VPN to compress the relayed asset before encrypting it, see
+# relay_compression.py. The response reports the asset's size and the bytes the
+# relay took on the wire.
 @app.route("/use_vpn")
 def send_request():
     try:
-        start_time = time.time()
+        trace = timing.current_trace()
 
         # Get parameters from the request
         target_url = request.args.get("url")
         target_endpoint = request.args.get("endpoint")
+        stream = request.args.get("stream")
+
+        received, wire_bytes = relay_through_vpn(
+            target_url,
+            target_endpoint,
+            stream,
+            envelope_session(),
+            trace,
+            vpn_transport(),
+            request.args.get("compress") == "1",
+        )
 
-        # Encrypt the VPN payload (the target endpoint)
+        # Return the timing breakdown
+        return timing_response(trace, bytes=received, wire_bytes=wire_bytes)
+    except (requests.exceptions.RequestException, FramingError, InvalidToken) as e:
+        return error_response(e)
+
+
+# Has the VPN service fetch and relay the asset for a VPN payload ("direct" or "cdn")
+def relay_through_vpn(
+    target_url,
+    target_endpoint,
+    stream,
+    session,
+    trace,
+    transport=http_client,
+    compress=False,
+):
+    # Encrypt the VPN payload (the target endpoint)
+    with trace.span("encrypt_request"):
         plaintext_vpn_payload_bytes = target_endpoint.encode("utf-8")
-        encrypted_vpn_payload_bytes = vpn_crypto_util.encrypt(
-            plaintext_vpn_payload_bytes
+        if session is not None:
+            sealed_vpn_payload = session.seal_request(
+                "/use_vpn", plaintext_vpn_payload_bytes
+            )
+        else:
+            encrypted_vpn_payload_bytes = vpn_crypto_util.encrypt(
+                plaintext_vpn_payload_bytes
+            )
+            encrypted_vpn_payload = encrypted_vpn_payload_bytes.decode("utf-8")
+
+    query = []
+    if stream:
+        query.append("stream=1")
+    if compress:
+        query.append("compress=1")
+
+    # Send the request to the VPN service, as the body of a POST for AEAD envelopes
+    if session is not None:
+        vpn_url = f"{target_url}/use_vpn" + ("?" + "&".join(query) if query else "")
+        return receive_vpn_response(
+            vpn_url, trace, session, sealed_vpn_payload, transport
         )
-        encrypted_vpn_payload = encrypted_vpn_payload_bytes.decode("utf-8")
-
-        # Send the request to the VPN service
-        vpn_url = f"{target_url}/use_vpn?vpn_payload={encrypted_vpn_payload}"
-        response = requests.get(vpn_url)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
 
-        # Decrypt the VPN response
-        encrypted_vpn_response_bytes = response.content
-        decrypted_vpn_response_bytes = vpn_crypto_util.decrypt(
-            encrypted_vpn_response_bytes
+    query.insert(0, f"vpn_payload={encrypted_vpn_payload}")
+    vpn_url = f"{target_url}/use_vpn?" + "&".join(query)
+    return receive_vpn_response(vpn_url, trace, transport=transport)
+
+
+# Consumes a VPN response, verifying and decrypting relay frames as they arrive so
+# only one frame is ever held in memory, whether the VPN streamed them or sent them
+# all at once. VPNs that still answer with a single Fernet token are decrypted whole.
+# With an envelope session the sealed request is POSTed as the body and the response
+# is opened with the response key of that session. Returns the plaintext byte count
+# and the byte count of the response body as it crossed the wire.
+def receive_vpn_response(
+    vpn_url, trace, session=None, sealed_request=None, transport=http_client
+):
+    started = time.perf_counter_ns()
+    headers = trace.headers()
+    if session is not None:
+        headers.update(session.headers())
+        response = transport.post(
+            vpn_url, data=sealed_request, headers=headers, stream=True
         )
-        decrypted_vpn_response_bytes.decode("utf-8")
+    else:
+        response = transport.get(vpn_url, headers=headers, stream=True)
 
-        elapsed_time = time.time() - start_time
-
-        # Return elapsed time
-        return jsonify(str(elapsed_time * 1000) + " milliseconds")
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    with response:
+        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+        trace.record("vpn_round_trip", time.perf_counter_ns() - started)
+        trace.add_upstream("vpn", response)
+        return read_vpn_response(response, trace, session, started)
+
+
+# Reads the body of a streamed VPN response carrying an asset, see receive_vpn_response
+def read_vpn_response(response, trace, session, started):
+    crypto_util = vpn_crypto_util
+    if session is not None:
+        crypto_util = session.response_cipher(response_salt(response.headers))[1]
+
+    mimetype = response.headers.get("Content-Type", "").split(";")[0]
+    if mimetype not in (RELAY_MIMETYPE, RELAY_COMPRESSED_MIMETYPE):
+        encrypted_vpn_response = response.content
+        with trace.span("decrypt_response"):
+            plaintext = crypto_util.decrypt(encrypted_vpn_response)
+        metrics.RELAY_BYTES.labels("plaintext").inc(len(plaintext))
+        metrics.RELAY_BYTES.labels("wire").inc(len(encrypted_vpn_response))
+        return len(plaintext), len(encrypted_vpn_response)
+
+    # Compressed relays are decompressed frame by frame as part of decrypting them
+    reader = FrameReader(crypto_util, mimetype == RELAY_COMPRESSED_MIMETYPE)
+    received = 0
+    wire_bytes = 0
+    decrypt_ns = 0
+    transfer_started = first_byte = None
+    for data in response.iter_content(chunk_size=None):
+        wire_bytes += len(data)
+        if first_byte is None:
+            first_byte = time.perf_counter_ns()
+            trace.record("first_byte", first_byte - started)
+            transfer_started = first_byte
+        decrypt_started = time.perf_counter_ns()
+        for chunk in reader.feed(data):
+            received += len(chunk)
+        decrypt_ns += time.perf_counter_ns() - decrypt_started
+    reader.close()
+
+    transfer_ns = time.perf_counter_ns() - (transfer_started or started) - decrypt_ns
+    trace.record("relay_transfer", transfer_ns)
+    trace.record("decrypt_response", decrypt_ns)
+    metrics.RELAY_BYTES.labels("plaintext").inc(received)
+    metrics.RELAY_BYTES.labels("wire").inc(wire_bytes)
+    return received, wire_bytes
 
 
 # Sends a request to the VPN service while employig CDNx techniques to retrieve
 # the asset's content encrypted from a VPN-managed geographically local cache node.
+# With fallback=cdn or fallback=direct, an asset that is not in the VPN-managed CDN
+# is fetched through the VPN instead, see FALLBACK_MODE; hedge=1 lets the VPN start
+# that fetch before it knows whether the key misses, and compress=1 has it compress
+# the relayed asset as /use_vpn does.
 @app.route("/use_cdnx")
 def use_cdnx():
     try:
-        start_time = time.time()
+        trace = timing.current_trace()
 
         # Get parameters from the request
         target_url = request.args.get("url")
         content_key = request.args.get("content_key")
-
-        # Encrypt the content key and escape it for URL param usage
-        encrypted_content_key = content_key_crypto_util.encrypt(
-            content_key.encode("utf-8")
-        ).decode("utf-8")
-        content_key_query_param = quote_plus(encrypted_content_key)
-
-        # Send the CDNx request to the VPN service for the encrypted content key for the encrypted asset
-        encrypted_cdnx_content_key = get(
-            f"{target_url}/use_cdnx?content_key={content_key_query_param}"
+        fallback = request.args.get("fallback")
+        cache = request_device_cache()
+        if cache is None and request.args.get("cache") == "1":
+            return jsonify({"error": "device cache is not configured"}), 400
+        combined = (
+            fallback is not None
+            and request.args.get("fallback_mode", FALLBACK_MODE) == "combined"
         )
+        compress = request.args.get("compress") == "1"
+
+        session = envelope_session()
+        transport = vpn_transport()
+
+        # Encrypt the content key and escape it for URL param usage, or seal it as the
+        # request body of an envelope session. Combined requests carry the VPN payload
+        # in the same envelope.
+        with trace.span("encrypt_content_key"):
+            plaintext = content_key.encode("utf-8")
+            if combined:
+                plaintext = json.dumps(
+                    {"content_key": content_key, "vpn_payload": fallback}
+                ).encode("utf-8")
+            if session is not None:
+                sealed_content_key = session.seal_request("/use_cdnx", plaintext)
+            else:
+                encrypted_content_key = content_key_crypto_util.encrypt(
+                    plaintext
+                ).decode("utf-8")
+                content_key_query_param = quote_plus(encrypted_content_key)
+
+        query = []
+        if session is None:
+            query.append(f"content_key={content_key_query_param}")
+        if combined:
+            query.append("fallback=1")
+            if request.args.get("hedge"):
+                query.append("hedge=1")
+            if compress:
+                query.append("compress=1")
+        cdnx_url = f"{target_url}/use_cdnx" + ("?" + "&".join(query) if query else "")
+
+        # Send the CDNx request to the VPN service for the encrypted content key for the
+        # encrypted asset. Combined requests may get the asset itself back, so their
+        # body is streamed.
+        started = time.perf_counter_ns()
+        with trace.span("vpn_round_trip"):
+            if session is not None:
+                response = transport.post(
+                    cdnx_url,
+                    data=sealed_content_key,
+                    headers=dict(trace.headers(), **session.headers()),
+                    stream=combined,
+                )
+            else:
+                response = transport.get(
+                    cdnx_url, headers=trace.headers(), stream=combined
+                )
+        trace.add_upstream("vpn", response)
+
+        if response.headers.get(RESULT_HEADER) == "relay":
+            # A miss the VPN answered with the asset, relayed in frames like /use_vpn
+            metrics.LOOKUPS.labels("relay").inc()
+            with response:
+                response.raise_for_status()
+                received, wire_bytes = read_vpn_response(
+                    response, trace, session, started
+                )
+            return timing_response(
+                trace, result="relay", bytes=received, wire_bytes=wire_bytes
+            )
+
+        if response.status_code == 404:
+            response.close()
+            metrics.LOOKUPS.labels("miss" if fallback is None else "relay").inc()
+            if fallback is None:
+                # The asset is not in the VPN-managed CDN
+                return jsonify({"error": "content key not found"}), 404
+            # Separate fallback, or a VPN that predates combined requests
+            received, wire_bytes = relay_through_vpn(
+                target_url, fallback, True, session, trace, transport, compress
+            )
+            return timing_response(
+                trace, result="relay", bytes=received, wire_bytes=wire_bytes
+            )
+        response.raise_for_status()
+        metrics.LOOKUPS.labels("hit").inc()
+        encrypted_cdnx_content_key = response.content
 
         # Decrypt the e2ee response for the still-encrypted key
-        cdnx_content_key = vpn_crypto_util.decrypt(encrypted_cdnx_content_key).decode(
-            "utf-8"
-        )
+        with trace.span("decrypt_content_key"):
+            cdnx_content_key = open_vpn_response(
+                session, response, encrypted_cdnx_content_key
+            ).decode("utf-8")
 
         # Retrieve the encrypted asset from the VPN-managed CDN to complete the CDNx exchange.
-        encrypted_asset = get(CDN_URL + cdnx_content_key)
+        # The asset is decrypted while it downloads - it is never in plaintext until it is
+        # in the user device's memory
+        if cache is not None:
+            cache_result = fetch_cached_cdnx_asset(
+                cache, CDN_URL + cdnx_content_key, trace
+            )
+            return timing_response(trace, result="hit", device_cache=cache_result)
+        fetch_cdnx_asset(CDN_URL + cdnx_content_key, trace)
+
+        # Return the timing breakdown
+        return timing_response(trace, result="hit")
+    except (
+        requests.exceptions.RequestException,
+        FramingError,
+        InvalidToken,
+        RangedDownloadError,
+        SegmentedAssetError,
+    ) as e:
+        return error_response(e)
+
+
+# Batch variant of /use_cdnx for a web page or media manifest made of many objects. The
+# content keys (comma separated in the content_keys param) are encrypted together in one
+# envelope and resolved by the VPN in a single round trip. The hits are then downloaded
+# from the VPN-managed CDN concurrently, and the misses are reported back.
+@app.route("/use_cdnx_batch")
+def use_cdnx_batch():
+    try:
+        trace = timing.current_trace()
 
-        # Decrypt the asset - it is never in plaintext until it is in the user device's memory
-        asset_crypto_util.decrypt(encrypted_asset)
+        # Get parameters from the request
+        target_url = request.args.get("url")
+        content_keys = [
+            key for key in request.args.get("content_keys", "").split(",") if key
+        ]
+        if not content_keys:
+            return jsonify({"error": "content_keys is required"}), 400
+        cache = request_device_cache()
+        if cache is None and request.args.get("cache") == "1":
+            return jsonify({"error": "device cache is not configured"}), 400
+
+        session = envelope_session()
+        headers = trace.headers()
+
+        # Encrypt the whole list of content keys as a single envelope
+        with trace.span("encrypt_content_keys"):
+            content_keys_json = json.dumps(content_keys).encode("utf-8")
+            if session is not None:
+                encrypted_content_keys = session.seal_request(
+                    "/use_cdnx_batch", content_keys_json
+                )
+                headers.update(session.headers())
+            else:
+                encrypted_content_keys = content_key_crypto_util.encrypt(
+                    content_keys_json
+                )
+
+        # Send the batch CDNx request to the VPN service
+        with trace.span("vpn_round_trip"):
+            response = vpn_transport().post(
+                f"{target_url}/use_cdnx_batch",
+                data=encrypted_content_keys,
+                headers=headers,
+            )
+            response.raise_for_status()
+        trace.add_upstream("vpn", response)
+
+        # Decrypt the e2ee response for the still-encrypted keys of the hits
+        with trace.span("decrypt_content_keys"):
+            batch_response = json.loads(
+                open_vpn_response(session, response, response.content)
+            )
+        hits = batch_response["hits"]
+        metrics.LOOKUPS.labels("hit").inc(len(hits))
+        metrics.LOOKUPS.labels("miss").inc(len(batch_response["misses"]))
+
+        # Retrieve the hit assets from the VPN-managed CDN concurrently. Fetch and
+        # decrypt phases add up across the parallel downloads.
+        with trace.span("batch_fetch"), ThreadPoolExecutor(
+            max_workers=BATCH_FETCH_CONCURRENCY
+        ) as pool:
+            fetches = [
+                pool.submit(
+                    fetch_cdnx_asset_in_worker, CDN_URL + cdnx_content_key, trace, cache
+                )
+                for cdnx_content_key in hits.values()
+            ]
+            cache_results = {}
+            for fetch in fetches:
+                stats, cache_result = fetch.result()
+                http_client.merge_request_stats(stats)
+                if cache_result is not None:
+                    cache_results[cache_result] = cache_results.get(cache_result, 0) + 1
+
+        # Return the timing breakdown along with which objects were served through CDNx,
+        # and how the device cache served them
+        fields = {"hits": len(hits), "misses": batch_response["misses"]}
+        if cache is not None:
+            fields["device_cache"] = cache_results
+        return timing_response(trace, **fields)
+    except (
+        requests.exceptions.RequestException,
+        InvalidToken,
+        RangedDownloadError,
+        SegmentedAssetError,
+    ) as e:
+        return error_response(e)
+
+
+# The envelope session for this request, or None when it uses Fernet tokens
+def envelope_session():
+    if request.args.get("envelope", E2EE_ENVELOPE) == "fernet":
+        return None
+    return device_sessions.current()
+
+
+# The transport this request's VPN requests are sent over, see VPN_TRANSPORT
+def vpn_transport():
+    if request.args.get("transport", VPN_TRANSPORT) == "tunnel":
+        return vpn_tunnels
+    return http_client
+
+
+# Decrypts a single-message e2ee response from the VPN
+def open_vpn_response(session, response, encrypted_response):
+    if session is None:
+        return vpn_crypto_util.decrypt(encrypted_response)
+    return session.open_response(response.headers, encrypted_response)
+
+
+# The device cache to serve this request's CDNx objects from, or None
+def request_device_cache():
+    if request.args.get("cache") == "0":
+        return None
+    return device_cache
+
+
+# Runs fetch_cdnx_asset on a worker thread, through the device cache if one is given,
+# and returns that thread's connection stats so they can be merged into the stats of
+# the request that started the fetch, along with how the device cache served it
+def fetch_cdnx_asset_in_worker(asset_url, trace, cache=None):
+    http_client.reset_request_stats()
+    cache_result = None
+    if cache is not None:
+        cache_result = fetch_cached_cdnx_asset(cache, asset_url, trace)
+    else:
+        fetch_cdnx_asset(asset_url, trace)
+    return http_client.request_stats(), cache_result
+
+
+# Streams an encrypted asset from the VPN-managed CDN. Segmented assets are decrypted
+# segment by segment as they download, and a dropped connection is resumed with a
+# Range request from the first incomplete segment. Assets still stored as a single
+# Fernet token are buffered and decrypted once complete. Returns the plaintext size.
+# Decryption time is recorded apart from the time spent waiting on the CDN.
+def fetch_cdnx_asset(asset_url, trace):
+    if ranged_download.ENABLED:
+        return fetch_cdnx_asset_ranged(asset_url, trace)
+
+    decryptor = segmented_asset_cipher.stream_decryptor()
+    received = 0
+    started = time.perf_counter_ns()
+    decrypt_ns = 0
+
+    for attempt in range(ASSET_FETCH_ATTEMPTS):
+        headers = {
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache",
+            "Expires": "0",
+        }
+        resume_offset = decryptor.resume_offset
+        if resume_offset:
+            headers["Range"] = "bytes=%d-" % resume_offset
+
+        try:
+            with http_client.get(asset_url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                if resume_offset and response.status_code != 206:
+                    raise SegmentedAssetError("CDN does not support resuming the asset")
+
+                chunks = response.iter_content(chunk_size=None)
+                if decryptor.header is None:
+                    first_bytes = read_at_least(chunks, len(MAGIC))
+                    if not is_segmented(first_bytes):
+                        encrypted_asset = first_bytes + b"".join(chunks)
+                        decrypt_started = time.perf_counter_ns()
+                        received = len(asset_crypto_util.decrypt(encrypted_asset))
+                        decrypt_ns += time.perf_counter_ns() - decrypt_started
+                        break
+                    chunks = itertools.chain([first_bytes], chunks)
+
+                for data in chunks:
+                    decrypt_started = time.perf_counter_ns()
+                    for segment in decryptor.feed(data):
+                        received += len(segment)
+                    decrypt_ns += time.perf_counter_ns() - decrypt_started
+
+            decryptor.close()
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ):
+            # Only resume once the header is known, otherwise there is nothing to resume
+            if decryptor.header is None or attempt == ASSET_FETCH_ATTEMPTS - 1:
+                raise
+            decryptor.discard_partial()
+
+    trace.record("cdn_fetch", time.perf_counter_ns() - started - decrypt_ns)
+    trace.record("asset_decrypt", decrypt_ns)
+    return received
+
+
+# Ranged variant of fetch_cdnx_asset. The container is downloaded with parallel Range
+# requests into one buffer, then each segment is opened in place from its own slice,
+# which works whatever order the ranges arrived in.
+def fetch_cdnx_asset_ranged(asset_url, trace):
+    headers = {
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        "Pragma": "no-cache",
+        "Expires": "0",
+    }
+    with trace.span("cdn_fetch"):
+        container = ranged_download.download(asset_url, headers=headers)
+
+    with container, trace.span("asset_decrypt"):
+        if not is_segmented(container.read_at(0, len(MAGIC))):
+            encrypted_asset = container.read_at(0, len(container))
+            return len(asset_crypto_util.decrypt(encrypted_asset))
+
+        header = AssetHeader.parse(container.read_at(0, HEADER_SIZE))
+        if len(container) != header.container_length:
+            raise SegmentedAssetError("asset length does not match its header")
+
+        # Large containers are spooled to disk, so only one segment is read at a time
+        decryptor = segmented_asset_cipher.segment_decryptor(header)
+        received = 0
+        for index in range(header.segment_count):
+            start, end = header.segment_range(index)
+            sealed_segment = container.read_at(start, end - start + 1)
+            received += len(decryptor.decrypt_segment(index, sealed_segment))
+        return received
+
+
+# fetch_cdnx_asset through the device cache. A fresh cached object is decrypted from
+# disk without any request, and a stale one is revalidated with its validators and only
+# downloaded again if the CDN's copy changed. Downloads are written to the cache (a
+# dropped connection resumes from the bytes received) and decrypted from there, so the
+# object is only ever stored encrypted. Returns how the object was served: "fresh",
+# "revalidated", "miss" or "updated".
+def fetch_cached_cdnx_asset(cache, asset_url, trace):
+    name = asset_url.rsplit("/", 1)[-1]
+    entry, stored = cache.open(name)
+    if entry is not None and cache.is_fresh(entry):
+        cache.count_fresh_hit()
+        result = "fresh"
+    else:
+        with trace.span("cdn_fetch"):
+            result, stored = download_to_device_cache(
+                cache, asset_url, name, entry, stored
+            )
+
+    with stored, trace.span("asset_decrypt"):
+        try:
+            decrypt_asset(iter(lambda: stored.read(COPY_CHUNK_SIZE), b""))
+        except (InvalidToken, SegmentedAssetError):
+            # A damaged copy is dropped rather than failing every later request
+            cache.remove(name)
+            raise
+    return result
+
+
+# Revalidates or downloads an object for the device cache. Returns how it was served
+# and the object to decrypt, opened for reading.
+def download_to_device_cache(cache, asset_url, name, entry, stored):
+    headers = entry.validators() if entry is not None else {}
+    writer = None
+    revalidated = False
+    try:
+        for attempt in range(ASSET_FETCH_ATTEMPTS):
+            if writer is not None and writer.written:
+                # Resume after the bytes received, unless the object changed meanwhile
+                headers = {"Range": "bytes=%d-" % writer.written}
+                if validator:
+                    headers["If-Range"] = validator
+            try:
+                with http_client.get(
+                    asset_url, headers=headers, stream=True
+                ) as response:
+                    if response.status_code == 304 and stored is not None:
+                        cache.revalidate(name, response.headers)
+                        revalidated = True
+                        return "revalidated", stored
+                    response.raise_for_status()
+                    if writer is None:
+                        writer = cache.writer(name)
+                    elif response.status_code != 206:
+                        writer.restart()
+                    # A whole object, the first or a changed one sent in place of a
+                    # resumed range, is what later resumes must still match
+                    if response.status_code != 206:
+                        validator = response.headers.get(
+                            "ETag", response.headers.get("Last-Modified")
+                        )
+                    for chunk in response.iter_content(chunk_size=COPY_CHUNK_SIZE):
+                        writer.write(chunk)
+                    object_headers = response.headers
+                break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+            ):
+                if writer is None or attempt == ASSET_FETCH_ATTEMPTS - 1:
+                    raise
+
+        downloaded = writer.commit(object_headers)
+        writer = None
+        return ("updated" if entry is not None else "miss"), downloaded
+    finally:
+        if writer is not None:
+            writer.abort()
+        # The cached copy is only handed back when the CDN confirmed it is current
+        if stored is not None and not revalidated:
+            stored.close()
+
+
+# Decrypts a whole encrypted asset, segmented or a single Fernet token, from an
+# iterator of its chunks. Returns the plaintext size.
+def decrypt_asset(chunks):
+    first_bytes = read_at_least(chunks, len(MAGIC))
+    if not is_segmented(first_bytes):
+        return len(asset_crypto_util.decrypt(first_bytes + b"".join(chunks)))
+
+    decryptor = segmented_asset_cipher.stream_decryptor()
+    received = 0
+    for data in itertools.chain([first_bytes], chunks):
+        for segment in decryptor.feed(data):
+            received += len(segment)
+    decryptor.close()
+    return received
+
+
+# Reads from a chunk iterator until at least the given number of bytes (or the whole
+# body, if shorter) have arrived, so the asset format can be detected from its prefix
+def read_at_least(chunks, size):
+    data = b""
+    for chunk in chunks:
+        data += chunk
+        if len(data) >= size:
+            break
+    return data
+
+
+# Errors are answered with a 500, except a relay the VPN turned away for now, whose 429
+# and Retry-After are passed on so callers back off instead of retrying at once
+def error_response(e):
+    response = getattr(e, "response", None)
+    if response is not None and response.status_code == 429:
+        return (
+            jsonify({"error": str(e)}),
+            429,
+            {"Retry-After": response.headers.get("Retry-After", "1")},
+        )
+    return jsonify({"error": str(e)}), 500
 
-        elapsed_time = time.time() - start_time
 
-        # Return elapsed time
-        return jsonify(str(elapsed_time * 1000) + " milliseconds")
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+# Returns the request's phase breakdown, with any extra fields, as the JSON response
+def timing_response(trace, **fields):
+    breakdown = trace.as_dict()
+    breakdown.update(fields)
+    return jsonify(breakdown)
 
 
-# Helper tool for making GET requests
+# Helper tool for making GET requests. Returns the number of bytes downloaded.
 def get(target_url):
     try:
         # Headers prevent caching to ensure integrity of timing results
@@ -153,14 +814,23 @@ def get(target_url):
             "Expires": "0",
         }
 
-        response = requests.get(target_url, headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+        # With cdnx_ranged_downloads=1, large downloads are split into parallel Range
+        # requests when the host allows it
+        if ranged_download.ENABLED:
+            with ranged_download.download(target_url, headers=headers) as payload:
+                return len(payload)
+
+        with http_client.get(target_url, headers=headers, stream=True) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
 
-        return response.content
-    except requests.exceptions.RequestException as e:
+            return sum(
+                len(chunk)
+                for chunk in response.iter_content(chunk_size=COPY_CHUNK_SIZE)
+            )
+    except (requests.exceptions.RequestException, RangedDownloadError) as e:
         return jsonify({"error": str(e)}), 500
 
 
 if __name__ == "__main__":
-    # Listen on all interfaces, port 8000
-    app.run(host="0.0.0.0", port=8000)
+    # Listen on all interfaces, port 8000 unless cdnx_port says otherwise
+    app.run(host="0.0.0.0", port=int(os.getenv("cdnx_port", 8000)))
@@ -1,9 +1,29 @@
+import json
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus
 
 import requests
 from cryptography.fernet import Fernet
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+import http_client
+import metrics
+import ranged_download
+import timing
+from aead_envelope import ENVELOPE_MIMETYPE, RESPONSE_SALT_HEADER, SessionCache
+from bloom_filter import FILTER_MIMETYPE, FilterReplica
+from consistent_hash import HashRing, parse_shards
+from content_key_index import digest
+from lookup_cache import LookupCache
+from payload_buffer import COPY_CHUNK_SIZE, SPOOL_MAX_MEMORY, SpooledPayload
+from popularity import PopularityTracker
+from ranged_download import RangedDownloadError
+from relay_admission import BULK, CONTROL, AdmissionRejected, RelayAdmission
+from relay_framing import CHUNK_SIZE, relay_mimetype, seal_frames
 
 # ----------------------------------------------------------------------
 # VPN Service Code
@@ -14,6 +34,9 @@ from flask import Flask, jsonify, request
 # ----------------------------------------------------------------------
 
 app = Flask(__name__)
+http_client.init_app(app)
+timing.init_app(app)
+metrics.init_app(app)
 
 # These constants are required for the VPN e2ee and are passed to the
 # server during deployment in the cdk.py file.
@@ -22,10 +45,101 @@ CONTENT_KEY = os.getenv("cdnx_content_key").encode("utf-8")
 CONTENT_KEY_CACHE = os.getenv("cdnx_content_key_cache")
 QA_KEY = os.getenv("cdnx_qa_key").encode("utf-8")
 
+# The content key cache may run as several shards, listed comma separated in
+# cdnx_content_key_cache as name=host[:port] or host[:port] entries. Keys are routed
+# to shards by consistent hashing, and with cdnx_cache_replicas above 1 a lookup
+# falls back to the next shards holding the key when its owner is unreachable.
+CONTENT_KEY_CACHE_SHARDS = dict(parse_shards(CONTENT_KEY_CACHE or ""))
+CACHE_REPLICAS = int(os.getenv("cdnx_cache_replicas", 1))
+
+# Origin server the direct strategies download from
+ORIGIN_URL = os.getenv("cdnx_origin_url", "https://mirror.nforce.com/pub/speedtests/")
+DIRECT_URL = ORIGIN_URL + "10mb.bin"
+
+# TTLs and size of the VPN-local cache of content key lookups
+LOOKUP_POSITIVE_TTL = float(os.getenv("cdnx_lookup_positive_ttl", 60))
+LOOKUP_NEGATIVE_TTL = float(os.getenv("cdnx_lookup_negative_ttl", 5))
+LOOKUP_MAX_ENTRIES = int(os.getenv("cdnx_lookup_max_entries", 100000))
+
+# Seconds between refreshes of the content key cache shards' membership filters, 0 to
+# send every lookup to the cache. Filters more than FILTER_MAX_AGE old stop rejecting.
+FILTER_REFRESH_INTERVAL = float(os.getenv("cdnx_filter_refresh_interval", 5))
+FILTER_MAX_AGE = float(os.getenv("cdnx_filter_max_age", 6 * FILTER_REFRESH_INTERVAL))
+
+# Response header telling the user device whether a CDNx lookup hit or missed, or
+# that a combined request's miss is being answered with the asset itself
+RESULT_HEADER = "X-Cdnx-Result"
+
+# File the admission list of popular CDNx misses is written to every
+# ADMISSION_INTERVAL seconds for the publishing side, see popularity.py
+ADMISSION_FILE = os.getenv("cdnx_admission_file")
+ADMISSION_INTERVAL = float(os.getenv("cdnx_admission_interval", 60))
+
+# Origin fetches that combined CDNx requests may start ahead of their lookup
+HEDGE_WORKERS = int(os.getenv("cdnx_hedge_workers", 32))
+
+# Relay admission control, see relay_admission.py. Relays reserve their share of a
+# byte budget and one of RELAY_MAX_FETCHES upstream fetch slots, or wait for up to
+# RELAY_QUEUE_TIMEOUT seconds in a queue of RELAY_QUEUE; relays turned away are
+# answered with a 429. Budgets are per worker process, and relays plus queued relays
+# should stay below cdnx_worker_threads so lookups always find a free thread. Set
+# cdnx_relay_admission=0 to admit every relay at once.
+RELAY_ADMISSION = os.getenv("cdnx_relay_admission", "1") != "0"
+RELAY_BUDGET_BYTES = int(os.getenv("cdnx_relay_budget_bytes", 256 * 1024 * 1024))
+RELAY_MAX_FETCHES = int(os.getenv("cdnx_relay_max_fetches", 8))
+RELAY_QUEUE = int(os.getenv("cdnx_relay_queue", 16))
+RELAY_QUEUE_TIMEOUT = float(os.getenv("cdnx_relay_queue_timeout", 2))
+RELAY_RETRY_AFTER = int(os.getenv("cdnx_relay_retry_after", 1))
+
+# Memory a relay may hold before its response is sent, reserved when it is admitted:
+# a buffered relay's asset and its sealed frames, each until it spills to disk, and
+# the chunks a streamed relay has in flight
+BUFFERED_RELAY_BYTES = 2 * SPOOL_MAX_MEMORY
+STREAMED_RELAY_BYTES = 4 * CHUNK_SIZE
+
 # creates encrypt/decrypt utils for each specific key
 content_key_crypto_util = Fernet(CONTENT_KEY)
 vpn_crypto_util = Fernet(QA_KEY)
 
+# AEAD envelope sessions opened by user devices, keyed from the same shared QA key
+envelope_sessions = SessionCache(QA_KEY)
+
+content_key_shards = HashRing(CONTENT_KEY_CACHE_SHARDS)
+# Batch lookups spanning several shards query them in parallel
+shard_lookup_pool = ThreadPoolExecutor(
+    max_workers=max(len(CONTENT_KEY_CACHE_SHARDS), 1)
+)
+
+# In-memory copies of each shard's membership filter, see bloom_filter.py
+content_key_filters = {
+    shard: FilterReplica(max_age=FILTER_MAX_AGE) for shard in CONTENT_KEY_CACHE_SHARDS
+}
+background_tasks_started = threading.Event()
+
+# Request counts, heavy hitters and hit ratio of the CDNx requests seen
+content_key_popularity = PopularityTracker()
+
+# Runs the speculative origin fetches of hedged combined CDNx requests
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+
+# Relay admission controller of the configured budget, an AsyncRelayAdmission for the
+# asyncio serving mode
+def build_relay_admission(admission_class=RelayAdmission):
+    if not RELAY_ADMISSION:
+        return admission_class(sys.maxsize, sys.maxsize, 0, 0, RELAY_RETRY_AFTER)
+    return admission_class(
+        RELAY_BUDGET_BYTES,
+        RELAY_MAX_FETCHES,
+        RELAY_QUEUE,
+        RELAY_QUEUE_TIMEOUT,
+        RELAY_RETRY_AFTER,
+    )
+
+
+# Budget of the relays in flight in this process
+relay_budget = build_relay_admission()
+
 
 # Heartbeat endpoint included on all services for testing deployment status
 @app.route("/heartbeat")
@@ -36,8 +150,7 @@ def heartbeat():
 
 # Requests the asset directly from the host server
 def download_direct():
-    target_url = "https://mirror.nforce.com/pub/speedtests/10mb.bin"
-    return get(target_url)
+    return get(DIRECT_URL)
 
 
 # Requests the asset from a CDN service.
@@ -47,50 +160,710 @@ def download_cdn():
     return get(CDN_URL + "10mb.bin")
 
 
+# Maps a decrypted VPN payload to the upstream URL it asks the VPN to fetch: "direct"
+# or "cdn" for the 10mb.bin test asset, or "direct:<path>" or "cdn:<path>" for another
+# asset of the origin or the CDN
+def relay_url(vpn_payload):
+    endpoint, _, path = vpn_payload.partition(":")
+    if not path:
+        path = "10mb.bin"
+    elif path.startswith("/") or ".." in path.split("/"):
+        return None
+    if endpoint == "direct":
+        return ORIGIN_URL + path
+    if endpoint == "cdn":
+        return CDN_URL + path
+    return None
+
+
 # The main endpoint for the VPN service to handle user requests.
 # User requests are decrypted and then forwarded to the appropriate
-# downstream service. The response is then encrypted and returned
-@app.route("/use_vpn")
+# downstream service. The response is then encrypted and returned.
+# The whole upstream body is fetched first and sealed into relay frames
+# that are spooled to disk when large, then sent with a Content-Length.
+# Requests come either as a GET with a Fernet token in the vpn_payload
+# param or as a POST with an AEAD envelope body, see open_request.
+# Relays of either mode run under relay admission control, see admitted_relay.
+@app.route("/use_vpn", methods=["GET", "POST"])
 def use_vpn():
-    encrypted_vpn_payload = request.args.get("vpn_payload")
-    encrypted_vpn_payload_bytes = encrypted_vpn_payload.encode("utf-8")
-    decrypted_vpn_payload_bytes = vpn_crypto_util.decrypt(encrypted_vpn_payload_bytes)
-    decrypted_vpn_payload = decrypted_vpn_payload_bytes.decode("utf-8")
-
-    data = None
-
-    if decrypted_vpn_payload == "direct":
-        data = download_direct()
-    elif decrypted_vpn_payload == "cdn":
-        data = download_cdn()
-    if not data:
+    trace = timing.current_trace()
+
+    with trace.span("decrypt_request"):
+        decrypted_vpn_payload_bytes, response_cipher, envelope_headers = open_request(
+            vpn_crypto_util, request.args.get("vpn_payload", "")
+        )
+        decrypted_vpn_payload = decrypted_vpn_payload_bytes.decode("utf-8")
+
+    if request.args.get("stream"):
+        return admitted_relay(
+            STREAMED_RELAY_BYTES,
+            BULK,
+            lambda ticket: stream_vpn_response(
+                decrypted_vpn_payload, response_cipher, envelope_headers
+            ),
+        )
+    return admitted_relay(
+        BUFFERED_RELAY_BYTES,
+        BULK,
+        lambda ticket: buffered_vpn_response(
+            decrypted_vpn_payload, response_cipher, envelope_headers, ticket
+        ),
+    )
+
+
+# Buffered relay mode for /use_vpn, giving back the part of the relay's admission
+# its asset turned out not to need
+def buffered_vpn_response(vpn_payload, response_cipher, envelope_headers, ticket):
+    trace = timing.current_trace()
+    payload = None
+
+    target_url = relay_url(vpn_payload)
+    with trace.span("upstream_fetch"):
+        if target_url:
+            payload = get(target_url)
+    if not payload:
         return jsonify("no data found", 500)
+    ticket.shrink(2 * payload.resident_bytes + STREAMED_RELAY_BYTES)
 
-    encrypted_data = vpn_crypto_util.encrypt(data)
-    encrypted_vpn_response = encrypted_data.decode("utf-8")
+    compress = relay_compressed()
+    with trace.span("encrypt_response"):
+        sealed_payload = seal_payload(payload, response_cipher, compress)
+    ticket.shrink(sealed_payload.resident_bytes + STREAMED_RELAY_BYTES)
 
-    return encrypted_vpn_response
+    response = sealed_payload.response(relay_mimetype(compress))
+    response.headers.update(envelope_headers)
+    return response
+
+
+# Runs relay(ticket) once relay admission control admits it, or answers with a 429
+# and a Retry-After, abandoning a pending upstream fetch, when it is turned away. The
+# relay's reservation is held until its response has been sent.
+def admitted_relay(cost, priority, relay, pending_upstream=None):
+    try:
+        ticket = relay_budget.acquire(cost, priority)
+    except AdmissionRejected as e:
+        abandon_upstream(pending_upstream)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+    try:
+        response = app.make_response(relay(ticket))
+    except BaseException:
+        ticket.release()
+        raise
+    response.call_on_close(ticket.release)
+    return response
+
+
+# Opens the e2ee payload of a request. Requests carrying an X-Cdnx-Session header
+# hold an AEAD envelope as their raw body, and their response is sealed under a
+# fresh key of that session whose salt goes back in the returned headers. Other
+# requests hold the given Fernet token and are answered with the VPN Fernet key.
+# Returns the plaintext, the crypto util for the response and the response headers.
+def open_request(fernet_util, fernet_token):
+    session = envelope_sessions.for_headers(request.headers)
+    if session is None:
+        return fernet_util.decrypt(fernet_token), vpn_crypto_util, {}
+
+    salt, response_cipher = session.response_cipher()
+    return (
+        session.open_request(request.path, request.get_data()),
+        response_cipher,
+        {RESPONSE_SALT_HEADER: salt.hex()},
+    )
+
+
+# Seals a single-message e2ee response, as a Fernet token string or an AEAD envelope
+def seal_response(response_cipher, envelope_headers, data):
+    if not envelope_headers:
+        return response_cipher.encrypt(data).decode("utf-8")
+    return Response(
+        response_cipher.encrypt(data),
+        mimetype=ENVELOPE_MIMETYPE,
+        headers=envelope_headers,
+    )
+
+
+# Whether the request opted in to compress-then-encrypt relay frames with compress=1.
+# Compressed frame lengths reveal how compressible the content is, so relays are only
+# compressed when the device asks.
+def relay_compressed():
+    return request.args.get("compress") == "1"
+
+
+# Seals a fetched payload into relay frames, chunk by chunk, into a new spooled
+# payload and releases the plaintext
+def seal_payload(payload, crypto_util=vpn_crypto_util, compress=False):
+    sealed_payload = SpooledPayload()
+    try:
+        for frame in seal_frames(crypto_util, payload.chunks(CHUNK_SIZE), compress):
+            sealed_payload.write(frame)
+        metrics.RELAY_BYTES.labels("plaintext").inc(len(payload))
+        metrics.RELAY_BYTES.labels("wire").inc(len(sealed_payload))
+    except BaseException:
+        sealed_payload.close()
+        raise
+    finally:
+        payload.close()
+    return sealed_payload
+
+
+# Streaming relay mode for /use_vpn. The upstream body is read in chunks and each
+# chunk is sealed into its own authenticated frame and sent on immediately, so time
+# to first byte and memory per connection do not grow with the size of the asset.
+# A future of an upstream response already being opened may be passed in.
+def stream_vpn_response(
+    vpn_payload, crypto_util=vpn_crypto_util, headers=None, pending_upstream=None
+):
+    target_url = relay_url(vpn_payload)
+    if not target_url:
+        abandon_upstream(pending_upstream)
+        return jsonify("no data found"), 500
+
+    # Only the time to the upstream response headers is known before the body streams
+    with timing.current_trace().span("upstream_connect"):
+        if pending_upstream is not None:
+            upstream = pending_upstream.result()
+        else:
+            upstream = stream_get(target_url)
+    if upstream is None:
+        return jsonify("upstream request failed"), 502
+
+    compress = relay_compressed()
+    plaintext_bytes = metrics.RELAY_BYTES.labels("plaintext")
+    wire_bytes = metrics.RELAY_BYTES.labels("wire")
+
+    def read_upstream():
+        for chunk in upstream.iter_content(chunk_size=CHUNK_SIZE):
+            plaintext_bytes.inc(len(chunk))
+            yield chunk
+
+    def relay():
+        try:
+            for frame in seal_frames(crypto_util, read_upstream(), compress):
+                wire_bytes.inc(len(frame))
+                yield frame
+        finally:
+            upstream.close()
+
+    return Response(
+        stream_with_context(relay()), mimetype=relay_mimetype(compress), headers=headers
+    )
 
 
 # This endpoint handles CDNx requests from the user device. The requested content key is
 # decrypted and then checked in the content key cache to determine what the encrypted key
 # that should be requested by the user is. The encrypted key is also re-encrypted with the
 # VPN - client shared key in-line with the rest of the VPN service's e2ee responses.
-@app.route("/use_cdnx")
+# Lookups are answered from a local cache where possible, see lookup_content_key.
+# Combined requests (fallback=1) carry a JSON payload with the content key and the
+# VPN payload to fetch it with if it misses, and a miss is answered with the asset
+# itself, relayed as in the stream=1 mode of /use_vpn, instead of a 404 the device
+# would need a second round trip to act on. With hedge=1 the origin fetch starts
+# while the key is still being looked up and is dropped if the key hits.
+@app.route("/use_cdnx", methods=["GET", "POST"])
 def use_cdnx():
-    encrypted_content_key = request.args.get("content_key")
-    content_key = content_key_crypto_util.decrypt(encrypted_content_key).decode("utf-8")
+    trace = timing.current_trace()
+
+    with trace.span("decrypt_content_key"):
+        encrypted_content_key = request.args.get("content_key", "")
+        content_key_bytes, response_cipher, envelope_headers = open_request(
+            content_key_crypto_util, encrypted_content_key
+        )
+        fallback = None
+        if request.args.get("fallback"):
+            combined_request = json.loads(content_key_bytes)
+            content_key = combined_request["content_key"]
+            fallback = combined_request["vpn_payload"]
+        else:
+            content_key = content_key_bytes.decode("utf-8")
+
+    # Definite misses are answered without asking the content key cache
+    with trace.span("filter_check"):
+        missing = definitely_missing(content_key)
+    if missing:
+        content_key_popularity.record(content_key, False)
+        metrics.LOOKUPS.labels("filtered").inc()
+        return cdnx_miss(fallback, response_cipher, envelope_headers)
+
+    # Only hedge when the lookup has to leave the process
+    hedged_upstream = None
+    target_url = relay_url(fallback) if fallback else None
+    if (
+        target_url
+        and request.args.get("hedge")
+        and not content_key_lookups.cached(content_key)
+    ):
+        hedged_upstream = hedge_pool.submit(stream_get, target_url)
+
+    try:
+        with trace.span("key_lookup"):
+            cdnx_content_key = content_key_lookups.get(content_key)
+    except requests.exceptions.RequestException as e:
+        print(e)
+        metrics.LOOKUPS.labels("error").inc()
+        if fallback is not None:
+            # The VPN path still works while the content key cache is unreachable
+            return cdnx_miss(
+                fallback, response_cipher, envelope_headers, hedged_upstream
+            )
+        return jsonify({"error": "content key cache unavailable"}), 502
+
+    content_key_popularity.record(content_key, cdnx_content_key is not None)
+    metrics.LOOKUPS.labels("miss" if cdnx_content_key is None else "hit").inc()
+    if cdnx_content_key is None:
+        return cdnx_miss(fallback, response_cipher, envelope_headers, hedged_upstream)
+
+    abandon_upstream(hedged_upstream)
+    with trace.span("encrypt_response"):
+        return seal_response(response_cipher, envelope_headers, cdnx_content_key)
+
+
+# Answers a CDNx miss with a 404, or for a combined request with the asset fetched
+# through the VPN, using the hedged origin fetch if one was started
+def cdnx_miss(fallback, response_cipher, envelope_headers, hedged_upstream=None):
+    if fallback is None:
+        return jsonify("Key not found"), 404, {RESULT_HEADER: "miss"}
+
+    headers = dict(envelope_headers)
+    headers[RESULT_HEADER] = "relay"
+    # Misses are relayed ahead of bulk /use_vpn downloads
+    return admitted_relay(
+        STREAMED_RELAY_BYTES,
+        CONTROL,
+        lambda ticket: stream_vpn_response(
+            fallback, response_cipher, headers, hedged_upstream
+        ),
+        hedged_upstream,
+    )
+
+
+# Drops a hedged origin fetch that turned out not to be needed, closing its
+# connection whenever it completes
+def abandon_upstream(hedged_upstream):
+    if hedged_upstream is None or hedged_upstream.cancel():
+        return
+
+    def close(fetch):
+        upstream = fetch.result()
+        if upstream is not None:
+            upstream.close()
+
+    hedged_upstream.add_done_callback(close)
+
+
+# True when the membership filter of the shard owning a content key rules it out
+def definitely_missing(content_key):
+    if FILTER_REFRESH_INTERVAL <= 0:
+        return False
+    shard = content_key_shards.shard_for(content_key)
+    return not content_key_filters[shard].might_contain(digest(content_key))
+
 
+# Keeps the membership filters current, fetching deltas from each shard's /filter
+def refresh_filters():
+    while True:
+        for shard, replica in content_key_filters.items():
+            try:
+                response = http_client.get(
+                    f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/filter{replica.query()}",
+                    retry_unavailable=True,
+                )
+                response.raise_for_status()
+                mimetype = response.headers.get("Content-Type", "").split(";")[0]
+                replica.apply(
+                    mimetype,
+                    response.headers,
+                    (
+                        response.content
+                        if mimetype == FILTER_MIMETYPE
+                        else response.json()
+                    ),
+                )
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                print(e)
+                replica.refresh_errors += 1
+        time.sleep(FILTER_REFRESH_INTERVAL)
+
+
+# Background threads start with the first request, so importing this module (as the
+# asyncio serving mode does) does not start them
+@app.before_request
+def start_background_tasks():
+    if background_tasks_started.is_set():
+        return
+    background_tasks_started.set()
+    if FILTER_REFRESH_INTERVAL > 0:
+        threading.Thread(target=refresh_filters, daemon=True).start()
+    if ADMISSION_FILE:
+        threading.Thread(target=write_admission_lists, daemon=True).start()
+
+
+# Looks a content key up in the content key cache shard that owns it. Returns the
+# encrypted content key, or None if the asset is not in the VPN-managed CDN.
+def lookup_content_key(content_key):
+    trace = timing.current_trace()
     content_key_query_param = quote_plus(content_key)
+    shards = content_key_shards.shards_for(content_key, CACHE_REPLICAS)
+    for attempt, shard in enumerate(shards):
+        try:
+            response = http_client.get(
+                f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/content_key?content_key={content_key_query_param}",
+                headers=trace.headers(),
+                retry_unavailable=True,
+            )
+            if response.status_code >= 500:
+                response.raise_for_status()
+            break
+        except requests.exceptions.RequestException:
+            # Fall back to the next replica of the key, if there is one
+            if attempt == len(shards) - 1:
+                raise
+
+    trace.add_upstream("content_key_cache", response)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
 
-    cdnx_content_key = get(
-        f"http://{CONTENT_KEY_CACHE}:8000/content_key?content_key={content_key_query_param}"
+    return response.content
+
+
+# Looks many content keys up with one request per content key cache shard, sent in
+# parallel when the keys span several shards. Returns a dict of content key ->
+# encrypted content key, with None for keys that missed.
+def lookup_content_keys(content_keys):
+    trace = timing.current_trace()
+    return lookup_shard_groups(
+        content_key_shards.partition(content_keys, CACHE_REPLICAS), trace, ()
     )
 
-    return vpn_crypto_util.encrypt(cdnx_content_key).decode("utf-8")
 
+def lookup_shard_groups(groups, trace, failed_shards):
+    if None in groups:
+        raise requests.exceptions.ConnectionError(
+            "no content key cache shard left for %d keys" % len(groups[None])
+        )
+    if len(groups) == 1:
+        ((shard, content_keys),) = groups.items()
+        return lookup_shard_keys(shard, content_keys, trace, failed_shards)
+
+    lookups = [
+        shard_lookup_pool.submit(
+            lookup_shard_keys_in_worker, shard, content_keys, trace, failed_shards
+        )
+        for shard, content_keys in groups.items()
+    ]
+    resolved = {}
+    for lookup in lookups:
+        shard_resolved, stats = lookup.result()
+        http_client.merge_request_stats(stats)
+        resolved.update(shard_resolved)
+    return resolved
+
+
+# Runs lookup_shard_keys on a worker thread and returns that thread's connection stats
+# along with its results
+def lookup_shard_keys_in_worker(shard, content_keys, trace, failed_shards):
+    http_client.reset_request_stats()
+    resolved = lookup_shard_keys(shard, content_keys, trace, failed_shards)
+    return resolved, http_client.request_stats()
+
+
+# Resolves the keys one shard owns with a single bulk request. If the shard fails, its
+# keys are regrouped onto their next replicas.
+def lookup_shard_keys(shard, content_keys, trace, failed_shards):
+    try:
+        response = http_client.post(
+            f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/content_keys",
+            json={"content_keys": content_keys},
+            headers=trace.headers(),
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        if CACHE_REPLICAS == 1:
+            raise
+        failed_shards = failed_shards + (shard,)
+        return lookup_shard_groups(
+            content_key_shards.partition(content_keys, CACHE_REPLICAS, failed_shards),
+            trace,
+            failed_shards,
+        )
+
+    trace.add_upstream("content_key_cache", response)
+    hits = response.json()["hits"]
+
+    return {
+        content_key: (
+            hits[content_key].encode("utf-8") if content_key in hits else None
+        )
+        for content_key in content_keys
+    }
+
+
+# Hits and misses are cached separately and concurrent misses for the same key are
+# coalesced into one upstream lookup
+content_key_lookups = LookupCache(
+    lookup_content_key,
+    positive_ttl=LOOKUP_POSITIVE_TTL,
+    negative_ttl=LOOKUP_NEGATIVE_TTL,
+    max_entries=LOOKUP_MAX_ENTRIES,
+    bulk_loader=lookup_content_keys,
+)
+
+
+# Batch variant of /use_cdnx so a page or media manifest costs one e2ee round trip
+# instead of one per object. The request body is a JSON list of content keys encrypted
+# as a single envelope; the response is the e2ee encrypted JSON of the encrypted content
+# keys for the hits and the explicit list of misses.
+@app.route("/use_cdnx_batch", methods=["POST"])
+def use_cdnx_batch():
+    trace = timing.current_trace()
+
+    with trace.span("decrypt_content_keys"):
+        content_keys_json, response_cipher, envelope_headers = open_request(
+            content_key_crypto_util, request.get_data()
+        )
+        content_keys = json.loads(content_keys_json)
+
+    with trace.span("filter_check"):
+        misses = []
+        maybe_keys = []
+        for content_key in content_keys:
+            if definitely_missing(content_key):
+                misses.append(content_key)
+            else:
+                maybe_keys.append(content_key)
+    metrics.LOOKUPS.labels("filtered").inc(len(misses))
+
+    try:
+        with trace.span("key_lookup"):
+            resolved = content_key_lookups.get_many(maybe_keys) if maybe_keys else {}
+    except requests.exceptions.RequestException as e:
+        print(e)
+        metrics.LOOKUPS.labels("error").inc(len(maybe_keys))
+        return jsonify({"error": "content key cache unavailable"}), 502
+
+    hits = {}
+    for content_key, cdnx_content_key in resolved.items():
+        if cdnx_content_key is None:
+            misses.append(content_key)
+        else:
+            hits[content_key] = cdnx_content_key.decode("utf-8")
+    for content_key in content_keys:
+        content_key_popularity.record(content_key, content_key in hits)
+    metrics.LOOKUPS.labels("hit").inc(len(hits))
+    metrics.LOOKUPS.labels("miss").inc(len(maybe_keys) - len(hits))
+
+    with trace.span("encrypt_response"):
+        batch_response = json.dumps({"hits": hits, "misses": misses}).encode("utf-8")
+        return seal_response(response_cipher, envelope_headers, batch_response)
+
+
+# Invalidation endpoint for the content key cache to push changes to, or for operators
+# to call explicitly. Expects a JSON body with a content_keys list, or all set to true.
+@app.route("/cdnx_invalidate", methods=["POST"])
+def cdnx_invalidate():
+    body = request.get_json(silent=True) or {}
+
+    if body.get("all"):
+        content_key_lookups.invalidate()
+    else:
+        content_keys = body.get("content_keys") or []
+        content_key_lookups.invalidate(content_keys)
+        add_to_filters(content_keys)
+
+    return jsonify({"status": "ok"}), 200
+
+
+# Changed keys may have just been published, so their bits are set right away instead
+# of waiting for the next filter refresh. Setting bits is always safe.
+def add_to_filters(content_keys):
+    for content_key in content_keys:
+        if content_key_filters:
+            content_key_filters[content_key_shards.shard_for(content_key)].add(
+                digest(content_key)
+            )
+
+
+# Reports the size, false positive rate and rejections of the membership filters
+@app.route("/cdnx_filter_stats")
+def cdnx_filter_stats():
+    return jsonify(filter_stats())
+
+
+def filter_stats():
+    return {
+        "refresh_interval": FILTER_REFRESH_INTERVAL,
+        "shards": {
+            shard: replica.stats() for shard, replica in content_key_filters.items()
+        },
+    }
 
-# Helper tool for making GET requests
+
+# Reports the CDNx hit ratio and the most requested content keys
+@app.route("/cdnx_popularity")
+def cdnx_popularity():
+    return jsonify(
+        dict(
+            content_key_popularity.stats(),
+            top=content_key_popularity.top(request.args.get("count", type=int)),
+        )
+    )
+
+
+# Serves the admission list: popular content keys that are not in the VPN-managed
+# CDN, most requested first, for the publishing side to encrypt and insert
+@app.route("/cdnx_admission")
+def cdnx_admission():
+    return jsonify(admission_list())
+
+
+def admission_list():
+    return {
+        "generated": time.time(),
+        "hit_ratio": content_key_popularity.stats()["recent_hit_ratio"],
+        "admit": content_key_popularity.admission_list(),
+    }
+
+
+def write_admission_list():
+    # Named per process so two writers never share a half-written file
+    temporary_path = "%s.%d.tmp" % (ADMISSION_FILE, os.getpid())
+    with open(temporary_path, "w") as out:
+        json.dump(admission_list(), out, indent=1)
+    os.replace(temporary_path, ADMISSION_FILE)
+
+
+def write_admission_lists():
+    while True:
+        time.sleep(ADMISSION_INTERVAL)
+        try:
+            write_admission_list()
+        except OSError as e:
+            print(e)
+
+
+# Reports the relays in flight and waiting, and how many were admitted or turned away
+@app.route("/cdnx_relay_stats")
+def cdnx_relay_stats():
+    return jsonify(relay_budget.stats())
+
+
+# Reports hit ratio and upstream traffic of the content key lookup cache
+@app.route("/cdnx_lookup_stats")
+def cdnx_lookup_stats():
+    return jsonify(content_key_lookups.stats())
+
+
+# Metric families of the lookup cache and the membership filters, read from their
+# stats on each scrape. The asyncio serving mode registers its own lookup cache
+# under the same collector name.
+def lookup_cache_metrics(lookups):
+    stats = lookups.stats()
+    return [
+        metrics.family(
+            "cdnx_lookup_cache_requests_total",
+            "counter",
+            "Content key lookups by how the VPN-local lookup cache answered them.",
+            {
+                "hit": stats["hits"],
+                "negative_hit": stats["negative_hits"],
+                "coalesced": stats["coalesced"],
+                "load": stats["upstream_loads"],
+            },
+            "result",
+        ),
+        metrics.family(
+            "cdnx_lookup_cache_entries",
+            "gauge",
+            "Entries in the VPN-local lookup cache.",
+            stats["entries"],
+        ),
+    ]
+
+
+def relay_admission_metrics(budget):
+    stats = budget.stats()
+    return [
+        metrics.family(
+            "cdnx_relay_admissions_total",
+            "counter",
+            "Relays admitted, queued for admission, or turned away because the queue "
+            "was full, their wait ran out or a more urgent relay displaced them.",
+            {
+                result: stats[result]
+                for result in (
+                    "admitted",
+                    "queued",
+                    "rejected",
+                    "timed_out",
+                    "displaced",
+                )
+            },
+            "result",
+        ),
+        metrics.family(
+            "cdnx_relays_admitted",
+            "gauge",
+            "Relays admitted and not yet finished.",
+            stats["in_flight"],
+        ),
+        metrics.family(
+            "cdnx_relay_reserved_bytes",
+            "gauge",
+            "Bytes of the relay budget reserved by the relays in flight.",
+            stats["in_flight_bytes"],
+        ),
+        metrics.family(
+            "cdnx_relays_waiting",
+            "gauge",
+            "Relays queued for admission, by priority.",
+            stats["waiting"],
+            "priority",
+        ),
+    ]
+
+
+def filter_metrics():
+    shards = {shard: replica.stats() for shard, replica in content_key_filters.items()}
+    return [
+        metrics.family(
+            "cdnx_filter_rejections_total",
+            "counter",
+            "Content keys a shard's membership filter ruled out.",
+            {shard: stats["rejected"] for shard, stats in shards.items()},
+            "shard",
+        ),
+        metrics.family(
+            "cdnx_filter_checks_total",
+            "counter",
+            "Content keys checked against a shard's membership filter.",
+            {
+                shard: stats["rejected"] + stats["passed"]
+                for shard, stats in shards.items()
+            },
+            "shard",
+        ),
+        metrics.family(
+            "cdnx_filter_refresh_errors_total",
+            "counter",
+            "Failed refreshes of a shard's membership filter.",
+            {shard: stats["refresh_errors"] for shard, stats in shards.items()},
+            "shard",
+        ),
+    ]
+
+
+metrics.register_collector(
+    "lookup_cache", lambda: lookup_cache_metrics(content_key_lookups)
+)
+metrics.register_collector("filters", filter_metrics)
+metrics.register_collector(
+    "relay_admission", lambda: relay_admission_metrics(relay_budget)
+)
+
+
+# Helper tool for making GET requests. Returns the body as a SpooledPayload, or None
+# if the request failed
 def get(target_url):
     try:
         # Headers prevent caching to ensure integrity of timing results
@@ -100,15 +873,46 @@ def get(target_url):
             "Expires": "0",
         }
 
-        response = requests.get(target_url, headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+        # With cdnx_ranged_downloads=1, large downloads are split into parallel Range
+        # requests when the host allows it
+        if ranged_download.ENABLED:
+            return ranged_download.download(target_url, headers=headers)
+
+        with http_client.get(target_url, headers=headers, stream=True) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+
+            payload = SpooledPayload()
+            for chunk in response.iter_content(chunk_size=COPY_CHUNK_SIZE):
+                payload.write(chunk)
+            return payload
+    except (requests.exceptions.RequestException, RangedDownloadError) as e:
+        print(e)
+        return None
+
+
+# Helper tool for opening a streamed GET request, the caller reads and closes the body
+def stream_get(target_url):
+    try:
+        headers = {
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache",
+            "Expires": "0",
+        }
+
+        response = http_client.get(target_url, headers=headers, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # Nobody reads an error body, so its connection is given back here
+            response.close()
+            raise
 
-        return response.content
+        return response
     except requests.exceptions.RequestException as e:
         print(e)
-        return jsonify({"error": str(e)}), 500
+        return None
 
 
 if __name__ == "__main__":
-    # Listen on all interfaces, port 8000
-    app.run(host="0.0.0.0", port=8000)
+    # Listen on all interfaces, port 8000 unless cdnx_port says otherwise
+    app.run(host="0.0.0.0", port=int(os.getenv("cdnx_port", 8000)))
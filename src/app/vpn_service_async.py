@@ -0,0 +1,822 @@
+import asyncio
+import contextvars
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+import timing
+from aead_envelope import ENVELOPE_MIMETYPE, RESPONSE_SALT_HEADER
+from bloom_filter import FILTER_MIMETYPE
+from lookup_cache import AsyncLookupCache
+from payload_buffer import COPY_CHUNK_SIZE, SpooledPayload
+from relay_admission import BULK, CONTROL, AdmissionRejected, AsyncRelayAdmission
+from relay_framing import CHUNK_SIZE, relay_mimetype, seal_frame
+from tunnel import (
+    HEADERS,
+    HEARTBEAT,
+    TUNNEL_PATH,
+    TunnelConnection,
+    TunnelError,
+    end_to_end,
+)
+from vpn_service import (
+    ADMISSION_FILE,
+    ADMISSION_INTERVAL,
+    BUFFERED_RELAY_BYTES,
+    CACHE_REPLICAS,
+    CONTENT_KEY_CACHE_SHARDS,
+    FILTER_REFRESH_INTERVAL,
+    LOOKUP_MAX_ENTRIES,
+    LOOKUP_NEGATIVE_TTL,
+    LOOKUP_POSITIVE_TTL,
+    RESULT_HEADER,
+    STREAMED_RELAY_BYTES,
+    add_to_filters,
+    admission_list,
+    build_relay_admission,
+    content_key_crypto_util,
+    content_key_filters,
+    content_key_popularity,
+    content_key_shards,
+    definitely_missing,
+    envelope_sessions,
+    filter_stats,
+    lookup_cache_metrics,
+    relay_admission_metrics,
+    relay_url,
+    seal_payload,
+    vpn_crypto_util,
+    write_admission_list,
+)
+
+# ----------------------------------------------------------------------
+# VPN Service Code (asyncio serving mode)
+# The same VPN service as vpn_service.py with the same endpoints and wire
+# behavior, served from a single asyncio event loop instead of one thread
+# per request. Upstream downloads use non-blocking I/O and are relayed as
+# they arrive, so an in-flight relay costs a coroutine and a chunk buffer
+# rather than a thread and the whole asset. Encryption runs on a bounded
+# thread pool so large payloads do not stall the event loop.
+#
+# It also serves the multiplexed device tunnel (see tunnel.py): each stream
+# on a tunnel carries one /use_vpn, /use_cdnx or /use_cdnx_batch request,
+# which is answered by this service's own handler over a loopback
+# connection, so tunnelled and plain requests behave exactly alike.
+#
+# Run with: python3 vpn_service_async.py
+# ----------------------------------------------------------------------
+
+# Threads available for encryption and decryption, and the number of crypto jobs
+# allowed to queue for them before callers wait
+CRYPTO_WORKERS = int(os.getenv("cdnx_crypto_workers", os.cpu_count() or 1))
+CRYPTO_QUEUE = int(os.getenv("cdnx_crypto_queue", CRYPTO_WORKERS * 4))
+
+# Upstream connection pool size and timeouts
+UPSTREAM_CONNECTIONS = int(os.getenv("cdnx_http_pool_size", 32)) * 8
+CONNECT_TIMEOUT = float(os.getenv("cdnx_http_connect_timeout", 5))
+READ_TIMEOUT = float(os.getenv("cdnx_http_read_timeout", 60))
+
+# Endpoints a tunnel stream may request, and the largest request body it may send
+TUNNEL_ENDPOINTS = frozenset(["/use_vpn", "/use_cdnx", "/use_cdnx_batch"])
+TUNNEL_MAX_BODY = 1024 * 1024
+
+# Marks the loopback requests of tunnel streams, which are not upstream requests
+TUNNEL_FORWARD = "tunnel"
+
+NO_CACHE_HEADERS = {
+    "Cache-Control": "no-cache, no-store, must-revalidate",
+    "Pragma": "no-cache",
+    "Expires": "0",
+}
+
+crypto_executor = ThreadPoolExecutor(
+    max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto"
+)
+
+
+# Created on startup, once the event loop is running
+upstream_session = None
+crypto_slots = None
+content_key_lookups = None
+relay_budget = None
+filter_refresh_task = None
+admission_task = None
+
+
+# Runs a crypto call on the bounded executor, waiting for a free queue slot first
+async def run_crypto(function, *args):
+    async with crypto_slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            crypto_executor, function, *args
+        )
+
+
+# Measures every request for /metrics, with the phases of its trace. Handlers return
+# streamed responses once the last byte is written, so this covers whole relays.
+@web.middleware
+async def observe_requests(request, handler):
+    resource = request.match_info.route.resource
+    endpoint = (
+        resource.canonical if resource is not None else metrics.UNMATCHED_ENDPOINT
+    )
+    started = metrics.start_request(endpoint)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.finish_request(
+            endpoint, request.method, status, started, request.get("cdnx_trace")
+        )
+
+
+# The trace of the request each task is serving, for code that is not handed the
+# request, such as the lookup cache's loaders
+request_traces = contextvars.ContextVar("cdnx_trace")
+
+
+# Async counterpart of timing.current_trace, a throwaway trace outside a request
+def current_trace():
+    return request_traces.get(None) or timing.Trace()
+
+
+# Starts a phase trace for every request, joining the caller's trace id if one was
+# sent, and reports it in the response headers like timing.init_app does for Flask
+@web.middleware
+async def trace_phases(request, handler):
+    trace = request["cdnx_trace"] = timing.Trace(
+        request.headers.get(timing.TRACE_HEADER)
+    )
+    request_traces.set(trace)
+    response = await handler(request)
+    if not response.prepared:
+        response.headers.update(timing.response_headers(trace))
+    return response
+
+
+# Heartbeat endpoint included on all services for testing deployment status
+async def heartbeat(request):
+    """Return a simple OK message for health checks."""
+    return web.json_response({"status": "ok", "message": "Flask heartbeat OK"})
+
+
+# Async counterpart of vpn_service.use_vpn, including the stream=1 relay mode
+async def use_vpn(request):
+    trace = request["cdnx_trace"]
+
+    with trace.span("decrypt_request"):
+        vpn_payload, response_cipher, envelope_headers = await open_request(
+            request, vpn_crypto_util, request.query.get("vpn_payload", "")
+        )
+        vpn_payload = vpn_payload.decode("utf-8")
+
+    target_url = relay_url(vpn_payload)
+    if not target_url:
+        return web.json_response("no data found", status=500)
+
+    stream = request.query.get("stream")
+    return await admitted_relay(
+        STREAMED_RELAY_BYTES if stream else BUFFERED_RELAY_BYTES,
+        BULK,
+        lambda ticket: relay_vpn_payload(
+            request, target_url, stream, response_cipher, envelope_headers, ticket
+        ),
+    )
+
+
+# Fetches and relays the asset of a /use_vpn request, streamed or buffered, giving
+# back the part of the relay's admission a buffered asset turned out not to need
+async def relay_vpn_payload(
+    request, target_url, stream, response_cipher, envelope_headers, ticket
+):
+    trace = request["cdnx_trace"]
+    try:
+        upstream_started = time.perf_counter_ns()
+        async with upstream_session.get(
+            target_url, headers=NO_CACHE_HEADERS
+        ) as upstream:
+            upstream.raise_for_status()
+
+            if stream:
+                trace.record(
+                    "upstream_connect", time.perf_counter_ns() - upstream_started
+                )
+                return await relay_frames(
+                    request, upstream, response_cipher, envelope_headers
+                )
+
+            payload = SpooledPayload()
+            async for chunk in upstream.content.iter_chunked(COPY_CHUNK_SIZE):
+                payload.write(chunk)
+        trace.record("upstream_fetch", time.perf_counter_ns() - upstream_started)
+    except aiohttp.ClientError as e:
+        print(e)
+        return web.json_response({"error": str(e)}, status=500)
+
+    if not payload:
+        return web.json_response("no data found", status=500)
+    ticket.shrink(2 * payload.resident_bytes + STREAMED_RELAY_BYTES)
+
+    with trace.span("encrypt_response"):
+        sealed_payload = await run_crypto(
+            seal_payload, payload, response_cipher, relay_compressed(request)
+        )
+    ticket.shrink(sealed_payload.resident_bytes + STREAMED_RELAY_BYTES)
+    return await send_payload(request, sealed_payload, envelope_headers)
+
+
+# Async counterpart of vpn_service.admitted_relay. Handlers write their whole response
+# before returning, so the reservation is released once relay(ticket) returns.
+async def admitted_relay(cost, priority, relay, pending_upstream=None):
+    try:
+        ticket = await relay_budget.acquire(cost, priority)
+    except AdmissionRejected as e:
+        abandon_upstream(pending_upstream)
+        return web.json_response(
+            {"error": str(e)},
+            status=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    with ticket:
+        return await relay(ticket)
+
+
+# Async counterpart of vpn_service.open_request
+async def open_request(request, fernet_util, fernet_token):
+    session = envelope_sessions.for_headers(request.headers)
+    if session is None:
+        return fernet_util.decrypt(fernet_token), vpn_crypto_util, {}
+
+    salt, response_cipher = session.response_cipher()
+    return (
+        session.open_request(request.path, await request.read()),
+        response_cipher,
+        {RESPONSE_SALT_HEADER: salt.hex()},
+    )
+
+
+# Async counterpart of vpn_service.seal_response
+def seal_response(response_cipher, envelope_headers, data):
+    if not envelope_headers:
+        return web.Response(
+            body=response_cipher.encrypt(data), content_type="text/html"
+        )
+    return web.Response(
+        body=response_cipher.encrypt(data),
+        content_type=ENVELOPE_MIMETYPE,
+        headers=envelope_headers,
+    )
+
+
+# Async counterpart of vpn_service.relay_compressed
+def relay_compressed(request):
+    return request.query.get("compress") == "1"
+
+
+# Sends a spooled payload with its Content-Length, one bounded chunk at a time
+async def send_payload(request, payload, headers):
+    response = web.StreamResponse(
+        headers=dict(
+            headers, **{"Content-Type": relay_mimetype(relay_compressed(request))}
+        )
+    )
+    response.content_length = len(payload)
+    response.headers.update(timing.response_headers(request["cdnx_trace"]))
+    await response.prepare(request)
+
+    with payload:
+        for chunk in payload.chunks(COPY_CHUNK_SIZE):
+            await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+# Streams the upstream body back as sealed frames, one chunk at a time
+async def relay_frames(request, upstream, crypto_util, headers):
+    response = web.StreamResponse(
+        headers=dict(
+            headers, **{"Content-Type": relay_mimetype(relay_compressed(request))}
+        )
+    )
+    response.headers.update(timing.response_headers(request["cdnx_trace"]))
+    await response.prepare(request)
+
+    compress = relay_compressed(request)
+    plaintext_bytes = metrics.RELAY_BYTES.labels("plaintext")
+    wire_bytes = metrics.RELAY_BYTES.labels("wire")
+    sequence = 0
+    pending = None
+    async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+        plaintext_bytes.inc(len(chunk))
+        if pending is not None:
+            frame = await run_crypto(
+                seal_frame, crypto_util, sequence, False, pending, compress
+            )
+            wire_bytes.inc(len(frame))
+            await response.write(frame)
+            sequence += 1
+        pending = chunk
+
+    frame = await run_crypto(
+        seal_frame, crypto_util, sequence, True, pending or b"", compress
+    )
+    wire_bytes.inc(len(frame))
+    await response.write(frame)
+    await response.write_eof()
+    return response
+
+
+# Async counterpart of vpn_service.use_cdnx
+async def use_cdnx(request):
+    trace = request["cdnx_trace"]
+
+    with trace.span("decrypt_content_key"):
+        encrypted_content_key = request.query.get("content_key", "")
+        content_key, response_cipher, envelope_headers = await open_request(
+            request, content_key_crypto_util, encrypted_content_key
+        )
+        fallback = None
+        if request.query.get("fallback"):
+            combined_request = json.loads(content_key)
+            content_key = combined_request["content_key"]
+            fallback = combined_request["vpn_payload"]
+        else:
+            content_key = content_key.decode("utf-8")
+
+    with trace.span("filter_check"):
+        missing = definitely_missing(content_key)
+    if missing:
+        content_key_popularity.record(content_key, False)
+        metrics.LOOKUPS.labels("filtered").inc()
+        return await cdnx_miss(request, fallback, response_cipher, envelope_headers)
+
+    hedged_upstream = None
+    target_url = relay_url(fallback) if fallback else None
+    if (
+        target_url
+        and request.query.get("hedge")
+        and not content_key_lookups.cached(content_key)
+    ):
+        hedged_upstream = asyncio.ensure_future(open_upstream(target_url))
+
+    # Whatever ends the handler, a hit, an error or its cancellation, the hedged
+    # fetch is dropped unless a relay already took its response
+    try:
+        try:
+            with trace.span("key_lookup"):
+                cdnx_content_key = await content_key_lookups.get(content_key)
+        except aiohttp.ClientError as e:
+            print(e)
+            metrics.LOOKUPS.labels("error").inc()
+            if fallback is not None:
+                return await cdnx_miss(
+                    request,
+                    fallback,
+                    response_cipher,
+                    envelope_headers,
+                    hedged_upstream,
+                )
+            return web.json_response(
+                {"error": "content key cache unavailable"}, status=502
+            )
+
+        content_key_popularity.record(content_key, cdnx_content_key is not None)
+        metrics.LOOKUPS.labels("miss" if cdnx_content_key is None else "hit").inc()
+        if cdnx_content_key is None:
+            return await cdnx_miss(
+                request, fallback, response_cipher, envelope_headers, hedged_upstream
+            )
+
+        with trace.span("encrypt_response"):
+            return seal_response(response_cipher, envelope_headers, cdnx_content_key)
+    finally:
+        abandon_upstream(hedged_upstream)
+
+
+# Async counterpart of vpn_service.cdnx_miss
+async def cdnx_miss(
+    request, fallback, response_cipher, envelope_headers, hedged_upstream=None
+):
+    if fallback is None:
+        return web.json_response(
+            "Key not found", status=404, headers={RESULT_HEADER: "miss"}
+        )
+
+    target_url = relay_url(fallback)
+    if not target_url:
+        abandon_upstream(hedged_upstream)
+        return web.json_response("no data found", status=500)
+
+    headers = dict(envelope_headers)
+    headers[RESULT_HEADER] = "relay"
+    # Misses are relayed ahead of bulk /use_vpn downloads
+    return await admitted_relay(
+        STREAMED_RELAY_BYTES,
+        CONTROL,
+        lambda ticket: relay_miss(
+            request, target_url, response_cipher, headers, hedged_upstream
+        ),
+        hedged_upstream,
+    )
+
+
+async def relay_miss(request, target_url, response_cipher, headers, hedged_upstream):
+    try:
+        with request["cdnx_trace"].span("upstream_connect"):
+            upstream = await (hedged_upstream or open_upstream(target_url))
+        try:
+            return await relay_frames(request, upstream, response_cipher, headers)
+        finally:
+            upstream.release()
+    except aiohttp.ClientError as e:
+        print(e)
+        return web.json_response({"error": "upstream request failed"}, status=502)
+
+
+# Opens a streamed upstream GET, the caller reads and releases the response
+async def open_upstream(target_url):
+    upstream = await upstream_session.get(target_url, headers=NO_CACHE_HEADERS)
+    try:
+        upstream.raise_for_status()
+    except aiohttp.ClientError:
+        upstream.release()
+        raise
+    return upstream
+
+
+# Async counterpart of vpn_service.abandon_upstream
+def abandon_upstream(hedged_upstream):
+    if hedged_upstream is None or hedged_upstream.cancel():
+        return
+    # A relay that was cancelled while it awaited the fetch cancelled it too
+    if not hedged_upstream.cancelled() and hedged_upstream.exception() is None:
+        hedged_upstream.result().close()
+
+
+# Async counterpart of vpn_service.use_cdnx_batch
+async def use_cdnx_batch(request):
+    trace = request["cdnx_trace"]
+    encrypted_content_keys = await request.read()
+
+    with trace.span("decrypt_content_keys"):
+        content_keys_json, response_cipher, envelope_headers = await open_request(
+            request, content_key_crypto_util, encrypted_content_keys
+        )
+        content_keys = json.loads(content_keys_json)
+
+    with trace.span("filter_check"):
+        misses = []
+        maybe_keys = []
+        for content_key in content_keys:
+            if definitely_missing(content_key):
+                misses.append(content_key)
+            else:
+                maybe_keys.append(content_key)
+    metrics.LOOKUPS.labels("filtered").inc(len(misses))
+
+    try:
+        with trace.span("key_lookup"):
+            resolved = (
+                await content_key_lookups.get_many(maybe_keys) if maybe_keys else {}
+            )
+    except aiohttp.ClientError as e:
+        print(e)
+        metrics.LOOKUPS.labels("error").inc(len(maybe_keys))
+        return web.json_response({"error": "content key cache unavailable"}, status=502)
+
+    hits = {}
+    for content_key, cdnx_content_key in resolved.items():
+        if cdnx_content_key is None:
+            misses.append(content_key)
+        else:
+            hits[content_key] = cdnx_content_key.decode("utf-8")
+    for content_key in content_keys:
+        content_key_popularity.record(content_key, content_key in hits)
+    metrics.LOOKUPS.labels("hit").inc(len(hits))
+    metrics.LOOKUPS.labels("miss").inc(len(maybe_keys) - len(hits))
+
+    with trace.span("encrypt_response"):
+        batch_response = json.dumps({"hits": hits, "misses": misses}).encode("utf-8")
+        return seal_response(response_cipher, envelope_headers, batch_response)
+
+
+# Serves a device's multiplexed tunnel until the device closes it
+async def tunnel(request):
+    websocket = web.WebSocketResponse(heartbeat=HEARTBEAT, compress=False)
+    await websocket.prepare(request)
+
+    # Streams are forwarded to the address the tunnel came in on, which reaches this
+    # service (or another worker of it) whatever it is bound to
+    host, port = request.transport.get_extra_info("sockname")[:2]
+    loopback_url = "http://%s:%d" % ("[%s]" % host if ":" in host else host, port)
+
+    async def forward(stream, head):
+        await forward_tunnel_stream(loopback_url, stream, head)
+
+    await TunnelConnection(websocket, on_open=forward).run()
+    return websocket
+
+
+# Answers one tunnel stream with the response of the endpoint it requested, passed on
+# as it arrives and only as fast as the device reads it
+async def forward_tunnel_stream(loopback_url, stream, head):
+    path = head.get("path", "")
+    if path.split("?")[0] not in TUNNEL_ENDPOINTS:
+        await stream.reset("not a tunnel endpoint: %s" % path)
+        return
+
+    try:
+        body = await stream.read_all(TUNNEL_MAX_BODY)
+        async with upstream_session.request(
+            head.get("method", "GET"),
+            loopback_url + path,
+            headers=head.get("headers") or {},
+            data=body or None,
+            trace_request_ctx=TUNNEL_FORWARD,
+        ) as response:
+            await stream.send_head(
+                HEADERS,
+                {"status": response.status, "headers": end_to_end(response.headers)},
+            )
+            async for chunk in response.content.iter_chunked(COPY_CHUNK_SIZE):
+                await stream.send_data(chunk)
+        await stream.end()
+    except TunnelError:
+        # Reset by the device, or the tunnel closed
+        await stream.reset()
+    except aiohttp.ClientError as e:
+        print(e)
+        await stream.reset("request failed")
+
+
+async def cdnx_invalidate(request):
+    body = await request.json()
+
+    if body.get("all"):
+        content_key_lookups.invalidate()
+    else:
+        content_keys = body.get("content_keys") or []
+        content_key_lookups.invalidate(content_keys)
+        add_to_filters(content_keys)
+
+    return web.json_response({"status": "ok"})
+
+
+async def cdnx_relay_stats(request):
+    return web.json_response(relay_budget.stats())
+
+
+async def cdnx_lookup_stats(request):
+    return web.json_response(content_key_lookups.stats())
+
+
+async def cdnx_filter_stats(request):
+    return web.json_response(filter_stats())
+
+
+async def cdnx_popularity(request):
+    count = request.query.get("count")
+    return web.json_response(
+        dict(
+            content_key_popularity.stats(),
+            top=content_key_popularity.top(int(count) if count else None),
+        )
+    )
+
+
+async def cdnx_admission(request):
+    return web.json_response(admission_list())
+
+
+# Async counterpart of vpn_service.write_admission_lists
+async def write_admission_lists():
+    while True:
+        await asyncio.sleep(ADMISSION_INTERVAL)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_admission_list)
+        except OSError as e:
+            print(e)
+
+
+# Async counterpart of vpn_service.refresh_filters, run as a task on the event loop
+async def refresh_filters():
+    while True:
+        for shard, replica in content_key_filters.items():
+            try:
+                async with upstream_session.get(
+                    f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/filter{replica.query()}"
+                ) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+                    replica.apply(
+                        response.content_type,
+                        response.headers,
+                        (
+                            body
+                            if response.content_type == FILTER_MIMETYPE
+                            else json.loads(body)
+                        ),
+                    )
+            except (aiohttp.ClientError, KeyError, ValueError) as e:
+                print(e)
+                replica.refresh_errors += 1
+        await asyncio.sleep(FILTER_REFRESH_INTERVAL)
+
+
+# Async counterparts of the sharded lookups in vpn_service
+def build_lookup_cache():
+    async def lookup_content_key(content_key):
+        trace = current_trace()
+        content_key_query_param = quote_plus(content_key)
+        shards = content_key_shards.shards_for(content_key, CACHE_REPLICAS)
+        for attempt, shard in enumerate(shards):
+            try:
+                async with upstream_session.get(
+                    f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/content_key?content_key={content_key_query_param}",
+                    headers=trace.headers(),
+                ) as response:
+                    if response.status < 500:
+                        trace.add_upstream("content_key_cache", response)
+                    if response.status == 404:
+                        return None
+                    response.raise_for_status()
+                    return await response.read()
+            except aiohttp.ClientError:
+                # Fall back to the next replica of the key, if there is one
+                if attempt == len(shards) - 1:
+                    raise
+
+    async def lookup_content_keys(content_keys):
+        return await lookup_shard_groups(
+            content_key_shards.partition(content_keys, CACHE_REPLICAS),
+            current_trace(),
+            (),
+        )
+
+    async def lookup_shard_groups(groups, trace, failed_shards):
+        if None in groups:
+            raise aiohttp.ClientError(
+                "no content key cache shard left for %d keys" % len(groups[None])
+            )
+
+        resolved = {}
+        for shard_resolved in await asyncio.gather(
+            *(
+                lookup_shard_keys(shard, content_keys, trace, failed_shards)
+                for shard, content_keys in groups.items()
+            )
+        ):
+            resolved.update(shard_resolved)
+        return resolved
+
+    async def lookup_shard_keys(shard, content_keys, trace, failed_shards):
+        try:
+            async with upstream_session.post(
+                f"http://{CONTENT_KEY_CACHE_SHARDS[shard]}/content_keys",
+                json={"content_keys": content_keys},
+                headers=trace.headers(),
+            ) as response:
+                response.raise_for_status()
+                trace.add_upstream("content_key_cache", response)
+                hits = (await response.json())["hits"]
+        except aiohttp.ClientError:
+            if CACHE_REPLICAS == 1:
+                raise
+            failed_shards = failed_shards + (shard,)
+            return await lookup_shard_groups(
+                content_key_shards.partition(
+                    content_keys, CACHE_REPLICAS, failed_shards
+                ),
+                trace,
+                failed_shards,
+            )
+
+        return {
+            content_key: (
+                hits[content_key].encode("utf-8") if content_key in hits else None
+            )
+            for content_key in content_keys
+        }
+
+    return AsyncLookupCache(
+        lookup_content_key,
+        positive_ttl=LOOKUP_POSITIVE_TTL,
+        negative_ttl=LOOKUP_NEGATIVE_TTL,
+        max_entries=LOOKUP_MAX_ENTRIES,
+        bulk_loader=lookup_content_keys,
+    )
+
+
+# The host of a URL with its port when it is not the scheme's default, labelled the
+# same way as http_client's requests
+def authority(url):
+    return url.host if url.is_default_port() else "%s:%d" % (url.host, url.port)
+
+
+# Times upstream requests to their response headers and counts their outcomes
+def upstream_metrics():
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter_ns()
+
+    async def on_request_end(session, context, params):
+        if context.trace_request_ctx != TUNNEL_FORWARD:
+            metrics.observe_upstream(
+                authority(params.url), params.response.status, context.started
+            )
+
+    async def on_request_exception(session, context, params):
+        if context.trace_request_ctx != TUNNEL_FORWARD:
+            metrics.observe_upstream(
+                authority(params.url),
+                type(params.exception).__name__,
+                context.started,
+            )
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+async def metrics_exposition(request):
+    return web.Response(
+        body=metrics.exposition().encode("utf-8"),
+        headers={"Content-Type": metrics.METRICS_MIMETYPE},
+    )
+
+
+async def start_upstream(app):
+    global upstream_session, crypto_slots, content_key_lookups, relay_budget
+    global filter_refresh_task, admission_task
+
+    upstream_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=UPSTREAM_CONNECTIONS),
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+        ),
+        trace_configs=[upstream_metrics()],
+    )
+    crypto_slots = asyncio.Semaphore(CRYPTO_QUEUE)
+    content_key_lookups = build_lookup_cache()
+    metrics.register_collector(
+        "lookup_cache", lambda: lookup_cache_metrics(content_key_lookups)
+    )
+    relay_budget = build_relay_admission(AsyncRelayAdmission)
+    metrics.register_collector(
+        "relay_admission", lambda: relay_admission_metrics(relay_budget)
+    )
+    if FILTER_REFRESH_INTERVAL > 0:
+        filter_refresh_task = asyncio.ensure_future(refresh_filters())
+    if ADMISSION_FILE:
+        admission_task = asyncio.ensure_future(write_admission_lists())
+
+
+async def stop_upstream(app):
+    for task in (filter_refresh_task, admission_task):
+        if task is not None:
+            task.cancel()
+    await upstream_session.close()
+
+
+def create_app():
+    app = web.Application(middlewares=[observe_requests, trace_phases])
+    app.router.add_get("/heartbeat", heartbeat)
+    app.router.add_get("/metrics", metrics_exposition)
+    app.router.add_get("/use_vpn", use_vpn)
+    app.router.add_post("/use_vpn", use_vpn)
+    app.router.add_get("/use_cdnx", use_cdnx)
+    app.router.add_post("/use_cdnx", use_cdnx)
+    app.router.add_post("/use_cdnx_batch", use_cdnx_batch)
+    app.router.add_get(TUNNEL_PATH, tunnel)
+    app.router.add_post("/cdnx_invalidate", cdnx_invalidate)
+    app.router.add_get("/cdnx_relay_stats", cdnx_relay_stats)
+    app.router.add_get("/cdnx_lookup_stats", cdnx_lookup_stats)
+    app.router.add_get("/cdnx_filter_stats", cdnx_filter_stats)
+    app.router.add_get("/cdnx_popularity", cdnx_popularity)
+    app.router.add_get("/cdnx_admission", cdnx_admission)
+    app.on_startup.append(start_upstream)
+    app.on_cleanup.append(stop_upstream)
+    return app
+
+
+if __name__ == "__main__":
+    # Listen on all interfaces, port 8000 unless cdnx_port says otherwise
+    web.run_app(
+        create_app(),
+        host="0.0.0.0",
+        port=int(os.getenv("cdnx_port", 8000)),
+        backlog=1024,
+    )
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote_plus, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+import http_client  # noqa: E402
+from consistent_hash import HashRing  # noqa: E402
+from workloads import ZipfKeys  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Content Key Cache Sharding Benchmark
+# Starts local stand-in shards of the content key cache and drives CDNx
+# lookups at them from many client threads, routed by the same consistent
+# hash ring and pooled client the VPN service uses, for several shard
+# counts. Each stand-in serves one lookup at a time with a fixed service
+# time, like a single-worker cache instance, so the lookup throughput the
+# clients reach should grow close to linearly with the shard count.
+#
+# It also reports, without any servers, how evenly the ring spreads keys
+# (largest shard over the mean) and what share of keys move when one more
+# shard is added, against the 1/(N+1) ideal.
+#
+# Lookups are uniform over the catalog by default: skewed popularity is
+# mostly absorbed by the VPN's own lookup cache before it reaches a shard,
+# and --zipf-exponent shows how much a hot shard costs when it is not.
+#
+# Usage: python3 bench_cache_shards.py --shards 1,2,4,8 --requests 4000
+# ----------------------------------------------------------------------
+
+BASE_PORT = 9300
+
+
+class StandInShard:
+    """A content key cache shard that serves one lookup at a time."""
+
+    def __init__(self, port, service_time):
+        self.service_time = service_time
+        self.lookups = 0
+        self._busy = threading.Lock()
+        shard = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                content_key = parse_qs(urlparse(self.path).query)["content_key"][0]
+                with shard._busy:
+                    shard.lookups += 1
+                    time.sleep(shard.service_time)
+                body = b"encrypted-" + content_key.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run(shard_count, requests, threads, service_time, keys):
+    shards = {
+        "shard-%d" % shard: StandInShard(BASE_PORT + shard, service_time)
+        for shard in range(shard_count)
+    }
+    addresses = {
+        name: "127.0.0.1:%d" % (BASE_PORT + shard) for shard, name in enumerate(shards)
+    }
+    ring = HashRing(shards)
+
+    def lookup(content_key):
+        response = http_client.get(
+            "http://%s/content_key?content_key=%s"
+            % (addresses[ring.shard_for(content_key)], quote_plus(content_key))
+        )
+        response.raise_for_status()
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lookup, keys.keys(requests)))
+        seconds = time.perf_counter() - started
+    finally:
+        for shard in shards.values():
+            shard.close()
+
+    lookups = [shard.lookups for shard in shards.values()]
+    return {
+        "shards": shard_count,
+        "requests": requests,
+        "seconds": seconds,
+        "lookups_per_second": requests / seconds,
+        "busiest_shard_share": max(lookups) / requests,
+    }
+
+
+# Key spread over the shards and the share of keys that move when one is added
+def ring_balance(shard_count, key_count):
+    ring = HashRing("shard-%d" % shard for shard in range(shard_count))
+    keys = ["asset/%d.bin" % n for n in range(key_count)]
+    owners = [ring.shard_for(key) for key in keys]
+
+    counts = {}
+    for owner in owners:
+        counts[owner] = counts.get(owner, 0) + 1
+
+    ring.add("shard-%d" % shard_count)
+    moved = sum(1 for key, owner in zip(keys, owners) if ring.shard_for(key) != owner)
+    return {
+        "max_over_mean": max(counts.values()) / (key_count / shard_count),
+        "moved_on_add": moved / key_count,
+        "ideal_moved_on_add": 1 / (shard_count + 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Content key cache sharding benchmark")
+    parser.add_argument(
+        "--shards",
+        type=lambda value: [int(count) for count in value.split(",")],
+        default=[1, 2, 4, 8],
+    )
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument(
+        "--service-time",
+        type=float,
+        default=0.02,
+        help="seconds a stand-in shard spends on each lookup",
+    )
+    parser.add_argument("--catalog", type=int, default=100000)
+    parser.add_argument("--zipf-exponent", type=float, default=0.0)
+    parser.add_argument("--json", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    keys = ZipfKeys(args.catalog, exponent=args.zipf_exponent, seed=1)
+    results = []
+    baseline = None
+    for shard_count in args.shards:
+        result = run(shard_count, args.requests, args.threads, args.service_time, keys)
+        result.update(ring_balance(shard_count, args.catalog))
+        baseline = baseline or result["lookups_per_second"] / shard_count
+        result["scaling_efficiency"] = result["lookups_per_second"] / (
+            baseline * shard_count
+        )
+        results.append(result)
+        print(
+            "%2d shards  %8.0f lookups/s  efficiency %5.2f  busiest shard %4.1f%%"
+            "  max/mean keys %.2f  moved on add %4.1f%% (ideal %4.1f%%)"
+            % (
+                shard_count,
+                result["lookups_per_second"],
+                result["scaling_efficiency"],
+                result["busiest_shard_share"] * 100,
+                result["max_over_mean"],
+                result["moved_on_add"] * 100,
+                result["ideal_moved_on_add"] * 100,
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "tools"))
+
+import requests  # noqa: E402
+
+from content_samples import SAMPLES_DIRECTORY, generate  # noqa: E402
+from relay_compression import DEFLATE, decode_chunk, encode_chunk  # noqa: E402
+from relay_compression import probe_entropy  # noqa: E402
+from relay_framing import CHUNK_SIZE  # noqa: E402
+from stats import summarize  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Relay Compression Benchmark
+# Measures the VPN relay's compress-then-encrypt mode (compress=1, see
+# relay_compression.py) for each content type of content_samples.py.
+#
+# The codec pass runs locally on the samples cut into relay chunks: the
+# probed entropy, the share of chunks that were compressed rather than
+# stored, the bytes saved and the compress and decompress throughput.
+#
+# With --device and --vpn it also relays every sample through the VPN
+# with /use_vpn?stream=1, with and without compress=1, interleaved in a
+# shuffled order each round, and reports per content type the bytes the
+# relay took on the wire, the bytes saved and the effect on latency.
+# The samples have to be served by the VPN's CDN or origin under
+# samples/, as the local topology does:
+#   python3 local_topology.py --run 'python3 ../bench/bench_compression.py \
+#       --device $cdnx_topology_device_url --vpn $cdnx_topology_vpn_url'
+# ----------------------------------------------------------------------
+
+
+def codec_pass(name, content, repeat):
+    chunks = [content[i : i + CHUNK_SIZE] for i in range(0, len(content), CHUNK_SIZE)]
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        encoded = [encode_chunk(chunk) for chunk in chunks]
+    encode_s = (time.perf_counter() - started) / repeat
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for body in encoded:
+            decode_chunk(body, CHUNK_SIZE)
+    decode_s = (time.perf_counter() - started) / repeat
+
+    encoded_bytes = sum(len(body) for body in encoded)
+    return {
+        "content_type": name,
+        "bytes": len(content),
+        "entropy_bits": sum(probe_entropy(chunk) for chunk in chunks) / len(chunks),
+        "compressed_chunks": sum(body[0] == DEFLATE for body in encoded) / len(chunks),
+        "encoded_bytes": encoded_bytes,
+        "saved": 1 - encoded_bytes / len(content),
+        "encode_mb_s": len(content) / encode_s / 1e6,
+        "decode_mb_s": len(content) / decode_s / 1e6,
+    }
+
+
+def relay(device, vpn, endpoint, name, compress, transport, timeout):
+    response = requests.get(
+        device + "/use_vpn",
+        params={
+            "url": vpn,
+            "endpoint": "%s:%s/%s" % (endpoint, SAMPLES_DIRECTORY, name),
+            "stream": "1",
+            "compress": "1" if compress else "0",
+            "transport": transport,
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    body = response.json()
+    return body["elapsed_ms"], body["wire_bytes"], body["bytes"]
+
+
+def relay_pass(args, names):
+    samples = {(name, compress): [] for name in names for compress in (False, True)}
+    order = list(samples)
+    rng = random.Random(args.seed)
+    for trial in range(args.warmup + args.trials):
+        rng.shuffle(order)
+        for name, compress in order:
+            elapsed_ms, wire_bytes, size = relay(
+                args.device,
+                args.vpn,
+                args.endpoint,
+                name,
+                compress,
+                args.transport,
+                args.timeout,
+            )
+            if trial >= args.warmup:
+                samples[name, compress].append((elapsed_ms, wire_bytes, size))
+
+    results = []
+    for name in names:
+        plain = samples[name, False]
+        compressed = samples[name, True]
+        plain_latency = summarize([elapsed for elapsed, _, _ in plain])
+        compressed_latency = summarize([elapsed for elapsed, _, _ in compressed])
+        plain_wire = plain[-1][1]
+        compressed_wire = compressed[-1][1]
+        results.append(
+            {
+                "content_type": name,
+                "bytes": plain[-1][2],
+                "wire_bytes": plain_wire,
+                "compressed_wire_bytes": compressed_wire,
+                "saved": 1 - compressed_wire / plain_wire,
+                "latency_ms": plain_latency,
+                "compressed_latency_ms": compressed_latency,
+                "latency_ratio": compressed_latency["mean"] / plain_latency["mean"],
+            }
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Relay compression benchmark")
+    parser.add_argument("--device", help="user device base URL")
+    parser.add_argument("--vpn", help="VPN service base URL, as the device reaches it")
+    parser.add_argument("--endpoint", default="cdn", choices=["cdn", "direct"])
+    parser.add_argument("--transport", default="http", choices=["http", "tunnel"])
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="codec pass repeats")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    samples = generate()
+    results = {"codec": [], "relay": []}
+    for name, content in samples.items():
+        codec = codec_pass(name, content, args.repeat)
+        results["codec"].append(codec)
+        print(
+            "codec %-13s entropy %4.2f  compressed chunks %4.0f%%  saved %5.1f%%  "
+            "encode %7.1f MB/s  decode %7.1f MB/s"
+            % (
+                name,
+                codec["entropy_bits"],
+                codec["compressed_chunks"] * 100,
+                codec["saved"] * 100,
+                codec["encode_mb_s"],
+                codec["decode_mb_s"],
+            ),
+            flush=True,
+        )
+
+    if args.device and args.vpn:
+        results["relay"] = relay_pass(args, list(samples))
+        for relayed in results["relay"]:
+            print(
+                "relay %-13s wire %9d -> %9d bytes  saved %5.1f%%  "
+                "mean %8.1f -> %8.1f ms  x%.2f"
+                % (
+                    relayed["content_type"],
+                    relayed["wire_bytes"],
+                    relayed["compressed_wire_bytes"],
+                    relayed["saved"] * 100,
+                    relayed["latency_ms"]["mean"],
+                    relayed["compressed_latency_ms"]["mean"],
+                    relayed["latency_ratio"],
+                )
+            )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
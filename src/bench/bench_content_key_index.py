@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from content_key_index import ContentKeyIndex  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Content Key Index Benchmark
+# Fills a content key index with synthetic entries and reports lookup
+# throughput and latency, resident memory per entry, and how long a
+# snapshot takes to save and to load back (the restart path).
+#
+# Usage: python3 bench_content_key_index.py --entries 10000000
+# ----------------------------------------------------------------------
+
+
+# Resident set size of this process in bytes, read from /proc on Linux
+def rss_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+# Encrypted content keys in the experiment are opaque urlsafe tokens of about this size
+def encrypted_key_for(n):
+    return ("%043d" % n).encode("utf-8")
+
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[
+        min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))
+    ]
+
+
+def run(entries, lookups, latency_samples):
+    baseline_rss = rss_bytes()
+
+    index = ContentKeyIndex(entries, max_value_bytes=entries * 64)
+    allocated_rss = rss_bytes()
+
+    start = time.perf_counter()
+    for n in range(entries):
+        index.put("asset/%d.bin" % n, encrypted_key_for(n))
+    insert_seconds = time.perf_counter() - start
+    filled_rss = rss_bytes()
+
+    keys = ["asset/%d.bin" % random.randrange(entries) for _ in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        index.get(key)
+    hit_seconds = time.perf_counter() - start
+
+    missing = ["missing/%d.bin" % n for n in range(lookups)]
+    start = time.perf_counter()
+    for key in missing:
+        index.get(key)
+    miss_seconds = time.perf_counter() - start
+
+    latencies = []
+    for key in keys[:latency_samples]:
+        started = time.perf_counter_ns()
+        index.get(key)
+        latencies.append(time.perf_counter_ns() - started)
+    latencies.sort()
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, "index.snap")
+        start = time.perf_counter()
+        index.save(snapshot)
+        save_seconds = time.perf_counter() - start
+        snapshot_bytes = os.path.getsize(snapshot)
+
+        restored = ContentKeyIndex(entries, max_value_bytes=entries * 64)
+        start = time.perf_counter()
+        restored.load(snapshot)
+        load_seconds = time.perf_counter() - start
+        assert restored.get(keys[0]) == index.get(keys[0])
+
+    return {
+        "entries": entries,
+        "insert_per_second": entries / insert_seconds,
+        "hit_lookups_per_second": lookups / hit_seconds,
+        "miss_lookups_per_second": lookups / miss_seconds,
+        "lookup_p50_us": percentile(latencies, 0.50) / 1000,
+        "lookup_p99_us": percentile(latencies, 0.99) / 1000,
+        "index_bytes_per_entry": index.memory_bytes / entries,
+        "rss_bytes_per_entry": (filled_rss - baseline_rss) / entries,
+        "preallocated_rss_bytes": allocated_rss - baseline_rss,
+        "snapshot_bytes": snapshot_bytes,
+        "snapshot_save_seconds": save_seconds,
+        "snapshot_load_seconds": load_seconds,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content key index benchmark")
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--latency-samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.entries, args.lookups, args.latency_samples), indent=2))
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+from aead_envelope import EnvelopeSession  # noqa: E402
+
+# ----------------------------------------------------------------------
+# E2EE Envelope Benchmark
+# Compares the per-message Fernet tokens the device and VPN used to
+# exchange with the session-keyed AES-GCM envelopes of aead_envelope.py.
+# For each message size it times sealing and opening one message, and
+# reports the throughput and the bytes each envelope adds on the wire.
+# Fernet tokens are base64 text (about 4/3 of the message), envelopes
+# add a fixed 24 bytes to a raw binary body.
+#
+# Usage: python3 bench_envelope.py --sizes 64,1024,65536,1048576
+# ----------------------------------------------------------------------
+
+DEFAULT_SIZES = [64, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 100 * 1024 * 1024]
+
+# Repeat small messages until a sample takes about this long
+SAMPLE_SECONDS = 0.05
+
+
+def fernet_envelope(key):
+    crypto_util = Fernet(key)
+    return crypto_util.encrypt, crypto_util.decrypt
+
+
+def aead_envelope(key):
+    session = EnvelopeSession(key)
+    return (
+        lambda data: session.seal_request("/use_vpn", data),
+        lambda token: session.open_request("/use_vpn", token),
+    )
+
+
+ENVELOPES = {"fernet": fernet_envelope, "aead": aead_envelope}
+
+
+# Mean seconds per call over samples of enough calls to be measurable
+def time_call(function, argument, samples):
+    started = time.perf_counter()
+    function(argument)
+    once = time.perf_counter() - started
+    repeat = max(1, int(SAMPLE_SECONDS / max(once, 1e-9)))
+
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            function(argument)
+        timings.append((time.perf_counter() - started) / repeat)
+    return statistics.mean(timings)
+
+
+def run(envelope, size, samples, key):
+    encrypt, decrypt = ENVELOPES[envelope](key)
+    message = os.urandom(size)
+    token = encrypt(message)
+    if decrypt(token) != message:
+        raise AssertionError("%s did not round trip" % envelope)
+
+    seal_seconds = time_call(encrypt, message, samples)
+    open_seconds = time_call(decrypt, token, samples)
+    return {
+        "envelope": envelope,
+        "size": size,
+        "wire_bytes": len(token),
+        "overhead_bytes": len(token) - size,
+        "seal_us": seal_seconds * 1e6,
+        "open_us": open_seconds * 1e6,
+        "seal_mb_s": size / seal_seconds / 2**20,
+        "open_mb_s": size / open_seconds / 2**20,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="E2EE envelope benchmark")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=DEFAULT_SIZES,
+        help="message sizes in bytes",
+    )
+    parser.add_argument(
+        "--envelopes",
+        type=lambda value: value.split(","),
+        default=list(ENVELOPES),
+    )
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--json", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    key = Fernet.generate_key()
+    results = []
+    for size in args.sizes:
+        for envelope in args.envelopes:
+            result = run(envelope, size, args.samples, key)
+            results.append(result)
+            print(
+                "%-6s %10d B  seal %10.1f us %8.1f MB/s  open %10.1f us %8.1f MB/s"
+                "  +%d B on the wire"
+                % (
+                    envelope,
+                    size,
+                    result["seal_us"],
+                    result["seal_mb_s"],
+                    result["open_us"],
+                    result["open_mb_s"],
+                    result["overhead_bytes"],
+                )
+            )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
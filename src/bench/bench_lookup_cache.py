@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from lookup_cache import LookupCache  # noqa: E402
+from workloads import ZipfKeys  # noqa: E402
+
+# ----------------------------------------------------------------------
+# VPN Lookup Cache Benchmark
+# Replays a Zipf distributed stream of CDNx lookups from many concurrent
+# clients against a simulated content key cache with a fixed round trip
+# time, once straight through and once behind the VPN's lookup cache, and
+# reports how much upstream traffic and lookup latency the cache removes.
+#
+# Usage: python3 bench_lookup_cache.py --requests 50000 --threads 32
+# ----------------------------------------------------------------------
+
+
+class SimulatedKeyCache:
+    """Stand-in for the content key cache service with a fixed round trip time."""
+
+    def __init__(self, round_trip, catalog_hits):
+        self.round_trip = round_trip
+        self.catalog_hits = catalog_hits
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, content_key):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.round_trip)
+        rank = int(content_key.split("/")[1].split(".")[0])
+        # Only the most popular part of the catalog is published to the CDN
+        return (
+            b"encrypted-" + content_key.encode() if rank < self.catalog_hits else None
+        )
+
+
+def replay(lookup, keys, threads):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(shard):
+        local = []
+        for key in shard:
+            started = time.perf_counter()
+            lookup(key)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    workers = [
+        threading.Thread(target=worker, args=(keys[n::threads],))
+        for n in range(threads)
+    ]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(keys),
+        "lookups_per_second": len(keys) / elapsed,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+    }
+
+
+def run(args):
+    keys = ZipfKeys(args.catalog, args.exponent, seed=1).keys(args.requests)
+    results = {}
+
+    upstream = SimulatedKeyCache(args.rtt_ms / 1000, args.catalog_hits)
+    results["uncached"] = replay(upstream.lookup, keys, args.threads)
+    results["uncached"]["upstream_calls"] = upstream.calls
+
+    upstream = SimulatedKeyCache(args.rtt_ms / 1000, args.catalog_hits)
+    cache = LookupCache(
+        upstream.lookup,
+        positive_ttl=args.positive_ttl,
+        negative_ttl=args.negative_ttl,
+        max_entries=args.max_entries,
+    )
+    results["cached"] = replay(cache.get, keys, args.threads)
+    results["cached"]["upstream_calls"] = upstream.calls
+    results["cached"].update(cache.stats())
+    results["upstream_traffic_removed"] = 1 - upstream.calls / args.requests
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VPN lookup cache benchmark")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--catalog", type=int, default=100000)
+    parser.add_argument("--catalog-hits", type=int, default=50000)
+    parser.add_argument("--exponent", type=float, default=1.0)
+    parser.add_argument("--rtt-ms", type=float, default=2.0)
+    parser.add_argument("--positive-ttl", type=float, default=60)
+    parser.add_argument("--negative-ttl", type=float, default=5)
+    parser.add_argument("--max-entries", type=int, default=100000)
+    print(json.dumps(run(parser.parse_args()), indent=2))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from flask import Flask, jsonify  # noqa: E402
+
+import metrics  # noqa: E402
+import timing  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Metrics Overhead Microbenchmark
+# Measures what the /metrics instrumentation of metrics.py costs:
+#   primitives  a labelled counter increment, histogram observation and
+#               upstream observation, in ns per call
+#   request     the instrumentation every request goes through
+#               (start_request and finish_request with a trace of
+#               PHASES phases), on 1 to --threads threads at once, all on
+#               the same endpoint or each on its own, to show contention
+#   flask       the same trivial Flask endpoint served by the test client
+#               with and without metrics.init_app, in alternating rounds
+#   scrape      rendering /metrics once the series exist, and merging the
+#               snapshots of --workers worker processes as under serve.py
+# Usage: python3 bench_metrics.py [--iterations 200000] [--json out.json]
+# ----------------------------------------------------------------------
+
+# Phases of a typical VPN /use_cdnx request
+PHASES = ["decrypt_content_key", "filter_check", "key_lookup", "encrypt_response"]
+
+
+def per_call_ns(function, iterations):
+    started = time.perf_counter_ns()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter_ns() - started) / iterations
+
+
+def primitives(iterations):
+    counter = metrics.LOOKUPS.labels("hit")
+    histogram = metrics.REQUEST_DURATION.labels("/bench")
+    started = time.perf_counter_ns()
+    return {
+        "baseline_ns": per_call_ns(lambda: None, iterations),
+        "counter_inc_ns": per_call_ns(counter.inc, iterations),
+        "labelled_counter_inc_ns": per_call_ns(
+            lambda: metrics.LOOKUPS.labels("hit").inc(), iterations
+        ),
+        "histogram_observe_ns": per_call_ns(
+            lambda: histogram.observe(0.0123), iterations
+        ),
+        "upstream_observe_ns": per_call_ns(
+            lambda: metrics.observe_upstream("cdn.bench:443", 200, started),
+            iterations,
+        ),
+    }
+
+
+def bench_trace():
+    trace = timing.Trace()
+    for phase in PHASES:
+        trace.record(phase, 250000)
+    return trace
+
+
+def instrument_requests(endpoint, iterations, trace):
+    for _ in range(iterations):
+        started = metrics.start_request(endpoint)
+        metrics.finish_request(endpoint, "POST", 200, started, trace)
+
+
+# Mean ns per instrumented request per thread, with thread_count threads at once
+def request_level(thread_count, iterations, shared_endpoint):
+    trace = bench_trace()
+    threads = [
+        threading.Thread(
+            target=instrument_requests,
+            args=(
+                "/bench" if shared_endpoint else "/bench_%d" % number,
+                iterations,
+                trace,
+            ),
+        )
+        for number in range(thread_count)
+    ]
+    started = time.perf_counter_ns()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter_ns() - started
+    return {
+        "threads": thread_count,
+        "endpoint": "shared" if shared_endpoint else "per_thread",
+        "ns_per_request": elapsed / (iterations * thread_count),
+    }
+
+
+def flask_app(instrumented):
+    app = Flask("bench_metrics_%s" % ("on" if instrumented else "off"))
+    timing.init_app(app)
+    if instrumented:
+        metrics.init_app(app)
+
+    @app.route("/use_cdnx")
+    def use_cdnx():
+        trace = timing.current_trace()
+        for phase in PHASES:
+            trace.record(phase, 250000)
+        return jsonify("ok")
+
+    return app
+
+
+# Mean µs per request through the Flask test client, with and without metrics
+def flask_overhead(requests_per_round, rounds):
+    clients = {
+        "without": flask_app(False).test_client(),
+        "with": flask_app(True).test_client(),
+    }
+    totals = {name: 0 for name in clients}
+    for round_number in range(rounds + 1):
+        for name, client in clients.items():
+            started = time.perf_counter_ns()
+            for _ in range(requests_per_round):
+                client.get("/use_cdnx").close()
+            # The first round warms both apps up
+            if round_number:
+                totals[name] += time.perf_counter_ns() - started
+
+    measured = requests_per_round * rounds
+    result = {name + "_us": total / measured / 1000 for name, total in totals.items()}
+    result["overhead_us"] = result["with_us"] - result["without_us"]
+    return result
+
+
+def scrape(workers, repeat):
+    started = time.perf_counter_ns()
+    for _ in range(repeat):
+        body = metrics.render(metrics.collect())
+    render_ms = (time.perf_counter_ns() - started) / repeat / 1e6
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = json.dumps(metrics.collect())
+        for number in range(workers):
+            path = os.path.join(directory, "%d-%d.json" % (os.getpid(), number))
+            with open(path, "w") as out:
+                out.write(snapshot)
+        started = time.perf_counter_ns()
+        for _ in range(repeat):
+            metrics.render(metrics.merge_snapshots(directory))
+        merge_ms = (time.perf_counter_ns() - started) / repeat / 1e6
+
+    return {
+        "series_lines": body.count("\n"),
+        "bytes": len(body),
+        "render_ms": render_ms,
+        "workers": workers,
+        "merge_and_render_ms": merge_ms,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Metrics overhead microbenchmark")
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--flask-requests", type=int, default=2000)
+    parser.add_argument("--flask-rounds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = {"primitives": primitives(args.iterations), "request": []}
+    for name, value in results["primitives"].items():
+        print("%-24s %8.1f ns" % (name, value), flush=True)
+
+    thread_counts = sorted({1, max(args.threads // 2, 1), args.threads})
+    for shared_endpoint in (True, False):
+        for thread_count in thread_counts:
+            level = request_level(
+                thread_count, args.iterations // thread_count, shared_endpoint
+            )
+            results["request"].append(level)
+            print(
+                "request  %-10s threads %-3d %8.1f ns per request"
+                % (level["endpoint"], thread_count, level["ns_per_request"]),
+                flush=True,
+            )
+
+    results["flask"] = flask_overhead(args.flask_requests, args.flask_rounds)
+    print(
+        "flask    without %.1f us  with %.1f us  overhead %.2f us per request"
+        % (
+            results["flask"]["without_us"],
+            results["flask"]["with_us"],
+            results["flask"]["overhead_us"],
+        ),
+        flush=True,
+    )
+
+    results["scrape"] = scrape(args.workers, 20)
+    print(
+        "scrape   %d lines, %d bytes  render %.2f ms  merge of %d workers %.2f ms"
+        % (
+            results["scrape"]["series_lines"],
+            results["scrape"]["bytes"],
+            results["scrape"]["render_ms"],
+            args.workers,
+            results["scrape"]["merge_and_render_ms"],
+        )
+    )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
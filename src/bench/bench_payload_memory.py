@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+from payload_buffer import COPY_CHUNK_SIZE, SpooledPayload  # noqa: E402
+from relay_framing import CHUNK_SIZE, FrameReader, seal_frames  # noqa: E402
+from segmented_asset import (  # noqa: E402
+    HEADER_SIZE,
+    AssetHeader,
+    SegmentedAssetCipher,
+    encrypt_file,
+)
+
+# ----------------------------------------------------------------------
+# Payload Memory Benchmark
+# Measures the peak resident memory one request needs to carry an asset
+# through the VPN and decrypt it on the user device, at several asset
+# sizes. Each measurement runs in a fresh process so the peak belongs to
+# that request alone:
+#   fernet  the original handling: the whole body as bytes, one Fernet
+#           token, its str form and the decrypted copy
+#   relay   the body spooled, sealed into relay frames into a second spool
+#           and decrypted frame by frame, as /use_vpn now does
+#   cdnx    a segmented CDNx container spooled and decrypted segment by
+#           segment, as the user device's ranged CDNx fetch does
+# Payloads past cdnx_spool_max_memory move to temporary files, so the relay
+# and cdnx peaks should stay flat as the asset grows.
+#
+# Usage: python3 bench_payload_memory.py --sizes 16,128,1024 --modes relay,cdnx
+# ----------------------------------------------------------------------
+
+MODES = ("fernet", "relay", "cdnx")
+# Measuring processes inherit the key from the parent run
+KEY = os.getenv("cdnx_asset_key", "").encode("utf-8") or Fernet.generate_key()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def run_fernet(source_path):
+    crypto_util = Fernet(KEY)
+    with open(source_path, "rb") as source:
+        data = source.read()
+    encrypted_response = crypto_util.encrypt(data).decode("utf-8")
+    del data
+    return len(crypto_util.decrypt(encrypted_response.encode("utf-8")))
+
+
+def run_relay(source_path):
+    crypto_util = Fernet(KEY)
+    payload = SpooledPayload()
+    with open(source_path, "rb") as source:
+        for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+            payload.write(chunk)
+
+    sealed_payload = SpooledPayload()
+    with payload:
+        for frame in seal_frames(crypto_util, payload.chunks(CHUNK_SIZE)):
+            sealed_payload.write(frame)
+
+    reader = FrameReader(crypto_util)
+    received = 0
+    with sealed_payload:
+        for data in sealed_payload.chunks(COPY_CHUNK_SIZE):
+            for chunk in reader.feed(data):
+                received += len(chunk)
+    reader.close()
+    return received
+
+
+def run_cdnx(container_path):
+    with open(container_path, "rb") as source:
+        container = SpooledPayload(os.path.getsize(container_path))
+        container.fill(0, len(container), source.readinto)
+
+    with container:
+        header = AssetHeader.parse(container.read_at(0, HEADER_SIZE))
+        decryptor = SegmentedAssetCipher(KEY).segment_decryptor(header)
+        received = 0
+        for index in range(header.segment_count):
+            start, end = header.segment_range(index)
+            sealed_segment = container.read_at(start, end - start + 1)
+            received += len(decryptor.decrypt_segment(index, sealed_segment))
+    return received
+
+
+# Runs one mode on one file in this process and prints its measurements as JSON
+def measure(mode, path):
+    baseline = current_rss_mb()
+    started = time.perf_counter()
+    received = {"fernet": run_fernet, "relay": run_relay, "cdnx": run_cdnx}[mode](path)
+    print(
+        json.dumps(
+            {
+                "bytes": received,
+                "seconds": time.perf_counter() - started,
+                "baseline_rss_mb": baseline,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+    )
+
+
+def write_asset(directory, size_mb):
+    source_path = os.path.join(directory, "asset-%dmb.bin" % size_mb)
+    with open(source_path, "wb") as out:
+        for _ in range(size_mb):
+            out.write(os.urandom(2**20))
+
+    container_path = source_path + ".cdnx"
+    encrypt_file(KEY, source_path, container_path)
+    return source_path, container_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Payload memory benchmark")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[16, 64, 256],
+        help="asset sizes in MB",
+    )
+    parser.add_argument(
+        "--modes", type=lambda value: value.split(","), default=list(MODES)
+    )
+    parser.add_argument("--json", help="write the results as JSON")
+    parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        measure(*args.measure)
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size_mb in args.sizes:
+            source_path, container_path = write_asset(directory, size_mb)
+            for mode in args.modes:
+                path = container_path if mode == "cdnx" else source_path
+                output = subprocess.check_output(
+                    [sys.executable, __file__, "--measure", mode, path],
+                    env=dict(os.environ, cdnx_asset_key=KEY.decode()),
+                )
+                result = dict(json.loads(output), mode=mode, size_mb=size_mb)
+                results.append(result)
+                print(
+                    "%-6s %6d MB  peak RSS %8.1f MB  (+%8.1f MB over baseline)  %.2f s"
+                    % (
+                        mode,
+                        size_mb,
+                        result["peak_rss_mb"],
+                        result["peak_rss_mb"] - result["baseline_rss_mb"],
+                        result["seconds"],
+                    )
+                )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from popularity import PopularityTracker  # noqa: E402
+from workloads import ZipfKeys  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Popularity Tracking Benchmark
+# Simulates the loop between the VPN's popularity tracker and the catalog
+# publisher. CDNx requests are drawn from a Zipf distributed catalog and
+# hit if their key is in a CDN of fixed capacity that starts out empty.
+# At the end of every epoch the admission list (the tracked heavy hitters
+# that missed) is published to the CDN, evicting the keys the tracker now
+# rates least popular once it is full. The hit ratio of each epoch should
+# climb towards the best any CDN of that size can reach (the share of
+# requests for its capacity's worth of most popular keys).
+#
+# Half way through, popularity is reshuffled so the decay can be seen
+# pulling the hit ratio back up. Time is simulated, one request per tick
+# of --request-seconds. The update cost and memory of the tracker are
+# reported as well, along with how many of the true top-K it tracks.
+#
+# Usage: python3 bench_popularity.py --epochs 20 --requests 20000
+# ----------------------------------------------------------------------
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(args):
+    clock = SimulatedClock()
+    tracker = PopularityTracker(
+        top_k=args.top_k,
+        half_life=args.half_life,
+        width=args.width,
+        depth=args.depth,
+        clock=clock,
+    )
+    keys = ZipfKeys(args.catalog, exponent=args.zipf_exponent, seed=1)
+    # Popularity rank -> catalog key, reshuffled half way through
+    ranking = list(range(args.catalog))
+    shuffler = random.Random(2)
+
+    best_ratio = keys.top_share(args.capacity)
+    cdn = set()
+    results = []
+    for epoch in range(args.epochs):
+        if epoch == args.epochs // 2 and args.shift:
+            shuffler.shuffle(ranking)
+
+        ranks = [keys.next_rank() for _ in range(args.requests)]
+        requested = ["asset/%d.bin" % ranking[rank] for rank in ranks]
+        hits = 0
+        started = time.perf_counter()
+        for content_key in requested:
+            hit = content_key in cdn
+            hits += hit
+            tracker.record(content_key, hit)
+            clock.now += args.request_seconds
+        update_us = (time.perf_counter() - started) / args.requests * 1e6
+
+        # Publish the admission list, keeping the CDN at its capacity
+        admitted = [entry["content_key"] for entry in tracker.admission_list()]
+        cdn.update(admitted)
+        if len(cdn) > args.capacity:
+            cdn = set(sorted(cdn, key=tracker.estimate, reverse=True)[: args.capacity])
+
+        true_top = {"asset/%d.bin" % ranking[rank] for rank in range(args.top_k)}
+        tracked = {entry["content_key"] for entry in tracker.top()}
+        results.append(
+            {
+                "epoch": epoch,
+                "hit_ratio": hits / args.requests,
+                "best_hit_ratio": best_ratio,
+                "admitted": len(admitted),
+                "cdn_size": len(cdn),
+                "top_k_recall": len(true_top & tracked) / args.top_k,
+                "update_us": update_us,
+            }
+        )
+    return tracker, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Popularity tracking benchmark")
+    parser.add_argument("--catalog", type=int, default=100000)
+    parser.add_argument("--zipf-exponent", type=float, default=1.0)
+    parser.add_argument("--capacity", type=int, default=2000, help="CDN size in keys")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=20000, help="per epoch")
+    parser.add_argument("--request-seconds", type=float, default=0.01)
+    parser.add_argument("--half-life", type=float, default=200)
+    parser.add_argument(
+        "--top-k", type=int, help="heavy hitters tracked, the CDN capacity by default"
+    )
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument(
+        "--no-shift",
+        dest="shift",
+        action="store_false",
+        help="keep popularity fixed for the whole run",
+    )
+    parser.add_argument("--json", help="write the results as JSON")
+    args = parser.parse_args(argv)
+    args.top_k = args.top_k or args.capacity
+
+    tracker, results = run(args)
+    for result in results:
+        print(
+            "epoch %2d  hit ratio %5.1f%% (best %5.1f%%)  admitted %4d  cdn %5d"
+            "  top-k recall %5.1f%%  %5.2f us/request"
+            % (
+                result["epoch"],
+                result["hit_ratio"] * 100,
+                result["best_hit_ratio"] * 100,
+                result["admitted"],
+                result["cdn_size"],
+                result["top_k_recall"] * 100,
+                result["update_us"],
+            )
+        )
+    stats = tracker.stats()
+    print(
+        "sketch %dx%d, %d bytes, tracking %d keys"
+        % (
+            stats["sketch_depth"],
+            stats["sketch_width"],
+            stats["memory_bytes"],
+            stats["tracked"],
+        )
+    )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"stats": stats, "epochs": results}, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+import requests  # noqa: E402
+from cryptography.fernet import Fernet  # noqa: E402
+
+import http_client  # noqa: E402
+from aead_envelope import DeviceSessions  # noqa: E402
+from stats import summarize  # noqa: E402
+from tunnel_client import TunnelClient  # noqa: E402
+
+# ----------------------------------------------------------------------
+# VPN Tunnel Benchmark
+# Plays a user device sending many small concurrent requests to the VPN
+# service, CDNx key resolutions (/use_cdnx), and compares the two ways
+# the device can send them:
+#   http    one request each on http_client's pooled keep-alive
+#           connections, as the device always has
+#   tunnel  streams on one multiplexed tunnel (tunnel_client.py)
+# At each concurrency level a fixed number of requests is sent by that
+# many threads, after a warm-up round that opens the pooled connections
+# or the tunnel. The requests/s, latency percentiles and connections the
+# measured requests opened are reported per transport and level.
+#
+# With --relay-streams, that many streamed /use_vpn relays of a large
+# asset run on the same transport throughout, to show how much the small
+# requests are held back by bulk transfers sharing the connection.
+#
+# Run against vpn_service_async, which serves the tunnel, for example
+# through the emulated cross-region link of the local topology:
+#   python3 local_topology.py --vpn-entrypoint vpn_service_async.py \
+#       --run 'python3 ../bench/bench_tunnel.py --vpn $cdnx_topology_vpn_url'
+# Requests are sealed with the cdnx_qa_key and cdnx_content_key env vars.
+# ----------------------------------------------------------------------
+
+TRANSPORTS = ["http", "tunnel"]
+
+
+class Device:
+    """Sends sealed VPN requests the way user_device.py does, over one transport."""
+
+    def __init__(self, vpn_url, transport, envelope):
+        self.vpn_url = vpn_url
+        self.transport = transport
+        self.sessions = (
+            DeviceSessions(os.getenv("cdnx_qa_key").encode("utf-8"))
+            if envelope == "aead"
+            else None
+        )
+        self.content_key_crypto_util = Fernet(
+            os.getenv("cdnx_content_key").encode("utf-8")
+        )
+        self.vpn_crypto_util = Fernet(os.getenv("cdnx_qa_key").encode("utf-8"))
+
+    # Resolves a content key and returns the still-encrypted CDNx key
+    def resolve(self, content_key):
+        if self.sessions is not None:
+            session = self.sessions.current()
+            response = self.transport.post(
+                self.vpn_url + "/use_cdnx",
+                data=session.seal_request("/use_cdnx", content_key.encode("utf-8")),
+                headers=session.headers(),
+            )
+            response.raise_for_status()
+            return session.open_response(response.headers, response.content)
+
+        token = self.content_key_crypto_util.encrypt(content_key.encode("utf-8"))
+        response = self.transport.get(
+            self.vpn_url + "/use_cdnx?content_key=" + quote_plus(token.decode("utf-8"))
+        )
+        response.raise_for_status()
+        return self.vpn_crypto_util.decrypt(response.content)
+
+    # Has the VPN stream an asset through, returning the bytes received
+    def relay(self, vpn_payload):
+        if self.sessions is not None:
+            session = self.sessions.current()
+            response = self.transport.post(
+                self.vpn_url + "/use_vpn?stream=1",
+                data=session.seal_request("/use_vpn", vpn_payload.encode("utf-8")),
+                headers=session.headers(),
+                stream=True,
+            )
+        else:
+            token = self.vpn_crypto_util.encrypt(vpn_payload.encode("utf-8"))
+            response = self.transport.get(
+                self.vpn_url + "/use_vpn?stream=1&vpn_payload=" + token.decode("utf-8"),
+                stream=True,
+            )
+        with response:
+            response.raise_for_status()
+            return sum(len(data) for data in response.iter_content(chunk_size=None))
+
+
+def connections_opened(host):
+    return http_client.host_stats().get(host, {}).get("connections_opened", 0)
+
+
+# Keeps relays running on the transport until stopped is set
+def run_relays(device, vpn_payload, streams, stopped):
+    relayed = {"relays": 0, "bytes": 0, "errors": 0}
+
+    def relay_loop():
+        while not stopped.is_set():
+            try:
+                relayed["bytes"] += device.relay(vpn_payload)
+                relayed["relays"] += 1
+            except requests.exceptions.RequestException as e:
+                print(e)
+                relayed["errors"] += 1
+                time.sleep(0.1)
+
+    threads = [threading.Thread(target=relay_loop) for _ in range(streams)]
+    for thread in threads:
+        thread.start()
+    return threads, relayed
+
+
+def run_level(device, content_key, concurrency, request_count):
+    latencies = []
+    errors = 0
+
+    def resolve():
+        started = time.perf_counter()
+        device.resolve(content_key)
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Warm-up round, opening the connections or the tunnel
+        for warm_up in [pool.submit(resolve) for _ in range(concurrency)]:
+            try:
+                warm_up.result()
+            except requests.exceptions.RequestException:
+                pass
+
+        host = urlsplit(device.vpn_url).hostname
+        opened_before = connections_opened(host)
+        started = time.perf_counter()
+        for resolution in [pool.submit(resolve) for _ in range(request_count)]:
+            try:
+                latencies.append(resolution.result())
+            except requests.exceptions.RequestException as e:
+                print(e)
+                errors += 1
+        elapsed = time.perf_counter() - started
+
+    summary = summarize([latency * 1000 for latency in latencies])
+    return {
+        "concurrency": concurrency,
+        "completed": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": summary.get("p50"),
+        "p99_ms": summary.get("p99"),
+        "mean_ms": summary.get("mean"),
+        "connections_opened": connections_opened(host) - opened_before,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VPN tunnel benchmark")
+    parser.add_argument("--vpn", required=True, help="VPN service base URL")
+    parser.add_argument("--transports", type=lambda v: v.split(","), default=TRANSPORTS)
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 8, 32, 64, 128],
+    )
+    parser.add_argument(
+        "--requests", type=int, default=400, help="measured requests per level"
+    )
+    parser.add_argument("--content-key", default="10mb.bin")
+    parser.add_argument("--envelope", default="aead", choices=["aead", "fernet"])
+    parser.add_argument(
+        "--relay-streams",
+        type=int,
+        default=0,
+        help="bulk /use_vpn relays kept running on the transport",
+    )
+    parser.add_argument("--relay-payload", default="cdn")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.transports:
+        transport = TunnelClient() if name == "tunnel" else http_client
+        device = Device(args.vpn.rstrip("/"), transport, args.envelope)
+
+        stopped = threading.Event()
+        relay_threads, relayed = run_relays(
+            device, args.relay_payload, args.relay_streams, stopped
+        )
+        levels = []
+        try:
+            for concurrency in args.concurrency:
+                level = run_level(device, args.content_key, concurrency, args.requests)
+                levels.append(level)
+                print(
+                    "%-6s c=%-4d %8.1f req/s  p50 %8.1f ms  p99 %8.1f ms  "
+                    "connections opened %4d  errors %d"
+                    % (
+                        name,
+                        concurrency,
+                        level["requests_per_second"],
+                        level["p50_ms"] or 0.0,
+                        level["p99_ms"] or 0.0,
+                        level["connections_opened"],
+                        level["errors"],
+                    ),
+                    flush=True,
+                )
+        finally:
+            stopped.set()
+            for thread in relay_threads:
+                thread.join()
+        results[name] = {"levels": levels}
+        if args.relay_streams:
+            results[name]["relayed"] = relayed
+            print("%-6s relayed %s" % (name, json.dumps(relayed)), flush=True)
+
+    # Every transport against the first, level by level
+    names = list(results)
+    for name in names[1:]:
+        for before, after in zip(results[names[0]]["levels"], results[name]["levels"]):
+            print(
+                "%s/%s c=%-4d throughput x%.2f  p99 x%.2f"
+                % (
+                    name,
+                    names[0],
+                    after["concurrency"],
+                    after["requests_per_second"]
+                    / max(before["requests_per_second"], 1e-9),
+                    (after["p99_ms"] or 0.0) / max(before["p99_ms"] or 0.0, 1e-9),
+                )
+            )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+from cryptography.fernet import Fernet
+
+from load_test_serving import request_path
+from load_test_vpn import percentile
+
+# ----------------------------------------------------------------------
+# Relay Admission Load Test
+# Shows whether a VPN service keeps answering CDNx lookups while bulk
+# relays saturate it (see relay_admission.py). Each target first serves
+# only --lookups closed-loop /use_cdnx clients for --duration seconds,
+# then the same lookups alongside --bulk clients downloading through
+# /use_vpn as fast as they are let. Bulk clients that get a 429 wait for
+# its Retry-After before trying again, as the user device's callers
+# should. Reported per phase: lookup latency percentiles and errors, and
+# for the saturated phase the bulk relays completed, turned away and
+# failed, their throughput and the VPN's /cdnx_relay_stats.
+#
+# Compare a VPN with admission control against one started with
+# cdnx_relay_admission=0, for example on the local topology, whose VPN
+# listens on --base-port + 1 without an emulated link in front of it:
+#   cdnx_relay_admission=0 python3 local_topology.py --serving production \
+#       --run 'python3 ../bench/load_test_admission.py \
+#           --target off=http://127.0.0.1:8101'
+# The requests are encrypted with the cdnx_content_key and cdnx_qa_key env
+# vars.
+# ----------------------------------------------------------------------
+
+
+async def lookup_client(session, url, deadline, interval, latencies, outcome):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                # Hits and misses are both answers
+                if response.status not in (200, 404):
+                    outcome["errors"] += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            outcome["errors"] += 1
+        await asyncio.sleep(interval)
+
+
+async def bulk_client(session, url, deadline, outcome):
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                async for chunk in response.content.iter_any():
+                    outcome["bytes"] += len(chunk)
+                if response.status == 429:
+                    outcome["rejected"] += 1
+                    retry_after = float(response.headers.get("Retry-After", 1))
+                    await asyncio.sleep(min(retry_after, deadline - time.monotonic()))
+                elif response.status != 200:
+                    outcome["errors"] += 1
+                else:
+                    outcome["completed"] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            outcome["errors"] += 1
+
+
+async def run_phase(session, lookup_url, bulk_url, args):
+    ramp = args.ramp if bulk_url else 0
+    started = time.monotonic()
+    deadline = started + ramp + args.duration
+    bulk = {"completed": 0, "rejected": 0, "errors": 0, "bytes": 0}
+    clients = [
+        bulk_client(session, bulk_url, deadline, bulk)
+        for _ in range(args.bulk if bulk_url else 0)
+    ]
+
+    # Lookups are measured once the bulk relays have had time to pile up
+    latencies = []
+    lookups = {"errors": 0}
+
+    async def lookups_after_ramp():
+        await asyncio.sleep(ramp)
+        await asyncio.gather(
+            *(
+                lookup_client(
+                    session,
+                    lookup_url,
+                    deadline,
+                    args.lookup_interval,
+                    latencies,
+                    lookups,
+                )
+                for _ in range(args.lookups)
+            )
+        )
+
+    await asyncio.gather(lookups_after_ramp(), *clients)
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    phase = {
+        "lookups": len(latencies),
+        "lookup_errors": lookups["errors"],
+        "lookup_p50_ms": percentile(latencies, 0.50),
+        "lookup_p99_ms": percentile(latencies, 0.99),
+        "lookup_max_ms": latencies[-1] if latencies else None,
+    }
+    for key in ("lookup_p50_ms", "lookup_p99_ms", "lookup_max_ms"):
+        if phase[key] is not None:
+            phase[key] *= 1000
+    if bulk_url:
+        phase.update(
+            bulk_completed=bulk["completed"],
+            bulk_rejected=bulk["rejected"],
+            bulk_errors=bulk["errors"],
+            bulk_megabytes_per_second=bulk["bytes"] / elapsed / 1e6,
+        )
+    return phase
+
+
+async def relay_stats(session, base_url):
+    try:
+        async with session.get(base_url + "/cdnx_relay_stats") as response:
+            if response.status == 200:
+                return await response.json()
+    except aiohttp.ClientError as e:
+        print(e)
+    return None
+
+
+def report(name, phase_name, phase):
+    line = (
+        "%-8s %-9s lookups %5d  p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms  errors %d"
+    ) % (
+        name,
+        phase_name,
+        phase["lookups"],
+        phase["lookup_p50_ms"] or 0.0,
+        phase["lookup_p99_ms"] or 0.0,
+        phase["lookup_max_ms"] or 0.0,
+        phase["lookup_errors"],
+    )
+    if "bulk_completed" in phase:
+        line += (
+            "\n%-8s %-9s bulk relays %d completed  %d turned away  %d failed  "
+            "%.1f MB/s"
+        ) % (
+            name,
+            phase_name,
+            phase["bulk_completed"],
+            phase["bulk_rejected"],
+            phase["bulk_errors"],
+            phase["bulk_megabytes_per_second"],
+        )
+    print(line, flush=True)
+
+
+async def run(args):
+    qa_util = Fernet(os.getenv("cdnx_qa_key").encode("utf-8"))
+    lookup_path = request_path("cdnx", args.content_key)
+    bulk_path = "/use_vpn?vpn_payload=" + qa_util.encrypt(
+        args.endpoint.encode("utf-8")
+    ).decode("utf-8")
+    if args.stream:
+        bulk_path += "&stream=1"
+    results = {}
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for target in args.target:
+            name, base_url = target.split("=", 1)
+            idle = await run_phase(session, base_url + lookup_path, None, args)
+            report(name, "idle", idle)
+            saturated = await run_phase(
+                session, base_url + lookup_path, base_url + bulk_path, args
+            )
+            report(name, "saturated", saturated)
+
+            results[name] = {
+                "idle": idle,
+                "saturated": saturated,
+                "lookup_p99_ratio": (
+                    saturated["lookup_p99_ms"] / idle["lookup_p99_ms"]
+                    if saturated["lookup_p99_ms"] and idle["lookup_p99_ms"]
+                    else None
+                ),
+                "relay_stats": await relay_stats(session, base_url),
+            }
+            if results[name]["lookup_p99_ratio"] is not None:
+                print(
+                    "%-8s lookup p99 saturated/idle x%.2f"
+                    % (name, results[name]["lookup_p99_ratio"]),
+                    flush=True,
+                )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay admission load test")
+    parser.add_argument(
+        "--target", action="append", required=True, help="name=VPN base URL"
+    )
+    parser.add_argument("--content-key", default="10mb.bin")
+    parser.add_argument("--endpoint", default="cdn", choices=["cdn", "direct"])
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--bulk", type=int, default=64, help="bulk relay clients")
+    parser.add_argument("--lookups", type=int, default=4, help="lookup clients")
+    parser.add_argument(
+        "--lookup-interval",
+        type=float,
+        default=0.05,
+        help="seconds each lookup client waits between requests",
+    )
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument(
+        "--ramp",
+        type=float,
+        default=3,
+        help="seconds of bulk traffic before lookups are measured",
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
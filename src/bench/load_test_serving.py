@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+from urllib.parse import quote_plus
+
+import aiohttp
+from cryptography.fernet import Fernet
+
+from load_test_vpn import run_level
+
+# ----------------------------------------------------------------------
+# Serving Mode Load Test
+# Compares a service run on Flask's development server (python3 <service>.py)
+# with the same service in the production serving mode (serve.py) on the
+# same instance type. Each target gets a fixed number of concurrent clients
+# at each concurrency level, and the requests/s and p50/p99 latency of
+# every level are reported, followed by the production over development
+# ratios per level.
+#
+# Request kinds:
+#   lookup     content key cache  /content_key?content_key=<key>
+#   cdnx       VPN service        /use_cdnx with a Fernet-encrypted content key
+#   heartbeat  any service        /heartbeat
+#
+# Usage:
+#   python3 load_test_serving.py --request cdnx \
+#       --target dev=http://vpn-dev:8000 --target prod=http://vpn-prod:8000
+# The cdnx request is encrypted with the cdnx_content_key env var.
+# ----------------------------------------------------------------------
+
+
+def request_path(kind, content_key):
+    if kind == "lookup":
+        return "/content_key?content_key=" + quote_plus(content_key)
+    if kind == "cdnx":
+        crypto_util = Fernet(os.getenv("cdnx_content_key").encode("utf-8"))
+        token = crypto_util.encrypt(content_key.encode("utf-8")).decode("utf-8")
+        return "/use_cdnx?content_key=" + quote_plus(token)
+    return "/heartbeat"
+
+
+async def run(args):
+    path = request_path(args.request, args.content_key)
+    results = {}
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for target in args.target:
+            name, base_url = target.split("=", 1)
+            levels = []
+            for concurrency in args.concurrency:
+                level = await run_level(
+                    session, base_url + path, concurrency, args.duration
+                )
+                levels.append(level)
+                print(
+                    "%-6s c=%-4d %8.1f req/s  p50 %8.1f ms  p99 %8.1f ms  errors %d"
+                    % (
+                        name,
+                        concurrency,
+                        level["requests_per_second"],
+                        level["p50_ms"] or 0.0,
+                        level["p99_ms"] or 0.0,
+                        level["errors"],
+                    )
+                )
+            results[name] = {"levels": levels}
+
+    # Every target against the first one, level by level
+    names = list(results)
+    baseline = results[names[0]]["levels"]
+    for name in names[1:]:
+        comparison = []
+        for before, after in zip(baseline, results[name]["levels"]):
+            comparison.append(
+                {
+                    "concurrency": after["concurrency"],
+                    "throughput_ratio": after["requests_per_second"]
+                    / max(before["requests_per_second"], 1e-9),
+                    "p99_ratio": (
+                        after["p99_ms"] / before["p99_ms"]
+                        if after["p99_ms"] and before["p99_ms"]
+                        else None
+                    ),
+                }
+            )
+            print(
+                "%s/%s c=%-4d throughput x%.2f  p99 x%s"
+                % (
+                    name,
+                    names[0],
+                    comparison[-1]["concurrency"],
+                    comparison[-1]["throughput_ratio"],
+                    (
+                        "%.2f" % comparison[-1]["p99_ratio"]
+                        if comparison[-1]["p99_ratio"] is not None
+                        else "-"
+                    ),
+                )
+            )
+        results[name]["against_" + names[0]] = comparison
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serving mode load test")
+    parser.add_argument(
+        "--target",
+        action="append",
+        required=True,
+        help="name=base URL, the first one is the baseline",
+    )
+    parser.add_argument(
+        "--request", default="cdnx", choices=["lookup", "cdnx", "heartbeat"]
+    )
+    parser.add_argument("--content-key", default="10mb.bin")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 10, 50, 100, 250],
+    )
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+from cryptography.fernet import Fernet
+
+# ----------------------------------------------------------------------
+# VPN Relay Load Test
+# Drives /use_vpn on one or more VPN service deployments (for example the
+# Flask mode on one port and the asyncio mode on another) with a fixed
+# number of concurrent tunneled downloads at each concurrency level, and
+# reports sustained throughput, error rate and latency percentiles. The
+# highest level each target sustains within the error and p99 budgets is
+# reported as its sustained concurrency.
+#
+# Usage:
+#   python3 load_test_vpn.py --target flask=http://vpn:8000 \
+#       --target async=http://vpn:8001 --concurrency 10,50,100,500
+# The VPN payload is encrypted with the cdnx_qa_key env var.
+# ----------------------------------------------------------------------
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[
+        min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))
+    ]
+
+
+async def run_level(session, url, concurrency, duration):
+    latencies = []
+    errors = 0
+    received = 0
+    deadline = time.monotonic() + duration
+
+    async def client():
+        nonlocal errors, received
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    async for chunk in response.content.iter_any():
+                        received += len(chunk)
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    completed = len(latencies)
+    p50 = percentile(latencies, 0.50)
+    p99 = percentile(latencies, 0.99)
+    return {
+        "concurrency": concurrency,
+        "completed": completed,
+        "errors": errors,
+        "error_rate": errors / max(completed + errors, 1),
+        "requests_per_second": completed / elapsed,
+        "megabytes_per_second": received / elapsed / 1e6,
+        "p50_ms": p50 * 1000 if p50 is not None else None,
+        "p99_ms": p99 * 1000 if p99 is not None else None,
+    }
+
+
+async def run(args):
+    crypto_util = Fernet(os.getenv("cdnx_qa_key").encode("utf-8"))
+    results = {}
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for target in args.target:
+            name, base_url = target.split("=", 1)
+            levels = []
+            for concurrency in args.concurrency:
+                # A fresh payload per level, the same way the user device builds one
+                payload = crypto_util.encrypt(args.endpoint.encode("utf-8")).decode()
+                url = f"{base_url}/use_vpn?vpn_payload={payload}"
+                if args.stream:
+                    url += "&stream=1"
+                level = await run_level(session, url, concurrency, args.duration)
+                levels.append(level)
+                print(name, json.dumps(level))
+
+            sustained = [
+                level["concurrency"]
+                for level in levels
+                if level["error_rate"] <= args.max_error_rate
+                and level["p99_ms"] is not None
+                and level["p99_ms"] <= args.max_p99_ms
+            ]
+            results[name] = {
+                "levels": levels,
+                "sustained_concurrency": max(sustained) if sustained else 0,
+            }
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VPN relay load test")
+    parser.add_argument("--target", action="append", required=True)
+    parser.add_argument("--endpoint", default="cdn", choices=["cdn", "direct"])
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[10, 50, 100, 250, 500, 1000],
+    )
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--max-p99-ms", type=float, default=30000)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
@@ -0,0 +1,359 @@
+import argparse
+import csv
+import json
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stats import summarize
+
+# ----------------------------------------------------------------------
+# Retrieval Strategy Benchmark Runner
+# Drives the user device's endpoints for the five retrieval strategies the
+# DownloadSpeedsChart compares, over a configurable number of trials and
+# concurrency levels:
+#   direct      /download_direct
+#   cdn         /download_cdn
+#   vpn_direct  /use_vpn?endpoint=direct
+#   vpn_cdn     /use_vpn?endpoint=cdn
+#   cdnx        /use_cdnx, bypassing the device cache so every run is a full transfer
+# and three ways of serving a CDNx miss (--miss-content-key, a key that is
+# not in the VPN-managed CDN), for comparing against vpn_cdn with --stream:
+#   cdnx_miss_separate  /use_cdnx then /use_vpn, two round trips
+#   cdnx_miss_combined  /use_cdnx relaying the asset on a miss, one round trip
+#   cdnx_miss_hedged    the same, with the origin fetch started during the lookup
+# and, for devices started with cdnx_device_cache_dir, repeat views served
+# through the device cache (not run unless asked for with --strategies):
+#   cdnx_cached         /use_cdnx?cache=1
+# Strategies are interleaved in a freshly shuffled order every round so slow
+# drift in network conditions is spread evenly over all of them, and the
+# first rounds are discarded as warm-up. Results are summarized with mean,
+# percentiles, throughput and 95% confidence intervals, along with the
+# per-phase breakdown the device reports, and written as JSON
+# (summary plus raw samples) and CSV (raw samples) stamped with the git
+# commit, so a run can be compared against an earlier one to catch
+# regressions. Point --device and --vpn at a real deployment or at local
+# stand-in services.
+#
+# Usage:
+#   python3 run_benchmarks.py --device http://device:8000 --vpn http://vpn:8000 \
+#       --trials 30 --concurrency 1,4 --json results.json --csv results.csv
+#   python3 run_benchmarks.py ... --compare baseline.json
+# ----------------------------------------------------------------------
+
+STRATEGIES = {
+    "direct": ("/download_direct", {}),
+    "cdn": ("/download_cdn", {}),
+    "vpn_direct": ("/use_vpn", {"endpoint": "direct"}),
+    "vpn_cdn": ("/use_vpn", {"endpoint": "cdn"}),
+    "cdnx": ("/use_cdnx", {"cache": "0"}),
+    "cdnx_miss_separate": (
+        "/use_cdnx",
+        {"fallback": "cdn", "fallback_mode": "separate"},
+    ),
+    "cdnx_miss_combined": (
+        "/use_cdnx",
+        {"fallback": "cdn", "fallback_mode": "combined"},
+    ),
+    "cdnx_miss_hedged": (
+        "/use_cdnx",
+        {"fallback": "cdn", "fallback_mode": "combined", "hedge": "1"},
+    ),
+    "cdnx_cached": ("/use_cdnx", {"cache": "1"}),
+}
+
+# Strategies that need more than the default deployment, only run when listed
+OPTIONAL_STRATEGIES = {"cdnx_cached"}
+
+
+# Reads the device-reported elapsed time in milliseconds from a response body. The
+# device reports a JSON object with elapsed_ms and a per-phase breakdown; older
+# builds report a JSON "1234.5 milliseconds" string.
+def reported_milliseconds(body):
+    if isinstance(body, dict):
+        if "elapsed_ms" in body:
+            return float(body["elapsed_ms"])
+        body = body.get("elapsed_time", "")
+    if isinstance(body, str) and body.endswith(" milliseconds"):
+        return float(body.split()[0])
+    return None
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Runner:
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(args.concurrency))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request_params(self, strategy):
+        path, params = STRATEGIES[strategy]
+        params = dict(params)
+        if path in ("/use_vpn", "/use_cdnx"):
+            params["url"] = self.args.vpn
+        if strategy in ("cdnx", "cdnx_cached"):
+            params["content_key"] = self.args.content_key
+        elif strategy.startswith("cdnx_miss"):
+            params["content_key"] = self.args.miss_content_key
+        if self.args.stream and path == "/use_vpn":
+            params["stream"] = "true"
+        return self.args.device + path, params
+
+    # One request, returning a raw sample row
+    def measure(self, strategy, concurrency, trial):
+        url, params = self.request_params(strategy)
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, params=params, timeout=self.args.timeout)
+            wall_ms = (time.perf_counter() - started) * 1000
+            ok = response.status_code == 200
+            body = response.json() if ok else None
+            opened = response.headers.get("X-Cdnx-Connections-Opened")
+        except (requests.exceptions.RequestException, ValueError):
+            wall_ms = (time.perf_counter() - started) * 1000
+            ok, body, opened = False, None, None
+
+        return {
+            "strategy": strategy,
+            "concurrency": concurrency,
+            "trial": trial,
+            "ok": ok,
+            "reported_ms": reported_milliseconds(body) if ok else None,
+            "wall_ms": wall_ms,
+            "connections_opened": int(opened) if opened is not None else None,
+            "phases": body.get("phases") if isinstance(body, dict) else None,
+            "timestamp": time.time(),
+        }
+
+    # One strategy at one concurrency level: that many requests at once
+    def run_batch(self, pool, strategy, concurrency, trial):
+        started = time.perf_counter()
+        rows = list(
+            pool.map(
+                lambda _: self.measure(strategy, concurrency, trial), range(concurrency)
+            )
+        )
+        return rows, time.perf_counter() - started
+
+    def run(self):
+        samples = []
+        busy_seconds = {}
+        shuffler = random.Random(self.args.seed)
+
+        with ThreadPoolExecutor(max_workers=max(self.args.concurrency)) as pool:
+            for concurrency in self.args.concurrency:
+                rounds = self.args.warmup + self.args.trials
+                for trial in range(rounds):
+                    order = list(self.args.strategies)
+                    shuffler.shuffle(order)
+                    for strategy in order:
+                        rows, seconds = self.run_batch(
+                            pool, strategy, concurrency, trial
+                        )
+                        if trial < self.args.warmup:
+                            continue
+                        samples.extend(rows)
+                        key = (strategy, concurrency)
+                        busy_seconds[key] = busy_seconds.get(key, 0) + seconds
+                    print(
+                        "concurrency %d round %d/%d done"
+                        % (concurrency, trial + 1, rounds),
+                        file=sys.stderr,
+                    )
+
+        return samples, busy_seconds
+
+
+def summarize_samples(samples, busy_seconds):
+    summary = []
+    for (strategy, concurrency), seconds in sorted(busy_seconds.items()):
+        rows = [
+            row
+            for row in samples
+            if row["strategy"] == strategy and row["concurrency"] == concurrency
+        ]
+        ok_rows = [row for row in rows if row["ok"]]
+        reported = [
+            row["reported_ms"] for row in ok_rows if row["reported_ms"] is not None
+        ]
+        warm = [
+            row["reported_ms"]
+            for row in ok_rows
+            if row["reported_ms"] is not None and row["connections_opened"] == 0
+        ]
+        phases = {}
+        for row in ok_rows:
+            for name, ms in (row["phases"] or {}).items():
+                phases.setdefault(name, []).append(ms)
+        summary.append(
+            {
+                "strategy": strategy,
+                "concurrency": concurrency,
+                "requests": len(rows),
+                "errors": len(rows) - len(ok_rows),
+                "throughput_rps": len(ok_rows) / seconds if seconds else 0.0,
+                "reported_ms": summarize(reported),
+                "wall_ms": summarize([row["wall_ms"] for row in ok_rows]),
+                "warm_reported_ms": summarize(warm),
+                "phases_ms": {
+                    name: summarize(values) for name, values in sorted(phases.items())
+                },
+            }
+        )
+    return summary
+
+
+# Flags strategies whose mean got slower than the baseline by more than the threshold,
+# where the confidence intervals of the two runs do not overlap
+def compare(summary, baseline_path, threshold):
+    with open(baseline_path) as source:
+        baseline = json.load(source)
+
+    previous = {
+        (entry["strategy"], entry["concurrency"]): entry["reported_ms"]
+        for entry in baseline["summary"]
+    }
+    regressions = []
+    for entry in summary:
+        before = previous.get((entry["strategy"], entry["concurrency"]))
+        after = entry["reported_ms"]
+        if not before or not before.get("count") or not after.get("count"):
+            continue
+        change = after["mean"] / before["mean"] - 1
+        entry["change_vs_baseline"] = change
+        if change > threshold and after["ci95_low"] > before["ci95_high"]:
+            regressions.append(
+                {
+                    "strategy": entry["strategy"],
+                    "concurrency": entry["concurrency"],
+                    "baseline_mean_ms": before["mean"],
+                    "mean_ms": after["mean"],
+                    "change": change,
+                }
+            )
+    return {"baseline_commit": baseline.get("commit"), "regressions": regressions}
+
+
+def write_csv(path, samples):
+    with open(path, "w", newline="") as out:
+        writer = csv.DictWriter(out, fieldnames=list(samples[0].keys()))
+        writer.writeheader()
+        for row in samples:
+            writer.writerow(dict(row, phases=json.dumps(row["phases"])))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Retrieval strategy benchmark runner")
+    parser.add_argument("--device", required=True, help="user device base URL")
+    parser.add_argument("--vpn", required=True, help="VPN service base URL")
+    parser.add_argument("--content-key", default="10mb.bin")
+    parser.add_argument("--miss-content-key", default="not-in-cdnx.bin")
+    parser.add_argument(
+        "--strategies",
+        type=lambda value: value.split(","),
+        default=[name for name in STRATEGIES if name not in OPTIONAL_STRATEGIES],
+    )
+    parser.add_argument("--trials", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1],
+    )
+    parser.add_argument("--stream", action="store_true", help="use the streamed relay")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="write summary and raw samples as JSON")
+    parser.add_argument("--csv", help="write raw samples as CSV")
+    parser.add_argument("--compare", help="earlier --json output to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    unknown = set(args.strategies) - set(STRATEGIES)
+    if unknown:
+        parser.error("unknown strategies: %s" % ", ".join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    samples, busy_seconds = Runner(args).run()
+    summary = summarize_samples(samples, busy_seconds)
+
+    result = {
+        "commit": git_commit(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("json", "csv")
+        },
+        "summary": summary,
+    }
+    if args.compare:
+        result["comparison"] = compare(summary, args.compare, args.regression_threshold)
+
+    for entry in summary:
+        reported = entry["reported_ms"]
+        if reported.get("count"):
+            print(
+                "%-18s c=%-3d mean %9.1f ms  p50 %9.1f  p95 %9.1f  p99 %9.1f  "
+                "ci95 [%0.1f, %0.1f]  %.2f req/s  errors %d"
+                % (
+                    entry["strategy"],
+                    entry["concurrency"],
+                    reported["mean"],
+                    reported["p50"],
+                    reported["p95"],
+                    reported["p99"],
+                    reported["ci95_low"],
+                    reported["ci95_high"],
+                    entry["throughput_rps"],
+                    entry["errors"],
+                )
+            )
+            for name, phase in entry["phases_ms"].items():
+                print(
+                    "    %-22s mean %9.1f ms  p95 %9.1f"
+                    % (name, phase["mean"], phase["p95"])
+                )
+        else:
+            print(
+                "%-18s c=%-3d no successful requests"
+                % (entry["strategy"], entry["concurrency"])
+            )
+
+    if args.json:
+        result["samples"] = samples
+        with open(args.json, "w") as out:
+            json.dump(result, out, indent=2)
+    if args.csv and samples:
+        write_csv(args.csv, samples)
+
+    regressions = result.get("comparison", {}).get("regressions")
+    if regressions:
+        print("regressions against baseline:", json.dumps(regressions, indent=2))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
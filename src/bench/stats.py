@@ -0,0 +1,83 @@
+import math
+
+# ----------------------------------------------------------------------
+# Benchmark Statistics
+# Summary statistics shared by the benchmark scripts: percentiles by the
+# nearest-rank method and a t-distribution confidence interval for the
+# mean, which matters at the small trial counts the experiment uses.
+# ----------------------------------------------------------------------
+
+# Two-sided 95% critical values of Student's t by degrees of freedom
+_T_95 = {
+    1: 12.706,
+    2: 4.303,
+    3: 3.182,
+    4: 2.776,
+    5: 2.571,
+    6: 2.447,
+    7: 2.365,
+    8: 2.306,
+    9: 2.262,
+    10: 2.228,
+    11: 2.201,
+    12: 2.179,
+    13: 2.160,
+    14: 2.145,
+    15: 2.131,
+    16: 2.120,
+    17: 2.110,
+    18: 2.101,
+    19: 2.093,
+    20: 2.086,
+    25: 2.060,
+    30: 2.042,
+    40: 2.021,
+    60: 2.000,
+    120: 1.980,
+}
+
+
+def t_critical_95(degrees_of_freedom):
+    if degrees_of_freedom in _T_95:
+        return _T_95[degrees_of_freedom]
+    # Use the next smaller tabulated value, which errs on the side of a wider interval
+    smaller = [df for df in _T_95 if df < degrees_of_freedom]
+    if degrees_of_freedom > 120:
+        return 1.960
+    return _T_95[max(smaller)]
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+# Mean, spread, percentiles and a 95% confidence interval of the mean
+def summarize(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    if count == 0:
+        return {"count": 0}
+
+    mean = sum(ordered) / count
+    stdev = (
+        math.sqrt(sum((x - mean) ** 2 for x in ordered) / (count - 1))
+        if count > 1
+        else 0.0
+    )
+    half_width = t_critical_95(count - 1) * stdev / math.sqrt(count) if count > 1 else 0
+
+    return {
+        "count": count,
+        "mean": mean,
+        "stdev": stdev,
+        "min": ordered[0],
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1],
+        "ci95_low": mean - half_width,
+        "ci95_high": mean + half_width,
+    }
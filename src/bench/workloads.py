@@ -0,0 +1,38 @@
+import bisect
+import itertools
+import random
+
+# ----------------------------------------------------------------------
+# Benchmark Workloads
+# Shared request generators for the benchmarks. Content popularity on real
+# CDNs is heavily skewed, so the default key stream is Zipf distributed:
+# the k-th most popular key is requested in proportion to 1 / k^s.
+# ----------------------------------------------------------------------
+
+
+class ZipfKeys:
+    """Draws content keys from a fixed catalog with Zipf distributed popularity."""
+
+    def __init__(self, catalog_size, exponent=1.0, seed=None, prefix="asset/"):
+        self.catalog_size = catalog_size
+        self.prefix = prefix
+        self._random = random.Random(seed)
+        weights = (1.0 / (rank**exponent) for rank in range(1, catalog_size + 1))
+        self._cumulative = list(itertools.accumulate(weights))
+
+    # Returns the popularity rank (0 is the most popular) of the next request
+    def next_rank(self):
+        target = self._random.random() * self._cumulative[-1]
+        return bisect.bisect_left(self._cumulative, target)
+
+    # Share of requests that go to the count most popular keys
+    def top_share(self, count):
+        return (
+            self._cumulative[min(count, self.catalog_size) - 1] / self._cumulative[-1]
+        )
+
+    def next_key(self):
+        return "%s%d.bin" % (self.prefix, self.next_rank())
+
+    def keys(self, count):
+        return [self.next_key() for _ in range(count)]
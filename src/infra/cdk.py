@@ -1,4 +1,8 @@
+import hashlib
 import os
+import shutil
+import subprocess
+import sys
 
 from aws_cdk import App, Environment, Stack
 from aws_cdk import aws_ec2 as ec2
@@ -12,6 +16,121 @@ CDN_URL = os.getenv("cdnx_qa_cdn_url")
 ENCRYPTED_CONTENT_KEY = os.getenv("cdnx_encrypted_content_key")
 CDNX_CONTENT_CACHE = os.getenv("cdnx_qa_content_cache")
 QA_KEY = os.getenv("cdnx_qa_key")
+# Entrypoint the VPN server is started with: vpn_service.py (Flask) or
+# vpn_service_async.py (asyncio serving mode)
+VPN_SERVICE_ENTRYPOINT = os.getenv("cdnx_vpn_entrypoint", "vpn_service.py")
+# "production" starts every service under gunicorn with serve.py (prefork workers
+# sized to the instance's cores), "dev" with Flask's development server
+SERVING_MODE = os.getenv("cdnx_serving_mode", "production")
+# Number of content key cache shards to deploy, and how many of them hold each key
+CACHE_SHARDS = int(os.getenv("cdnx_cache_shards", 1))
+CACHE_REPLICAS = int(os.getenv("cdnx_cache_replicas", 1))
+# Directory the user device caches encrypted CDNx objects in, empty to keep every
+# download a full transfer
+DEVICE_CACHE_DIR = os.getenv("cdnx_device_cache_dir", "")
+# How the user device sends its VPN requests: "http", one request each, or "tunnel",
+# multiplexed on one long-lived tunnel, which needs the vpn_service_async.py entrypoint
+VPN_TRANSPORT = os.getenv("cdnx_vpn_transport", "http")
+# "1" ships each service's dependencies prebuilt next to its code so boot only has to
+# unpack them, "0" installs them from the package index at boot
+DEPENDENCY_BUNDLE = os.getenv("cdnx_dependency_bundle", "1") == "1"
+# Python the instances run (Amazon Linux 2's python3) and the platform of their CPU
+BUNDLE_PYTHON_VERSION = os.getenv("cdnx_bundle_python_version", "3.7")
+BUNDLE_PLATFORM = "manylinux2014_aarch64"
+# pip evaluates environment markers against the Python running synth rather than the
+# target, so the backports older Pythons need are always bundled (aiohttp's asynctest
+# is left out, only its test utilities use it)
+BUNDLE_BACKPORTS = ["importlib-metadata", "typing-extensions"]
+
+# Packages each service needs at run time
+CACHE_PACKAGES = ["flask", "gunicorn==23.0.0", "requests==2.29.0"]
+VPN_SERVICE_PACKAGES = [
+    "aiohttp",
+    "cryptography",
+    "flask",
+    "gunicorn==23.0.0",
+    "redis",
+    "requests==2.29.0",
+]
+USER_DEVICE_PACKAGES = [
+    "aiohttp",
+    "cryptography",
+    "flask",
+    "gunicorn==23.0.0",
+    "requests==2.29.0",
+]
+
+# First user data command, marking when setup started for the readiness probe
+MARK_SETUP_STARTED = "setup_started=$(date +%s.%N)"
+
+
+# Shell command starting a service from its entrypoint in the chosen serving mode
+def start_command(entrypoint):
+    if SERVING_MODE == "dev":
+        return f"python3 {entrypoint}"
+    return f"python3 serve.py {entrypoint}"
+
+
+# Directory of packages installed for the instances' Python and CPU, built with pip
+# at synth time from binary wheels only. Bundles are named after their package list,
+# so an unchanged list is neither rebuilt nor uploaded again; delete build/ to pick
+# up new releases.
+def dependency_bundle(packages):
+    spec = " ".join(
+        sorted(packages + BUNDLE_BACKPORTS) + [BUNDLE_PYTHON_VERSION, BUNDLE_PLATFORM]
+    )
+    name = hashlib.sha256(spec.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(os.getcwd(), "build", "dependencies-" + name)
+    if not os.path.isdir(path):
+        staging = path + ".partial"
+        shutil.rmtree(staging, ignore_errors=True)
+        subprocess.run(
+            [sys.executable, "-m", "pip", "install", "--quiet"]
+            + ["--target", staging, "--platform", BUNDLE_PLATFORM]
+            + ["--python-version", BUNDLE_PYTHON_VERSION, "--implementation", "cp"]
+            + ["--only-binary=:all:", "--no-compile"]
+            + packages
+            + BUNDLE_BACKPORTS,
+            check=True,
+        )
+        os.rename(staging, path)
+    return path
+
+
+# S3 asset of a service's dependency bundle, or None when they are installed at boot
+def dependency_asset(scope, id, packages):
+    if not DEPENDENCY_BUNDLE:
+        return None
+    return s3_assets.Asset(scope, id, path=dependency_bundle(packages))
+
+
+# User data commands putting a service's dependencies in place, run from /opt/app
+def dependency_commands(asset, packages):
+    if asset is None:
+        return [
+            "yum update -y",
+            "python3 -m pip install --upgrade pip",
+            "pip3 install " + " ".join(packages),
+        ]
+    return [
+        f"aws s3 cp {asset.s3_object_url} dependencies.zip",
+        "unzip -q -o dependencies.zip -d /opt/app/site-packages",
+        "export PYTHONPATH=/opt/app/site-packages",
+    ]
+
+
+# User data commands starting a service in the background, then waiting for its first
+# heartbeat and logging the bring-up times to the console and /var/log
+def start_commands(entrypoint):
+    service = entrypoint[:-3]
+    return [
+        "service_started=$(date +%s.%N)",
+        f"nohup {start_command(entrypoint)} >> /var/log/cdnx-service.log 2>&1 &",
+        f"python3 readiness.py --service {service} --setup-started $setup_started"
+        " --service-started $service_started"
+        " | tee -a /var/log/cdnx-readiness.log > /dev/console",
+    ]
+
 
 # ----------------------------------------------------------------------
 # VPN Service Stack – Creates servers for the VPN service and CDNx Cache
@@ -58,9 +177,13 @@ class VpnServiceStack(Stack):
         repo_directory = os.path.abspath(
             os.path.join(current_directory, os.path.pardir)
         )
-        cdnx_cache_code_path = repo_directory + "/app/cdnx_content_key_cache.py"
+        # the whole app directory is bundled so services can import the shared modules
+        app_code_path = repo_directory + "/app"
         cdnx_cache_app_asset = s3_assets.Asset(
-            self, "cdnx_cache_asset", path=cdnx_cache_code_path
+            self, "cdnx_cache_asset", path=app_code_path
+        )
+        cdnx_cache_dependency_asset = dependency_asset(
+            self, "cdnx_cache_dependency_asset", CACHE_PACKAGES
         )
 
         # create ec2 role for CDNx Cache
@@ -82,41 +205,49 @@ class VpnServiceStack(Stack):
 
         # allow ec2 role to get asset
         cdnx_cache_app_asset.grant_read(cdnx_cache_ec2_role)
+        if cdnx_cache_dependency_asset is not None:
+            cdnx_cache_dependency_asset.grant_read(cdnx_cache_ec2_role)
 
         # User data script for deploying the code from S3 to the provisioned server
         user_data = ec2.UserData.for_linux()
         user_data.add_commands(
+            MARK_SETUP_STARTED,
             # Set env var for encrypted content key
             f"export cdnx_encrypted_content_key={ENCRYPTED_CONTENT_KEY}",
-            "yum update -y",
             # Create a dir for the app
             "mkdir -p /opt/app",
             f"cd /opt/app",
             # Download the asset bundle from S3
-            f"aws s3 cp {cdnx_cache_app_asset.s3_object_url} cdnx_content_key_cache.py",
-            # Install dependencies
-            "python3 -m pip install --upgrade pip",
-            "pip3 install flask",
+            f"aws s3 cp {cdnx_cache_app_asset.s3_object_url} app.zip",
+            "unzip -o app.zip",
+            # Put the dependencies in place
+            *dependency_commands(cdnx_cache_dependency_asset, CACHE_PACKAGES),
             # Start the app
-            "python3 cdnx_content_key_cache.py",
+            *start_commands("cdnx_content_key_cache.py"),
         )
 
-        # Server for cdnx cache
-        cdnx_cache_server = ec2.Instance(
-            self,
-            "CDNxCache",
-            instance_type=ec2.InstanceType("t4g.micro"),
-            machine_image=ec2.MachineImage.latest_amazon_linux2(
-                cpu_type=ec2.AmazonLinuxCpuType.ARM_64,
-            ),
-            vpc=vpc,
-            security_group=self.cdnx_cache_sg,
-            instance_name="CDNxCache",
-            user_data=user_data,
-            role=cdnx_cache_ec2_role,
-        )
-        # Save the public IP of the cache server to set in VPN service env variables
-        cache_domain = cdnx_cache_server.instance_public_ip
+        # Servers for the cdnx cache, one per shard. The first keeps the original
+        # construct id and name so single-shard stacks deploy as before.
+        cache_shards = []
+        for shard in range(CACHE_SHARDS):
+            suffix = str(shard) if shard else ""
+            cdnx_cache_server = ec2.Instance(
+                self,
+                "CDNxCache" + suffix,
+                instance_type=ec2.InstanceType("t4g.micro"),
+                machine_image=ec2.MachineImage.latest_amazon_linux2(
+                    cpu_type=ec2.AmazonLinuxCpuType.ARM_64,
+                ),
+                vpc=vpc,
+                security_group=self.cdnx_cache_sg,
+                instance_name="CDNxCache" + suffix,
+                user_data=user_data,
+                role=cdnx_cache_ec2_role,
+            )
+            # Shards are routed by name so keys keep their shard if an instance is replaced
+            cache_shards.append(f"shard-{shard}={cdnx_cache_server.instance_public_ip}")
+        # Save the public IPs of the cache servers to set in VPN service env variables
+        cache_domain = ",".join(cache_shards)
 
         # Security Group for VPN server
         self.vpn_sg = ec2.SecurityGroup(
@@ -134,10 +265,11 @@ class VpnServiceStack(Stack):
         )
 
         # put service code in s3 for deployment
-        vpn_service_code_path = repo_directory + "/app/vpn_service.py"
-
         vpn_service_app_asset = s3_assets.Asset(
-            self, "vpn_service_asset", path=vpn_service_code_path
+            self, "vpn_service_asset", path=app_code_path
+        )
+        vpn_service_dependency_asset = dependency_asset(
+            self, "vpn_service_dependency_asset", VPN_SERVICE_PACKAGES
         )
 
         # create ec2 role for VPN Server
@@ -158,26 +290,29 @@ class VpnServiceStack(Stack):
 
         # allow ec2 role to get asset
         vpn_service_app_asset.grant_read(vpn_service_ec2_role)
+        if vpn_service_dependency_asset is not None:
+            vpn_service_dependency_asset.grant_read(vpn_service_ec2_role)
 
         # User data script for setting env vars and deploying the code from S3 to the provisioned server
         user_data = ec2.UserData.for_linux()
         user_data.add_commands(
+            MARK_SETUP_STARTED,
             # Set env variables
             f"export cdnx_qa_cdn_url={CDN_URL}",
             f"export cdnx_qa_key={QA_KEY}",
             f"export cdnx_content_key={CONTENT_KEY}",
             f"export cdnx_content_key_cache={cache_domain}",
-            "yum update -y",
+            f"export cdnx_cache_replicas={CACHE_REPLICAS}",
             # Create a dir for the app
             "mkdir -p /opt/app",
             f"cd /opt/app",
             # Download the asset bundle from S3
-            f"aws s3 cp {vpn_service_app_asset.s3_object_url} vpn_service.py",
-            # Install dependencies
-            "python3 -m pip install --upgrade pip",
-            "pip3 install cryptography flask redis requests==2.29.0",
+            f"aws s3 cp {vpn_service_app_asset.s3_object_url} app.zip",
+            "unzip -o app.zip",
+            # Put the dependencies in place
+            *dependency_commands(vpn_service_dependency_asset, VPN_SERVICE_PACKAGES),
             # Start the app
-            "python3 vpn_service.py",
+            *start_commands(VPN_SERVICE_ENTRYPOINT),
         )
 
         # Server for VPN service
@@ -244,9 +379,13 @@ class UserDeviceVPCStack(Stack):
         repo_directory = os.path.abspath(
             os.path.join(current_directory, os.path.pardir)
         )
-        code_path = repo_directory + "/app/user_device.py"
+        # the whole app directory is bundled so services can import the shared modules
+        code_path = repo_directory + "/app"
 
         app_asset = s3_assets.Asset(self, "user_device_asset", path=code_path)
+        dependency_bundle_asset = dependency_asset(
+            self, "user_device_dependency_asset", USER_DEVICE_PACKAGES
+        )
 
         # create ec2 role for User Device server
         ec2_role = iam.Role(
@@ -266,27 +405,31 @@ class UserDeviceVPCStack(Stack):
 
         # allow ec2 role to get asset
         app_asset.grant_read(ec2_role)
+        if dependency_bundle_asset is not None:
+            dependency_bundle_asset.grant_read(ec2_role)
 
         # User data script for setting env vars and deploying the code from S3 to the provisioned server
         user_data = ec2.UserData.for_linux()
         user_data.add_commands(
+            MARK_SETUP_STARTED,
             # Set env variables
             f"export cdnx_asset_key={ASSET_KEY}",
             f"export cdnx_content_key={CONTENT_KEY}",
             f"export cdnx_qa_content_cache={CDNX_CONTENT_CACHE}",
             f"export cdnx_qa_cdn_url={CDN_URL}",
             f"export cdnx_qa_key={QA_KEY}",
-            "yum update -y",
+            f"export cdnx_device_cache_dir={DEVICE_CACHE_DIR}",
+            f"export cdnx_vpn_transport={VPN_TRANSPORT}",
             # Create a dir for the app
             "mkdir -p /opt/app",
             f"cd /opt/app",
             # Download the asset bundle from S3
-            f"aws s3 cp {app_asset.s3_object_url} user_device.py",
-            # Install dependencies
-            "python3 -m pip install --upgrade pip",
-            "pip3 install cryptography flask requests==2.29.0",
+            f"aws s3 cp {app_asset.s3_object_url} app.zip",
+            "unzip -o app.zip",
+            # Put the dependencies in place
+            *dependency_commands(dependency_bundle_asset, USER_DEVICE_PACKAGES),
             # Start the app
-            "python3 user_device.py",
+            *start_commands("user_device.py"),
         )
 
         # Server for User Device service
@@ -0,0 +1,212 @@
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+
+# ----------------------------------------------------------------------
+# Content Type Samples
+# Generates a fixed set of assets of the content types a VPN relays, for
+# measuring how each one fares with the relay's compress-then-encrypt
+# mode. Text content is built from a seeded vocabulary so it compresses
+# about as well as real pages and API responses do, rather than trivially:
+#   page.html    markup with attributes and prose
+#   data.json    an API response of nested records
+#   app.js       minified-looking script
+#   notes.txt    plain prose
+#   page.html.gz the same page already gzip compressed
+#   video.bin    incompressible bytes, like media or the random 10mb.bin
+# Every run writes the same bytes, so results are comparable across runs.
+#
+# The local topology serves these from its origin and CDN under samples/.
+# Usage: python3 content_samples.py <directory> [--size 1048576]
+# ----------------------------------------------------------------------
+
+SAMPLES_DIRECTORY = "samples"
+
+SAMPLE_NAMES = [
+    "page.html",
+    "data.json",
+    "app.js",
+    "notes.txt",
+    "page.html.gz",
+    "video.bin",
+]
+
+DEFAULT_SIZE = 1024 * 1024
+
+VOCABULARY_SIZE = 4000
+
+
+def vocabulary(rng):
+    letters = "etaoinshrdlcumwfgypbvkjxqz"
+    weights = [26 - rank for rank in range(len(letters))]
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        length = max(2, int(rng.gauss(6, 2.5)))
+        words.add("".join(rng.choices(letters, weights, k=length)))
+    return sorted(words)
+
+
+# Words drawn with Zipf-like frequencies, as in natural text
+class Words:
+    """Draws words from a seeded vocabulary, the frequent ones most often."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.words = vocabulary(rng)
+        self.cumulative = list(
+            itertools.accumulate(1.0 / rank for rank in range(1, len(self.words) + 1))
+        )
+
+    def take(self, count):
+        return self.rng.choices(self.words, cum_weights=self.cumulative, k=count)
+
+    def sentence(self):
+        words = self.take(self.rng.randint(6, 18))
+        return " ".join(words).capitalize() + "."
+
+
+def prose(words, size):
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = " ".join(words.sentence() for _ in range(words.rng.randint(3, 8)))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def html_page(words, size):
+    rng = words.rng
+    parts = [
+        '<!DOCTYPE html>\n<html lang="en">\n<head><title>%s</title></head>\n<body>\n'
+        % " ".join(words.take(4))
+    ]
+    length = len(parts[0])
+    while length < size:
+        tag = rng.choice(["div", "section", "article", "li", "p"])
+        classes = " ".join(words.take(rng.randint(1, 3)))
+        href = "/%s/%s-%d" % tuple(words.take(2) + [rng.randint(1, 99999)])
+        element = '<%s class="%s" id="%s-%d"><a href="%s">%s</a> %s</%s>\n' % (
+            tag,
+            classes,
+            words.take(1)[0],
+            rng.randint(1, 9999),
+            href,
+            " ".join(words.take(rng.randint(1, 4))),
+            words.sentence(),
+            tag,
+        )
+        parts.append(element)
+        length += len(element)
+    parts.append("</body>\n</html>\n")
+    return "".join(parts)
+
+
+def json_records(words, size):
+    rng = words.rng
+    records = []
+    length = 0
+    while length < size:
+        record = {
+            "id": rng.randint(1, 10**9),
+            "name": " ".join(words.take(2)),
+            "tags": words.take(rng.randint(0, 4)),
+            "price": round(rng.uniform(0, 500), 2),
+            "in_stock": rng.random() < 0.7,
+            "updated": "2024-%02d-%02dT%02d:%02d:%02dZ"
+            % (
+                rng.randint(1, 12),
+                rng.randint(1, 28),
+                rng.randint(0, 23),
+                rng.randint(0, 59),
+                rng.randint(0, 59),
+            ),
+            "summary": words.sentence(),
+        }
+        encoded = json.dumps(record)
+        records.append(encoded)
+        length += len(encoded) + 1
+    return '{"items":[' + ",".join(records) + "]}"
+
+
+def script(words, size):
+    rng = words.rng
+    statements = []
+    length = 0
+    while length < size:
+        name = "".join(word.capitalize() for word in words.take(2))
+        argument, other = words.take(2)
+        statement = rng.choice(
+            [
+                "function %s(%s,%s){return %s.%s(%s)+%d}",
+                "var %s=function(%s,%s){if(!%s)return null;%s.push(%s)};",
+                "const %s=(%s,%s)=>{for(let i=0;i<%s.length;i++)%s[i]=%s;};",
+            ]
+        )
+        filled = statement.count("%s")
+        values = [name, argument, other] + words.take(filled - 3)
+        if "%d" in statement:
+            statement = statement % tuple(values + [rng.randint(0, 999)])
+        else:
+            statement = statement % tuple(values)
+        statements.append(statement)
+        length += len(statement)
+    return "".join(statements)
+
+
+# Bytes that do not compress, derived from the sample's name
+def incompressible(name, size):
+    return hashlib.shake_256(name.encode("utf-8")).digest(size)
+
+
+# Sample name -> its content, size bytes or a little more of it
+def generate(size=DEFAULT_SIZE, seed=1):
+    samples = {}
+    for name, build in (
+        ("page.html", html_page),
+        ("data.json", json_records),
+        ("app.js", script),
+        ("notes.txt", prose),
+    ):
+        words = Words(random.Random("%d:%s" % (seed, name)))
+        samples[name] = build(words, size).encode("utf-8")
+    samples["page.html.gz"] = gzip.compress(samples["page.html"], mtime=0)
+    samples["video.bin"] = incompressible("%d:video.bin" % seed, size)
+    return samples
+
+
+# Writes the samples into directory/samples, unless they all are there already
+def write_samples(directory, size=DEFAULT_SIZE, seed=1):
+    sample_directory = os.path.join(directory, SAMPLES_DIRECTORY)
+    if all(
+        os.path.exists(os.path.join(sample_directory, name)) for name in SAMPLE_NAMES
+    ):
+        return SAMPLE_NAMES
+
+    os.makedirs(sample_directory, exist_ok=True)
+    for name, content in generate(size, seed).items():
+        with open(os.path.join(sample_directory, name), "wb") as sample:
+            sample.write(content)
+    return SAMPLE_NAMES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate content type samples")
+    parser.add_argument("directory")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    for name in write_samples(args.directory, args.size, args.seed):
+        path = os.path.join(args.directory, SAMPLES_DIRECTORY, name)
+        print("%-14s %9d bytes" % (name, os.path.getsize(path)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,493 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from aiohttp import web  # noqa: E402
+from cryptography.fernet import Fernet  # noqa: E402
+
+from content_samples import write_samples  # noqa: E402
+from publish_catalog import INDEX_SNAPSHOT, OBJECTS_DIRECTORY, publish  # noqa: E402
+from readiness import wait_for_heartbeat  # noqa: E402
+
+# ----------------------------------------------------------------------
+# Local Emulated-Network Topology
+# Reproduces the experiment on one Linux box instead of two CDK stacks and
+# public servers. The user device, VPN service and content key cache run
+# as local processes; a stub origin serves generated assets in place of
+# mirror.nforce.com and a stub CDN edge serves the same assets plus their
+# CDNx-encrypted objects, published with publish_catalog.py into an index
+# snapshot the cache loads at startup. The assets include the content type
+# samples of content_samples.py, under samples/.
+#
+# Every hop between them goes through an emulated link: a TCP proxy in
+# this process that delays each chunk by the link's one-way latency plus
+# normally distributed jitter, paces it to the link's bandwidth (shared by
+# all connections in that direction) and charges new connections a round
+# trip, as a TCP handshake would. Services are pointed at the links with
+# their usual env vars (cdnx_qa_cdn_url, cdnx_origin_url,
+# cdnx_content_key_cache), so they run unchanged. No root or tc is needed.
+# The defaults model the deployed layout, with the device in us-west-2, the
+# VPN and cache in ap-northeast-2, the origin in Europe and a CDN edge near
+# each side; jitter is seeded so runs are repeatable.
+#
+# Ports, from --base-port: cache +0, VPN +1, device +2, origin +3, CDN +4,
+# then one per link from +10 in the order of LINKS. Service logs, the
+# topology (URLs and links) and, with --serving production, the workers'
+# metrics snapshots are written to the work directory.
+#
+# Usage:
+#   python3 local_topology.py [--link device-vpn=62,3,100] [--serving production]
+#   python3 local_topology.py --run 'python3 ../bench/run_benchmarks.py \
+#       --device $cdnx_topology_device_url --vpn $cdnx_topology_vpn_url'
+# The asset, content and QA keys are read from the usual env vars, or
+# generated for the run when unset.
+# ----------------------------------------------------------------------
+
+APP_DIRECTORY = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, "app")
+)
+
+# Emulated links: name -> (one-way latency ms, jitter ms, bandwidth Mbit/s, 0 for
+# unlimited). The device reaches the VPN through device-vpn, which is the VPN URL
+# to benchmark with.
+LINKS = {
+    "device-vpn": (62.0, 3.0, 100.0),
+    "device-origin": (70.0, 4.0, 100.0),
+    "device-cdn": (3.0, 0.5, 500.0),
+    "vpn-origin": (125.0, 6.0, 100.0),
+    "vpn-cdn": (3.0, 0.5, 500.0),
+    "vpn-cache": (0.25, 0.05, 1000.0),
+}
+
+# Port offsets from --base-port
+CACHE_PORT = 0
+VPN_PORT = 1
+DEVICE_PORT = 2
+ORIGIN_PORT = 3
+CDN_PORT = 4
+FIRST_LINK_PORT = 10
+
+RELAY_CHUNK_SIZE = 64 * 1024
+# Chunks in flight per connection and direction, enough to fill the default links
+RELAY_QUEUE_CHUNKS = 64
+
+ASSET_BLOCK_SIZE = 1024 * 1024
+
+
+class LinkDirection:
+    """One direction of a link, a bottleneck all of its connections queue behind."""
+
+    def __init__(self, latency_ms, jitter_ms, bandwidth_mbps, rng):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.bytes_per_second = bandwidth_mbps * 1e6 / 8 if bandwidth_mbps else None
+        self.rng = rng
+        self.busy_until = 0.0
+        self.bytes = 0
+
+    # Loop time at which a chunk read at now reaches the other end
+    def arrival(self, now, size):
+        start = max(now, self.busy_until)
+        self.busy_until = start
+        if self.bytes_per_second:
+            self.busy_until += size / self.bytes_per_second
+        self.bytes += size
+        delay = self.latency
+        if self.jitter:
+            delay = max(0.0, self.rng.gauss(self.latency, self.jitter))
+        return self.busy_until + delay
+
+
+class EmulatedLink:
+    """A TCP proxy standing in for the network between two services."""
+
+    def __init__(self, name, target, latency_ms, jitter_ms, bandwidth_mbps, seed):
+        self.name = name
+        self.target = target
+        rng = random.Random("%s:%d" % (name, seed))
+        self.uplink = LinkDirection(latency_ms, jitter_ms, bandwidth_mbps, rng)
+        self.downlink = LinkDirection(latency_ms, jitter_ms, bandwidth_mbps, rng)
+        self.connections = 0
+        self.server = None
+        self._tasks = set()
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.connect, host, port)
+
+    # Stops accepting and drops the open connections
+    async def close(self):
+        self.server.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def connect(self, client_reader, client_writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        upstream_writer = None
+        try:
+            # A new connection costs a round trip before any data moves
+            await asyncio.sleep(self.uplink.latency + self.downlink.latency)
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                *self.target
+            )
+            await asyncio.gather(
+                relay(client_reader, upstream_writer, self.uplink),
+                relay(upstream_reader, client_writer, self.downlink),
+            )
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            client_writer.close()
+            if upstream_writer is not None:
+                upstream_writer.close()
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "bytes_up": self.uplink.bytes,
+            "bytes_down": self.downlink.bytes,
+        }
+
+
+# Copies one direction of a connection, holding every chunk until its arrival time
+async def relay(reader, writer, direction):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(RELAY_QUEUE_CHUNKS)
+
+    async def receive():
+        arrival = 0.0
+        try:
+            while True:
+                chunk = await reader.read(RELAY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # Chunks of a connection never overtake each other, whatever the jitter
+                arrival = max(arrival, direction.arrival(loop.time(), len(chunk)))
+                await queue.put((arrival, chunk))
+        except OSError:
+            pass
+        await queue.put((arrival, None))
+
+    receiver = asyncio.ensure_future(receive())
+    try:
+        while True:
+            arrival, chunk = await queue.get()
+            delay = arrival - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if chunk is None:
+                if writer.can_write_eof():
+                    writer.write_eof()
+                return
+            writer.write(chunk)
+            await writer.drain()
+    except OSError:
+        pass
+    finally:
+        receiver.cancel()
+
+
+# A stub origin or CDN edge serving files from its roots, with ranges and HEAD
+def file_server(roots):
+    roots = [os.path.realpath(root) for root in roots]
+
+    async def serve(request):
+        for root in roots:
+            path = os.path.realpath(os.path.join(root, request.match_info["name"]))
+            if path.startswith(root + os.sep) and os.path.isfile(path):
+                return web.FileResponse(path)
+        raise web.HTTPNotFound()
+
+    app = web.Application()
+    app.router.add_get("/{name:.+}", serve)
+    return app
+
+
+# Writes size bytes of incompressible content derived from the asset's name, so every
+# run serves the same assets
+def write_asset(path, content_key, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as asset:
+        for block, offset in enumerate(range(0, size, ASSET_BLOCK_SIZE)):
+            seed = ("%s:%d" % (content_key, block)).encode("utf-8")
+            asset.write(
+                hashlib.shake_256(seed).digest(min(ASSET_BLOCK_SIZE, size - offset))
+            )
+
+
+# Generates the catalog and publishes it, returning the published directory
+def build_catalog(work_directory, asset_key, asset_size, catalog_assets, catalog_size):
+    catalog = os.path.join(work_directory, "catalog")
+    assets = {"10mb.bin": asset_size}
+    for number in range(catalog_assets):
+        assets["asset/%d.bin" % number] = catalog_size
+    for content_key, size in assets.items():
+        path = os.path.join(catalog, content_key)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            write_asset(path, content_key, size)
+    write_samples(catalog)
+
+    published = os.path.join(work_directory, "published")
+    publish(catalog, published, asset_key.encode("utf-8"), prune=True)
+    return catalog, published
+
+
+def parse_link(value):
+    name, _, numbers = value.partition("=")
+    if name not in LINKS:
+        raise argparse.ArgumentTypeError("unknown link: %s" % name)
+    latency, jitter, bandwidth = (float(number) for number in numbers.split(","))
+    return name, (latency, jitter, bandwidth)
+
+
+def start_service(entrypoint, port, env, serving, workers, work_directory):
+    env = dict(env, cdnx_port=str(port))
+    if serving == "production":
+        command = [sys.executable, "serve.py", entrypoint]
+        command += ["--bind", "127.0.0.1:%d" % port, "--workers", str(workers)]
+        # Metrics snapshots of the workers, cleared so a reused work directory does not
+        # add up earlier runs
+        metrics_directory = os.path.join(work_directory, "metrics", entrypoint[:-3])
+        shutil.rmtree(metrics_directory, ignore_errors=True)
+        os.makedirs(metrics_directory)
+        env["cdnx_metrics_directory"] = metrics_directory
+    else:
+        command = [sys.executable, entrypoint]
+    log = open(os.path.join(work_directory, entrypoint[:-3] + ".log"), "ab")
+    return subprocess.Popen(
+        command,
+        cwd=APP_DIRECTORY,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    host = "127.0.0.1"
+    base = args.base_port
+
+    keys = {
+        name: os.getenv(name) or Fernet.generate_key().decode("utf-8")
+        for name in ("cdnx_asset_key", "cdnx_content_key", "cdnx_qa_key")
+    }
+    catalog, published = await loop.run_in_executor(
+        None,
+        build_catalog,
+        args.work_directory,
+        keys["cdnx_asset_key"],
+        args.asset_size,
+        args.catalog_assets,
+        args.catalog_size,
+    )
+
+    runners = []
+    for app, port in (
+        (file_server([catalog]), base + ORIGIN_PORT),
+        (
+            file_server([os.path.join(published, OBJECTS_DIRECTORY), catalog]),
+            base + CDN_PORT,
+        ),
+    ):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+
+    targets = {
+        "device-vpn": base + VPN_PORT,
+        "device-origin": base + ORIGIN_PORT,
+        "device-cdn": base + CDN_PORT,
+        "vpn-origin": base + ORIGIN_PORT,
+        "vpn-cdn": base + CDN_PORT,
+        "vpn-cache": base + CACHE_PORT,
+    }
+    links = {}
+    for offset, (name, shape) in enumerate(LINKS.items()):
+        latency, jitter, bandwidth = args.links.get(name, shape)
+        link = EmulatedLink(
+            name, (host, targets[name]), latency, jitter, bandwidth, args.seed
+        )
+        await link.start(host, base + FIRST_LINK_PORT + offset)
+        links[name] = link
+
+    def link_url(name):
+        return "http://%s:%d" % (host, links[name].server.sockets[0].getsockname()[1])
+
+    env = dict(os.environ, **keys)
+    services = [
+        (
+            "cdnx_content_key_cache.py",
+            base + CACHE_PORT,
+            {
+                "cdnx_index_snapshot": os.path.join(published, INDEX_SNAPSHOT),
+                "cdnx_encrypted_content_key": "",
+            },
+        ),
+        (
+            args.vpn_entrypoint,
+            base + VPN_PORT,
+            {
+                "cdnx_qa_cdn_url": link_url("vpn-cdn") + "/",
+                "cdnx_origin_url": link_url("vpn-origin") + "/",
+                "cdnx_content_key_cache": link_url("vpn-cache")[len("http://") :],
+            },
+        ),
+        (
+            "user_device.py",
+            base + DEVICE_PORT,
+            {
+                "cdnx_qa_cdn_url": link_url("device-cdn") + "/",
+                "cdnx_origin_url": link_url("device-origin") + "/",
+            },
+        ),
+    ]
+    processes = []
+    try:
+        for entrypoint, port, service_env in services:
+            processes.append(
+                start_service(
+                    entrypoint,
+                    port,
+                    dict(env, **service_env),
+                    args.serving,
+                    args.workers,
+                    args.work_directory,
+                )
+            )
+        for entrypoint, port, _ in services:
+            url = "http://%s:%d/heartbeat" % (host, port)
+            attempts = await loop.run_in_executor(
+                None, wait_for_heartbeat, url, args.timeout, 0.1
+            )
+            if attempts is None:
+                print(
+                    "%s did not start, see its log in %s"
+                    % (entrypoint, args.work_directory)
+                )
+                return 1
+
+        topology = {
+            "device_url": "http://%s:%d" % (host, base + DEVICE_PORT),
+            "vpn_url": link_url("device-vpn"),
+            "work_directory": args.work_directory,
+            "links": {
+                name: dict(
+                    zip(
+                        ("latency_ms", "jitter_ms", "bandwidth_mbps"),
+                        args.links.get(name, LINKS[name]),
+                    ),
+                    url=link_url(name),
+                )
+                for name in links
+            },
+        }
+        with open(os.path.join(args.work_directory, "topology.json"), "w") as out:
+            json.dump(topology, out, indent=2)
+        for name, link in topology["links"].items():
+            print(
+                "%-14s %s  %7.2f ms +- %5.2f ms  %6.0f Mbit/s"
+                % (
+                    name,
+                    link["url"],
+                    link["latency_ms"],
+                    link["jitter_ms"],
+                    link["bandwidth_mbps"],
+                )
+            )
+        print(
+            "device %s  vpn (as seen by the device) %s"
+            % (topology["device_url"], topology["vpn_url"])
+        )
+
+        run_env = dict(
+            env,
+            cdnx_topology_device_url=topology["device_url"],
+            cdnx_topology_vpn_url=topology["vpn_url"],
+        )
+        if args.run:
+            command = await asyncio.create_subprocess_shell(args.run, env=run_env)
+            return await command.wait()
+
+        stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        print("running, Ctrl-C to stop")
+        await stopped.wait()
+        return 0
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for link in links.values():
+            await link.close()
+            print("%-14s %s" % (link.name, json.dumps(link.stats())))
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local emulated-network topology")
+    parser.add_argument(
+        "--link",
+        dest="links",
+        type=parse_link,
+        action="append",
+        default=[],
+        help="name=latency ms,jitter ms,bandwidth Mbit/s, overriding a default link",
+    )
+    parser.add_argument("--base-port", type=int, default=8100)
+    parser.add_argument(
+        "--vpn-entrypoint",
+        default="vpn_service.py",
+        choices=["vpn_service.py", "vpn_service_async.py"],
+    )
+    parser.add_argument(
+        "--serving",
+        default="dev",
+        choices=["dev", "production"],
+        help="Flask's development server or serve.py",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="with --serving production"
+    )
+    parser.add_argument("--asset-size", type=int, default=10 * 1024 * 1024)
+    parser.add_argument(
+        "--catalog-assets", type=int, default=32, help="extra asset/<n>.bin assets"
+    )
+    parser.add_argument("--catalog-size", type=int, default=256 * 1024)
+    parser.add_argument("--seed", type=int, default=1, help="seeds the link jitter")
+    parser.add_argument("--work-directory", help="a temporary directory by default")
+    parser.add_argument("--timeout", type=float, default=60, help="service start-up")
+    parser.add_argument("--run", help="shell command to run once up, then stop")
+    args = parser.parse_args(argv)
+    args.links = dict(args.links)
+
+    if args.work_directory:
+        os.makedirs(args.work_directory, exist_ok=True)
+        return asyncio.run(run(args))
+    with tempfile.TemporaryDirectory(prefix="cdnx-topology-") as work_directory:
+        args.work_directory = work_directory
+        return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
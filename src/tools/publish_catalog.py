@@ -0,0 +1,431 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+from cryptography.hazmat.primitives import hashes  # noqa: E402
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF  # noqa: E402
+
+import http_client  # noqa: E402
+from consistent_hash import HashRing, parse_shards  # noqa: E402
+from content_key_index import write_snapshot  # noqa: E402
+from segmented_asset import DEFAULT_SEGMENT_SIZE, SegmentedAssetCipher  # noqa: E402
+
+# ----------------------------------------------------------------------
+# CDNx Catalog Publisher
+# Produces what CDNx serves from: every asset of a catalog encrypted into
+# the segmented container format and stored under an opaque encrypted
+# content key, plus a content key index snapshot that the content key
+# cache loads at startup (cdnx_index_snapshot). The catalog is a
+# directory, whose relative paths become the content keys, or a JSON
+# manifest mapping content keys to file paths.
+#
+# Assets are encrypted by a process pool across all cores, each one
+# streamed segment by segment so memory stays bounded whatever the asset
+# size. Runs are incremental: a state file records the SHA-256 of every
+# published asset, so unchanged assets are skipped (files whose size and
+# mtime are unchanged are not even read again).
+#
+# Encrypted content keys are an HMAC of the content key and the content
+# hash under a key derived from cdnx_asset_key, so names reveal nothing
+# about the asset and a changed asset gets a new name, which CDN edges can
+# cache as immutable.
+#
+# With --admission, only the catalog assets on an admission list written
+# by the VPN service (its cdnx_admission_file, or its /cdnx_admission
+# endpoint) are added to what was published before, so the CDN fills up
+# with the objects users are asking for and missing. --cache inserts the
+# entries into the running content key cache as well, so they are served
+# without waiting for the next snapshot load.
+#
+# Output layout:
+#   <output>/objects/<encrypted content key>   files to upload to the CDN
+#   <output>/index.snap                        content key index snapshot
+#   <output>/index-<shard>.snap                per-shard snapshots, with --shards
+#   <output>/publish-state.json                state for incremental runs
+#
+# Usage: python3 publish_catalog.py <catalog dir or manifest.json> <output dir>
+# The asset key is read from the same cdnx_asset_key env var the services use.
+# ----------------------------------------------------------------------
+
+OBJECTS_DIRECTORY = "objects"
+INDEX_SNAPSHOT = "index.snap"
+SHARD_SNAPSHOT = "index-%s.snap"
+STATE_FILE = "publish-state.json"
+
+# Hex digits of the HMAC used for encrypted content keys
+NAME_LENGTH = 40
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Set in each worker process by init_worker
+worker_cipher = None
+worker_name_key = None
+worker_segment_size = None
+
+
+# Derives the key encrypted content keys are computed with from the asset key
+def name_key_for(asset_key):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"cdnx-object-name-v1"
+    ).derive(base64.urlsafe_b64decode(asset_key))
+
+
+def encrypted_content_key_for(name_key, content_key, content_hash):
+    message = content_key.encode("utf-8") + b"\0" + content_hash.encode("ascii")
+    return hmac.new(name_key, message, hashlib.sha256).hexdigest()[:NAME_LENGTH]
+
+
+class HashingReader:
+    """A readable stream that hashes everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+
+def hash_file(path):
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def init_worker(asset_key, segment_size):
+    global worker_cipher, worker_name_key, worker_segment_size
+
+    worker_cipher = SegmentedAssetCipher(asset_key)
+    worker_name_key = name_key_for(asset_key)
+    worker_segment_size = segment_size
+
+
+# Publishes one asset in a worker process. Returns its new state record and whether
+# it was encrypted (False when the previous record still holds).
+def publish_asset(task):
+    content_key, path, objects_directory, previous = task
+    stat = os.stat(path)
+
+    if previous is not None and os.path.exists(
+        os.path.join(objects_directory, previous["encrypted_content_key"])
+    ):
+        if (
+            previous["size"] == stat.st_size
+            and previous["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return content_key, previous, False
+        # Touched but maybe unchanged: hashing is cheaper than encrypting again
+        content_hash = hash_file(path)
+        if content_hash == previous["sha256"]:
+            return (
+                content_key,
+                dict(previous, mtime_ns=stat.st_mtime_ns),
+                False,
+            )
+
+    # Hash while encrypting in a single pass, then name the object after the hash
+    temporary_path = os.path.join(
+        objects_directory,
+        ".%s.tmp" % hashlib.sha256(content_key.encode("utf-8")).hexdigest(),
+    )
+    with open(path, "rb") as source, open(temporary_path, "wb") as out:
+        reader = HashingReader(source)
+        for block in worker_cipher.encrypt_stream(
+            reader, stat.st_size, worker_segment_size
+        ):
+            out.write(block)
+    content_hash = reader.hash.hexdigest()
+
+    encrypted_content_key = encrypted_content_key_for(
+        worker_name_key, content_key, content_hash
+    )
+    os.replace(temporary_path, os.path.join(objects_directory, encrypted_content_key))
+    record = {
+        "encrypted_content_key": encrypted_content_key,
+        "sha256": content_hash,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    return content_key, record, True
+
+
+# Returns {content key: file path} for a catalog directory or JSON manifest
+def read_catalog(catalog):
+    if os.path.isdir(catalog):
+        assets = {}
+        for directory, _, files in os.walk(catalog):
+            for name in files:
+                path = os.path.join(directory, name)
+                content_key = os.path.relpath(path, catalog).replace(os.sep, "/")
+                assets[content_key] = path
+        return assets
+
+    # Manifest paths are relative to the manifest itself
+    with open(catalog) as manifest:
+        entries = json.load(manifest)
+    base = os.path.dirname(os.path.abspath(catalog))
+    return {
+        content_key: os.path.join(base, path) for content_key, path in entries.items()
+    }
+
+
+# Reads the content keys of an admission list from a file or a VPN service URL
+def read_admission(source):
+    if source.startswith(("http://", "https://")):
+        response = http_client.get(source)
+        response.raise_for_status()
+        admission = response.json()
+    else:
+        with open(source) as admission_file:
+            admission = json.load(admission_file)
+    return [entry["content_key"] for entry in admission["admit"]]
+
+
+def read_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state:
+        return json.load(state)
+
+
+def write_state(path, assets):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as out:
+        json.dump(assets, out, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+# Writes the index snapshot, or with shards one snapshot per shard holding the keys
+# the consistent hash ring places on it (on its replicas too with replicas > 1)
+def write_snapshots(output, state, shards, replicas):
+    if not shards:
+        write_snapshot(
+            os.path.join(output, INDEX_SNAPSHOT),
+            (
+                (content_key, record["encrypted_content_key"])
+                for content_key, record in state.items()
+            ),
+        )
+        return
+
+    ring = HashRing(shards)
+    entries = {shard: [] for shard in shards}
+    for content_key, record in state.items():
+        for shard in ring.shards_for(content_key, replicas):
+            entries[shard].append((content_key, record["encrypted_content_key"]))
+    for shard, shard_entries in entries.items():
+        write_snapshot(os.path.join(output, SHARD_SNAPSHOT % shard), shard_entries)
+
+
+# PUTs entries into the running content key cache, on every shard holding each key
+def insert_entries(cache_shards, replicas, entries):
+    addresses = dict(cache_shards)
+    ring = HashRing(addresses)
+    inserted = 0
+    for content_key, encrypted_content_key in entries:
+        for shard in ring.shards_for(content_key, replicas):
+            response = http_client.request(
+                "PUT",
+                f"http://{addresses[shard]}/content_key",
+                json={
+                    "content_key": content_key,
+                    "encrypted_content_key": encrypted_content_key,
+                },
+            )
+            response.raise_for_status()
+        inserted += 1
+    return inserted
+
+
+def publish(
+    catalog,
+    output,
+    asset_key,
+    workers=None,
+    segment_size=None,
+    prune=False,
+    shards=(),
+    replicas=1,
+    admission=None,
+    cache_shards=(),
+):
+    objects_directory = os.path.join(output, OBJECTS_DIRECTORY)
+    os.makedirs(objects_directory, exist_ok=True)
+    state_path = os.path.join(output, STATE_FILE)
+
+    assets = read_catalog(catalog)
+    previous_state = read_state(state_path)
+    admitted = []
+    if admission is not None:
+        # Keep everything published before and add the admitted assets
+        admitted = [content_key for content_key in admission if content_key in assets]
+        assets = {
+            content_key: path
+            for content_key, path in assets.items()
+            if content_key in previous_state or content_key in admitted
+        }
+    tasks = [
+        (content_key, path, objects_directory, previous_state.get(content_key))
+        for content_key, path in sorted(assets.items())
+    ]
+    workers = workers or os.cpu_count() or 1
+
+    started = time.perf_counter()
+    state = {}
+    encrypted_keys = []
+    encrypted_bytes = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(asset_key, segment_size or DEFAULT_SEGMENT_SIZE),
+    ) as pool:
+        # Small assets are handed out in batches so the pool is not bound by IPC
+        chunksize = max(1, min(64, len(tasks) // (workers * 4)))
+        for content_key, record, was_encrypted in pool.map(
+            publish_asset, tasks, chunksize=chunksize
+        ):
+            state[content_key] = record
+            if was_encrypted:
+                encrypted_keys.append(content_key)
+                encrypted_bytes += record["size"]
+
+    write_snapshots(output, state, shards, replicas)
+    write_state(state_path, state)
+
+    # Admitted entries are inserted even when unchanged, in case the cache evicted them
+    inserted = 0
+    if cache_shards:
+        inserted = insert_entries(
+            cache_shards,
+            replicas,
+            (
+                (content_key, state[content_key]["encrypted_content_key"])
+                for content_key in (
+                    admitted if admission is not None else encrypted_keys
+                )
+            ),
+        )
+    seconds = time.perf_counter() - started
+
+    # Objects of removed or changed assets stay on the CDN for clients still holding
+    # their keys unless pruning is asked for
+    live = {record["encrypted_content_key"] for record in state.values()}
+    stale = [
+        name
+        for name in os.listdir(objects_directory)
+        if name not in live and not name.startswith(".")
+    ]
+    if prune:
+        for name in stale:
+            os.remove(os.path.join(objects_directory, name))
+
+    encrypted = len(encrypted_keys)
+    return {
+        "assets": len(state),
+        "encrypted": encrypted,
+        "skipped": len(state) - encrypted,
+        "admitted": len(admitted),
+        "inserted": inserted,
+        "encrypted_bytes": encrypted_bytes,
+        "stale_objects": len(stale),
+        "pruned": len(stale) if prune else 0,
+        "workers": workers,
+        "seconds": seconds,
+        "mb_per_second": encrypted_bytes / 2**20 / seconds if seconds else 0.0,
+        "assets_per_second": len(state) / seconds if seconds else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish a CDNx catalog")
+    parser.add_argument("catalog", help="catalog directory or JSON manifest")
+    parser.add_argument("output", help="directory for objects, snapshot and state")
+    parser.add_argument("--workers", type=int, help="processes, all cores by default")
+    parser.add_argument("--segment-size", type=int, help="container segment size")
+    parser.add_argument(
+        "--prune", action="store_true", help="delete objects no longer in the index"
+    )
+    parser.add_argument(
+        "--shards",
+        type=lambda value: [shard for shard in value.split(",") if shard],
+        default=[],
+        help="comma separated content key cache shard names, one snapshot each",
+    )
+    parser.add_argument(
+        "--replicas", type=int, default=1, help="shards each key is stored on"
+    )
+    parser.add_argument(
+        "--admission",
+        help="admission list file or VPN /cdnx_admission URL; only adds those assets",
+    )
+    parser.add_argument(
+        "--cache",
+        type=parse_shards,
+        default=[],
+        help="content key cache shards to insert entries into, as in "
+        "cdnx_content_key_cache",
+    )
+    parser.add_argument("--json", help="write the run summary as JSON")
+    args = parser.parse_args(argv)
+
+    asset_key = os.getenv("cdnx_asset_key")
+    if not asset_key:
+        parser.error("cdnx_asset_key must be set")
+
+    summary = publish(
+        args.catalog,
+        args.output,
+        asset_key.encode("utf-8"),
+        workers=args.workers,
+        segment_size=args.segment_size,
+        prune=args.prune,
+        shards=args.shards,
+        replicas=args.replicas,
+        admission=read_admission(args.admission) if args.admission else None,
+        cache_shards=args.cache,
+    )
+    print(
+        "%d assets: %d encrypted, %d unchanged in %.2f s with %d workers"
+        % (
+            summary["assets"],
+            summary["encrypted"],
+            summary["skipped"],
+            summary["seconds"],
+            summary["workers"],
+        )
+    )
+    print(
+        "%.1f MB/s encrypted, %.1f assets/s, %d stale objects%s"
+        % (
+            summary["mb_per_second"],
+            summary["assets_per_second"],
+            summary["stale_objects"],
+            " pruned" if args.prune else "",
+        )
+    )
+    if args.admission or args.cache:
+        print(
+            "%d assets admitted, %d entries inserted into the content key cache"
+            % (summary["admitted"], summary["inserted"])
+        )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(summary, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())